@@ -0,0 +1,576 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from itertools import accumulate
+from index_store import (
+    open_stored_index,
+    stored_index_path,
+)
+from doc_norms import (
+    NORMS_PATH,
+    load_doc_norms,
+)
+import query
+import query_tfidf
+from string_processing import (
+    process_tokens,
+    tokenize_text,
+)
+from query_boolean import (
+    run_boolean_query,
+    intersect_query,
+    intersect_galloping,
+    intersect_adaptive,
+    union_query,
+    union_many,
+    intersect_many,
+)
+
+
+def time_func(func, *args, repeat=5):
+    """Time a function call.
+
+    Args:
+        func (callable): the function
+        args: its arguments
+        repeat (int): number of calls
+
+    Returns:
+        float: the best time of the calls, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_intersection(long_len=500000, ratios=(1, 2, 4, 8, 16, 64, 256, 1024, 16384), seed=0):
+    """Compare the intersection routines on lists of skewed lengths.
+
+    Args:
+        long_len (int): length of the long list
+        ratios (list(int)): ratios of the long list length to the short list length
+        seed (int): seed of the random doc_ids
+
+    Returns:
+        list(dict): for each ratio, the time of each routine in seconds
+    """
+    rnd = random.Random(seed)
+    num_docs = 4 * long_len
+    long_list = sorted(rnd.sample(range(num_docs), long_len))
+
+    results = []
+    for ratio in ratios:
+        short_list = sorted(rnd.sample(range(num_docs), max(1, long_len // ratio)))
+        results.append({
+            "ratio": ratio,
+            "short_len": len(short_list),
+            "long_len": long_len,
+            "linear_sec": time_func(intersect_query, short_list, long_list),
+            "galloping_sec": time_func(intersect_galloping, short_list, long_list),
+            "adaptive_sec": time_func(intersect_adaptive, short_list, long_list),
+        })
+    return results
+
+
+def bench_nary(num_docs=1000000, list_len=20000, operands=(2, 4, 8, 16, 32, 64), seed=0):
+    """Compare a chain of binary merges with the one-pass n-ary merges.
+
+    Args:
+        num_docs (int): doc_ids are drawn from range(num_docs)
+        list_len (int): length of each operand list
+        operands (list(int)): numbers of operands of the chains
+        seed (int): seed of the random doc_ids
+
+    Returns:
+        list(dict): for each number of operands, the time of each routine in seconds
+    """
+    rnd = random.Random(seed)
+    lists = [sorted(rnd.sample(range(num_docs), list_len)) for _ in range(max(operands))]
+
+    def fold(op, doc_lists):
+        res = doc_lists[0]
+        for doc_list in doc_lists[1:]:
+            res = op(res, doc_list)
+        return res
+
+    results = []
+    for n in operands:
+        # for the intersection, every list shares a tenth of the doc_ids
+        common = lists[0][::10]
+        and_lists = [sorted(set(doc_list[:list_len - len(common)]) | set(common)) for doc_list in lists[:n]]
+        results.append({
+            "operands": n,
+            "list_len": list_len,
+            "union_chain_sec": time_func(fold, union_query, lists[:n], repeat=3),
+            "union_many_sec": time_func(union_many, lists[:n], repeat=3),
+            "intersect_chain_sec": time_func(fold, intersect_adaptive, and_lists, repeat=3),
+            "intersect_many_sec": time_func(intersect_many, and_lists, repeat=3),
+        })
+    return results
+
+
+def percentile(sorted_values, q):
+    """Get the q-th percentile (0 <= q <= 100) of sorted values, nearest rank."""
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+
+def make_boolean_queries(terms, num_queries, seed=0):
+    """Generate random boolean queries of 1 to 4 terms joined by AND / OR, with
+    an optional NOT.
+
+    Args:
+        terms (list(str)): terms to draw from
+        num_queries (int): number of queries
+        seed (int): seed of the random queries
+
+    Returns:
+        list(str): the queries
+    """
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        query_terms = rnd.sample(terms, rnd.randint(1, 4))
+        query = query_terms[0]
+        for term in query_terms[1:]:
+            query += " " + rnd.choice(["AND", "OR", "AND NOT"]) + " " + term
+        queries.append(query)
+    return queries
+
+
+def bench_boolean_load(num_queries=100000, window=10000, stored=False, seed=0):
+    """Run many boolean queries back to back and record, for each window of
+    queries, the latency percentiles and the number of live threads.
+
+    Args:
+        num_queries (int): number of queries
+        window (int): number of queries of each reported window
+        stored (bool): query the stored index of the working directory instead
+            of a synthetic in-memory index
+        seed (int): seed of the synthetic index and the queries
+
+    Returns:
+        list(dict): for each window, the latency percentiles in ms and the thread count
+    """
+    if stored:
+        (index, doc_freq, _, num_docs) = open_stored_index()
+        # frequent enough terms, without reading the whole term dictionary
+        terms = [term for (_, term) in zip(range(20000), index) if doc_freq[term] >= 10]
+    else:
+        rnd = random.Random(seed)
+        num_docs = 100000
+        terms = ["term{n}".format(n=n) for n in range(1000)]
+        index = {}
+        for (rank, term) in enumerate(terms):
+            # Zipf-like document frequencies
+            df = max(1, num_docs // (10 * (rank + 1)))
+            index[term] = [(docid, 1) for docid in sorted(rnd.sample(range(num_docs), df))]
+        doc_freq = {term: len(postings) for (term, postings) in index.items()}
+    queries = make_boolean_queries(terms, num_queries, seed)
+
+    results = []
+    for start in range(0, num_queries, window):
+        latencies = []
+        for query_string in queries[start:start + window]:
+            t = time.perf_counter()
+            run_boolean_query(query_string, index, doc_freq, num_docs)
+            latencies.append(time.perf_counter() - t)
+        latencies.sort()
+        results.append({
+            "queries": start + len(latencies),
+            "p50_ms": 1000 * percentile(latencies, 50),
+            "p99_ms": 1000 * percentile(latencies, 99),
+            "threads": threading.active_count(),
+        })
+    return results
+
+
+# The most frequent words of the synthetic corpora are stopwords, like in real text
+SYNTHETIC_STOPWORDS = ["the", "of", "and", "to", "in", "a", "is", "that", "for", "it", "as", "was", "with", "on", "by"]
+SYLLABLES = ["ka", "ro", "mi", "te", "su", "na", "lo", "pe", "di", "ga", "ve", "zu", "bi", "fo", "ha", "ju"]
+SUFFIXES = ["", "", "", "s", "ing", "ed", "ation", "ly"]
+
+
+def synthetic_word(rank):
+    """Get the word of a rank of the synthetic vocabulary, made of syllables
+    and an English suffix so the stemmer has something to do.
+
+    Args:
+        rank (int): rank of the word, 0 for the most frequent
+
+    Returns:
+        str: the word
+    """
+    if rank < len(SYNTHETIC_STOPWORDS):
+        return SYNTHETIC_STOPWORDS[rank]
+    n = rank
+    word = ""
+    while True:
+        word += SYLLABLES[n % len(SYLLABLES)]
+        n //= len(SYLLABLES)
+        if n == 0:
+            break
+    return word + SUFFIXES[rank % len(SUFFIXES)]
+
+
+def generate_corpus(out_dir, num_docs=10000, vocab_size=50000, mean_doc_len=300, zipf_s=1.1,
+                    num_topics=100, docs_per_dir=1000, seed=0):
+    """Write a synthetic collection laid out like gov: gov/documents/NN/G00-NN-XXXXXXX
+    documents whose words follow a Zipfian distribution, and gov/topics/gov.topics.
+    The same arguments always give the same files.
+
+    Args:
+        out_dir (str): directory the gov directory is created in
+        num_docs (int): number of documents
+        vocab_size (int): number of distinct words
+        mean_doc_len (int): mean number of words of a document (lengths are exponential)
+        zipf_s (float): exponent of the Zipf distribution of the words
+        num_topics (int): number of queries of gov.topics, 1 to 5 words each
+        docs_per_dir (int): number of documents of each sub-directory
+        seed (int): seed of the random generator
+
+    Returns:
+        dict: the arguments, and the number of words written
+    """
+    rnd = random.Random(seed)
+    vocab = [synthetic_word(rank) for rank in range(vocab_size)]
+    cum_weights = list(accumulate(1 / (rank + 1)**zipf_s for rank in range(vocab_size)))
+
+    num_words = 0
+    for docid in range(num_docs):
+        dir_name = "{:02d}".format(docid // docs_per_dir)
+        doc_dir = os.path.join(out_dir, "gov", "documents", dir_name)
+        if docid % docs_per_dir == 0:
+            os.makedirs(doc_dir, exist_ok=True)
+        doc_len = max(1, int(rnd.expovariate(1 / mean_doc_len)))
+        words = rnd.choices(vocab, cum_weights=cum_weights, k=doc_len)
+        # a few capitalized words and line breaks
+        text = "\n".join(" ".join(w.capitalize() if rnd.random() < 0.05 else w for w in words[i:i + 12])
+                         for i in range(0, doc_len, 12))
+        with open(os.path.join(doc_dir, "G00-{d}-{n:07d}".format(d=dir_name, n=docid)), "w", encoding="utf-8") as f:
+            f.write(text)
+        num_words += doc_len
+
+    # topics use the words users search for: neither stopwords nor too rare
+    topic_ranks = range(len(SYNTHETIC_STOPWORDS), min(vocab_size, 20 * len(SYNTHETIC_STOPWORDS) + 2000))
+    os.makedirs(os.path.join(out_dir, "gov", "topics"), exist_ok=True)
+    with open(os.path.join(out_dir, "gov", "topics", "gov.topics"), "w") as f:
+        for qid in range(num_topics):
+            words = [vocab[rank] for rank in rnd.sample(topic_ranks, rnd.randint(1, 5))]
+            f.write("{qid} {q}\n".format(qid=qid + 1, q=" ".join(words)))
+
+    return {"num_docs": num_docs, "vocab_size": vocab_size, "mean_doc_len": mean_doc_len, "zipf_s": zipf_s,
+            "num_topics": num_topics, "seed": seed, "num_words": num_words}
+
+
+def latency_stats(latencies):
+    """Summarize latencies in seconds as percentiles in ms."""
+    latencies = sorted(latencies)
+    return {
+        "queries": len(latencies),
+        "mean_ms": 1000 * sum(latencies) / max(1, len(latencies)),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p90_ms": 1000 * percentile(latencies, 90),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "max_ms": 1000 * latencies[-1],
+    }
+
+
+def bench_indexing(corpus_dir, indexer_args=()):
+    """Run indexer.py on a collection in its own process.
+
+    Args:
+        corpus_dir (str): directory containing the gov directory
+        indexer_args (list(str)): extra arguments of indexer.py, e.g. ["--format", "binary"]
+
+    Returns:
+        dict: wall time, peak RSS of the indexer process, throughput and size of the stored files
+    """
+    indexer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexer.py")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, indexer_path] + list(indexer_args), cwd=corpus_dir,
+                            stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this child only
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError("indexer.py failed with exit code {code}".format(code=proc.returncode))
+
+    cwd = os.getcwd()
+    os.chdir(corpus_dir)
+    try:
+        (index, doc_freq, _, num_docs) = open_stored_index()
+        # processed tokens, the ones the index is made of
+        num_tokens = sum(tf for term in index for (_, tf) in index[term])
+        index_path = stored_index_path()
+        index_bytes = os.path.getsize(index_path)
+        norms_bytes = os.path.getsize(NORMS_PATH) if os.path.exists(NORMS_PATH) else 0
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "args": list(indexer_args),
+        "seconds": elapsed,
+        "docs_per_sec": num_docs / elapsed,
+        "tokens_per_sec": num_tokens / elapsed,
+        # KB on Linux
+        "peak_rss_mb": rusage.ru_maxrss / 1024,
+        "num_docs": num_docs,
+        "num_terms": len(doc_freq),
+        "num_tokens": num_tokens,
+        "index_file": os.path.basename(index_path),
+        "index_bytes": index_bytes,
+        "norms_bytes": norms_bytes,
+    }
+
+
+def bench_queries(corpus_dir, k=None):
+    """Run the topics of a collection with the TF, TF-IDF and boolean engines
+    on its stored index. The boolean queries are the processed terms of the
+    topic (stopwords removed, stemmed, like the index terms) joined with AND
+    and with OR.
+
+    Args:
+        corpus_dir (str): directory containing the gov directory and the stored index
+        k (int): number of documents retrieved by the ranked queries (default: all of them)
+
+    Returns:
+        dict: latency percentiles of each engine, and the peak RSS of this process
+            (see bench_queries_process to leave out the memory used before)
+    """
+    cwd = os.getcwd()
+    os.chdir(corpus_dir)
+    try:
+        (index, doc_freq, _, num_docs) = open_stored_index()
+        with open(os.path.join("gov", "topics", "gov.topics")) as f:
+            topics = [line.split(None, 1)[1].strip() for line in f if len(line.split()) > 1]
+        norms = {}
+        for (name, norm_func) in [("tf", query.get_doc_to_norm), ("tfidf", query_tfidf.get_doc_to_norm)]:
+            norms[name] = load_doc_norms(name, stored_index_path())
+            if norms[name] is None:
+                norms[name] = norm_func(index, doc_freq, num_docs)
+    finally:
+        os.chdir(cwd)
+
+    # the stemmer is loaded on first use, not while timing the first query
+    process_tokens(tokenize_text(" ".join(topics[:1])))
+
+    # the boolean queries don't process their terms like the ranked ones: a
+    # stopword or an unstemmed word would be missing from the index
+    def boolean_query(topic, operator):
+        return " {op} ".format(op=operator).join(dict.fromkeys(process_tokens(tokenize_text(topic))))
+
+    engines = [
+        ("tf", lambda q: query.run_query(q, index, doc_freq, norms["tf"], num_docs, k=k)),
+        ("tfidf", lambda q: query_tfidf.run_query(q, index, doc_freq, norms["tfidf"], num_docs, k=k)),
+        ("boolean_and", lambda q: run_boolean_query(q, index, doc_freq, num_docs), lambda q: boolean_query(q, "AND")),
+        ("boolean_or", lambda q: run_boolean_query(q, index, doc_freq, num_docs), lambda q: boolean_query(q, "OR")),
+    ]
+    results = {}
+    for (name, run, *make_query) in engines:
+        queries = [make_query[0](topic) for topic in topics] if make_query else topics
+        latencies = []
+        for query_string in queries:
+            start = time.perf_counter()
+            run(query_string)
+            latencies.append(time.perf_counter() - start)
+        results[name] = latency_stats(latencies)
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def bench_queries_process(corpus_dir, k=None):
+    """Run bench_queries in its own process, so that its peak RSS is only
+    the memory of the queries and not of what ran before in this one, e.g.
+    generating the collection.
+
+    Args:
+        corpus_dir (str): directory containing the gov directory and the stored index
+        k (int): number of documents retrieved by the ranked queries (default: all of them)
+
+    Returns:
+        dict: see bench_queries
+    """
+    args = [sys.executable, os.path.abspath(__file__), "queries", "--corpus-dir", os.path.abspath(corpus_dir)]
+    if k is not None:
+        args += ["--k", str(k)]
+    out = subprocess.run(args, check=True, capture_output=True, text=True).stdout
+    return json.loads(out)["results"]
+
+
+# Run in a fresh interpreter by bench_cold_start: the time to import the query
+# engine, open the stored index and answer the first topic with document paths
+COLD_START_SCRIPT = """
+import os, sys, json, time
+start = time.perf_counter()
+import query_tfidf
+from index_store import DocPaths, open_stored_index, stored_index_path
+from doc_norms import load_doc_norms
+imported = time.perf_counter()
+(index, doc_freq, doc_ids, num_docs) = open_stored_index()
+doc_norms = load_doc_norms("tfidf", stored_index_path())
+if doc_norms is None:
+    doc_norms = query_tfidf.get_doc_to_norm(index, doc_freq, num_docs)
+opened = time.perf_counter()
+with open(os.path.join("gov", "topics", "gov.topics")) as f:
+    topic = f.readline().split(None, 1)[1]
+res = query_tfidf.run_query(topic, index, doc_freq, doc_norms, num_docs, k=10)
+ids_to_doc = DocPaths(doc_ids)
+paths = [ids_to_doc[docid] for (docid, _) in res]
+done = time.perf_counter()
+json.dump({"index_file": stored_index_path(),
+           "seconds": {"import": imported - start, "open": opened - imported, "first_query": done - opened}},
+          sys.stdout)
+"""
+
+
+def bench_cold_start(corpus_dir, modules=("string_processing", "query_tfidf", "query_boolean"), repeat=5):
+    """Measure the start-up of the query scripts, each run in a new interpreter.
+
+    Args:
+        corpus_dir (str): directory containing the gov directory and the stored index
+        modules (list(str)): modules whose import time is measured
+        repeat (int): number of runs, the median is reported
+
+    Returns:
+        dict: median milliseconds of importing each module (interpreter start-up
+            excluded), and of the phases up to the first query's results, with
+            the index file they were measured on (only the binary index is
+            opened lazily, see index_store.open_stored_index)
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+
+    def run_child(code):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], cwd=corpus_dir, env=env,
+                             check=True, capture_output=True, text=True).stdout
+        return (time.perf_counter() - start, out)
+
+    def median_ms(values):
+        return 1000 * sorted(values)[len(values) // 2]
+
+    interpreter = median_ms([run_child("pass")[0] for _ in range(repeat)])
+    results = {"interpreter_ms": interpreter, "import_ms": {}}
+    for module in modules:
+        results["import_ms"][module] = median_ms([run_child("import " + module)[0] for _ in range(repeat)]) - interpreter
+
+    runs = [run_child(COLD_START_SCRIPT) for _ in range(repeat)]
+    phases = [json.loads(out) for (_, out) in runs]
+    results["index_file"] = phases[0]["index_file"]
+    results["first_query_ms"] = {phase: median_ms([p["seconds"][phase] for p in phases]) for phase in phases[0]["seconds"]}
+    results["first_query_ms"]["process"] = median_ms([elapsed for (elapsed, _) in runs])
+    return results
+
+
+def bench_suite(corpus_dir=None, indexer_args=(), k=None, **corpus_args):
+    """Generate a synthetic collection (unless one is given), index it and run
+    its topics.
+
+    Args:
+        corpus_dir (str): directory of an existing collection (default: generate
+            one in a temporary directory)
+        indexer_args (list(str)): extra arguments of indexer.py
+        k (int): number of documents retrieved by the ranked queries
+        corpus_args: arguments of generate_corpus
+
+    Returns:
+        dict: the corpus, indexing and query results
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus = None
+        if corpus_dir is None:
+            corpus_dir = tmp_dir
+            start = time.perf_counter()
+            corpus = generate_corpus(corpus_dir, **corpus_args)
+            corpus["generate_seconds"] = time.perf_counter() - start
+        return {
+            "corpus": corpus,
+            "indexing": bench_indexing(corpus_dir, indexer_args),
+            "queries": bench_queries_process(corpus_dir, k),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Performance benchmarks, results are printed as JSON")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    intersect_parser = subparsers.add_parser("intersect", help="boolean AND on skewed list lengths")
+    intersect_parser.add_argument("--long-len", type=int, default=500000)
+
+    nary_parser = subparsers.add_parser("nary", help="long OR / AND chains, binary vs n-ary merges")
+    nary_parser.add_argument("--list-len", type=int, default=20000)
+
+    load_parser = subparsers.add_parser("boolean-load", help="latency and thread count over many boolean queries")
+    load_parser.add_argument("--queries", type=int, default=100000)
+    load_parser.add_argument("--stored", action="store_true",
+                             help="query the stored index of the working directory (default: synthetic index)")
+
+    def add_corpus_arguments(subparser):
+        subparser.add_argument("--docs", type=int, default=10000, help="number of documents")
+        subparser.add_argument("--vocab", type=int, default=50000, help="number of distinct words")
+        subparser.add_argument("--doc-len", type=int, default=300, help="mean number of words of a document")
+        subparser.add_argument("--zipf", type=float, default=1.1, help="exponent of the Zipf distribution")
+        subparser.add_argument("--topics", type=int, default=100, help="number of queries")
+        subparser.add_argument("--seed", type=int, default=0)
+
+    corpus_parser = subparsers.add_parser("corpus", help="generate a synthetic gov-like collection")
+    corpus_parser.add_argument("dir", help="directory the gov directory is created in")
+    add_corpus_arguments(corpus_parser)
+
+    suite_parser = subparsers.add_parser("suite", help="indexing throughput, peak RSS, index size and query latencies")
+    suite_parser.add_argument("--corpus-dir", default=None,
+                              help="use this collection instead of generating one (in a temporary directory)")
+    suite_parser.add_argument("--k", type=int, default=None,
+                              help="number of documents retrieved by the ranked queries (default: all of them)")
+    suite_parser.add_argument("--indexer-args", default="",
+                              help="extra arguments of indexer.py, e.g. \"--format binary\"")
+    add_corpus_arguments(suite_parser)
+
+    queries_parser = subparsers.add_parser("queries", help="query latencies and peak RSS on a stored index")
+    queries_parser.add_argument("--corpus-dir", default=".",
+                                help="collection with a stored index (default: the working directory)")
+    queries_parser.add_argument("--k", type=int, default=None,
+                                help="number of documents retrieved by the ranked queries (default: all of them)")
+
+    cold_parser = subparsers.add_parser("cold-start", help="import time and time to the first query's results")
+    cold_parser.add_argument("--corpus-dir", default=".",
+                             help="collection with a stored index (default: the working directory)")
+    cold_parser.add_argument("--repeat", type=int, default=5)
+
+    parser.add_argument("--output", default=None, help="write the JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.benchmark == "intersect":
+        results = bench_intersection(args.long_len)
+    elif args.benchmark == "nary":
+        results = bench_nary(list_len=args.list_len)
+    elif args.benchmark == "boolean-load":
+        results = bench_boolean_load(args.queries, stored=args.stored)
+    elif args.benchmark == "queries":
+        results = bench_queries(args.corpus_dir, args.k)
+    elif args.benchmark == "cold-start":
+        results = bench_cold_start(args.corpus_dir, repeat=args.repeat)
+    elif args.benchmark in ["corpus", "suite"]:
+        corpus_args = {"num_docs": args.docs, "vocab_size": args.vocab, "mean_doc_len": args.doc_len,
+                       "zipf_s": args.zipf, "num_topics": args.topics, "seed": args.seed}
+        if args.benchmark == "corpus":
+            results = generate_corpus(args.dir, **corpus_args)
+        else:
+            results = bench_suite(args.corpus_dir, args.indexer_args.split(), args.k, **corpus_args)
+
+    out = open(args.output, "w") if args.output is not None else sys.stdout
+    json.dump({"benchmark": args.benchmark, "python": sys.version.split()[0], "results": results}, out, indent=2)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
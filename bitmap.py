@@ -0,0 +1,205 @@
+import os
+import pickle
+from doc_norms import index_fingerprint
+
+BITMAPS_PATH = "stored_bitmaps.pkl"
+
+# Doc_ids are split like in roaring bitmaps: the high bits select a chunk of
+# 2**CHUNK_BITS doc_ids, and each chunk is a Python int whose bit i is set if
+# the doc_id (chunk << CHUNK_BITS) + i is in the set. Set operations on chunks
+# are single int operations, which run in C over whole machine words.
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+CHUNK_BYTES = CHUNK_SIZE // 8
+
+# Terms in at least this fraction of the documents get a bitmap by default
+DEFAULT_THRESHOLD = 0.05
+
+
+class Bitmap:
+    """Compressed set of doc_ids for set algebra on frequent terms. Only the
+    chunks with at least one doc_id are kept.
+    """
+
+    __slots__ = ["chunks"]
+
+    def __init__(self, chunks=None):
+        """
+        Args:
+            chunks (dict(int : int)): chunk number to bits of the chunk, without empty chunks
+        """
+        self.chunks = chunks if chunks is not None else {}
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids):
+        """Build a bitmap from doc_ids.
+
+        Args:
+            doc_ids (iterable(int)): asc sorted doc_ids
+
+        Returns:
+            Bitmap: the bitmap
+        """
+        chunks = {}
+        high = -1
+        bits = None
+        for docid in doc_ids:
+            if docid >> CHUNK_BITS != high:
+                if bits is not None:
+                    chunks[high] = int.from_bytes(bits, "little")
+                high = docid >> CHUNK_BITS
+                bits = bytearray(CHUNK_BYTES)
+            low = docid & CHUNK_MASK
+            bits[low >> 3] |= 1 << (low & 7)
+        if bits is not None:
+            chunks[high] = int.from_bytes(bits, "little")
+        return cls(chunks)
+
+    @classmethod
+    def from_range(cls, num_docs):
+        """Build the bitmap of all the doc_ids in range(num_docs)."""
+        chunks = {}
+        for high in range(0, (num_docs + CHUNK_MASK) >> CHUNK_BITS):
+            size = min(CHUNK_SIZE, num_docs - (high << CHUNK_BITS))
+            chunks[high] = (1 << size) - 1
+        return cls(chunks)
+
+    def to_list(self):
+        """Get the doc_ids of the bitmap.
+
+        Returns:
+            list(int): asc sorted doc_ids
+        """
+        doc_ids = []
+        for high in sorted(self.chunks):
+            base = high << CHUNK_BITS
+            # bits from the lowest, scanned for the set ones in C
+            bits = bin(self.chunks[high])[:1:-1]
+            pos = bits.find("1")
+            while pos >= 0:
+                doc_ids.append(base + pos)
+                pos = bits.find("1", pos + 1)
+        return doc_ids
+
+    def __contains__(self, docid):
+        return self.chunks.get(docid >> CHUNK_BITS, 0) >> (docid & CHUNK_MASK) & 1 == 1
+
+    def __len__(self):
+        return sum(bits.bit_count() for bits in self.chunks.values())
+
+    def __bool__(self):
+        return len(self.chunks) > 0
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self.chunks == other.chunks
+
+    def __and__(self, other):
+        (small, large) = (self, other) if len(self.chunks) <= len(other.chunks) else (other, self)
+        chunks = {}
+        for (high, bits) in small.chunks.items():
+            bits &= large.chunks.get(high, 0)
+            if bits:
+                chunks[high] = bits
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for (high, bits) in other.chunks.items():
+            chunks[high] = chunks.get(high, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for (high, bits) in self.chunks.items():
+            bits &= ~other.chunks.get(high, 0)
+            if bits:
+                chunks[high] = bits
+        return Bitmap(chunks)
+
+    def filter(self, doc_ids):
+        """Get the doc_ids of a list which are in the bitmap (list AND bitmap).
+
+        Args:
+            doc_ids (list(int)): asc sorted doc_ids
+
+        Returns:
+            list(int): asc sorted doc_ids
+        """
+        chunks = self.chunks
+        return [docid for docid in doc_ids if chunks.get(docid >> CHUNK_BITS, 0) >> (docid & CHUNK_MASK) & 1]
+
+    def exclude(self, doc_ids):
+        """Get the doc_ids of a list which are not in the bitmap (list AND NOT bitmap).
+
+        Args:
+            doc_ids (list(int)): asc sorted doc_ids
+
+        Returns:
+            list(int): asc sorted doc_ids
+        """
+        chunks = self.chunks
+        return [docid for docid in doc_ids if not chunks.get(docid >> CHUNK_BITS, 0) >> (docid & CHUNK_MASK) & 1]
+
+    def size_in_bytes(self):
+        """Get the size of the bits of the chunks."""
+        return sum((bits.bit_length() + 7) // 8 for bits in self.chunks.values())
+
+
+def build_bitmaps(index, doc_freq, num_docs, threshold=DEFAULT_THRESHOLD):
+    """Build the bitmaps of the terms in at least a fraction of the documents.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        doc_freq (dict(str : int)): document frequency for each term
+        num_docs (int): number of documents in the corpus
+        threshold (float): minimum fraction of the documents a term must be in
+
+    Returns:
+        dict(str : Bitmap): bitmaps of the frequent terms
+    """
+    min_df = max(1, int(threshold * num_docs))
+    bitmaps = {}
+    for term in index:
+        if doc_freq[term] >= min_df:
+            if hasattr(index, "doc_ids_of"):
+                bitmaps[term] = Bitmap.from_doc_ids(index.doc_ids_of(term))
+            else:
+                bitmaps[term] = Bitmap.from_doc_ids(docid for (docid, _) in index[term])
+    return bitmaps
+
+
+def save_bitmaps(bitmaps, index_path, bitmaps_path=BITMAPS_PATH):
+    """Store the bitmaps next to the index they were built from.
+
+    Args:
+        bitmaps (dict(str : Bitmap)): output of build_bitmaps
+        index_path (str): path of the stored index
+        bitmaps_path (str): path of the bitmaps file
+    """
+    chunks = {term: bitmap.chunks for (term, bitmap) in bitmaps.items()}
+    with open(bitmaps_path, "wb") as f:
+        pickle.dump((index_fingerprint(index_path), chunks), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_bitmaps(index_path, bitmaps_path=BITMAPS_PATH):
+    """Load stored bitmaps.
+
+    Args:
+        index_path (str): path of the stored index the bitmaps are used with
+        bitmaps_path (str): path of the bitmaps file
+
+    Returns:
+        dict(str : Bitmap): bitmaps of the frequent terms, or None if there are
+            no stored bitmaps or they were built for another version of the index
+    """
+    if not os.path.exists(bitmaps_path):
+        return None
+    with open(bitmaps_path, "rb") as f:
+        (fingerprint, chunks) = pickle.load(f)
+    if fingerprint != index_fingerprint(index_path):
+        return None
+    return {term: Bitmap(term_chunks) for (term, term_chunks) in chunks.items()}
@@ -0,0 +1,132 @@
+import os
+import math
+import pickle
+from array import array
+from index_store import SEGMENTS_MANIFEST_PATH
+
+NORMS_PATH = "stored_norms.pkl"
+
+# Norm variants stored with the index, see get_doc_to_norm in query.py (tf)
+# and query_tfidf.py (tfidf). The per-term score upper bounds used by
+# query_tfidf.run_query_maxscore are stored along as "tfidf_bounds".
+NORM_VARIANTS = ["tf", "tfidf"]
+
+
+def index_fingerprint(index_path):
+    """Identify a version of the stored index, so norms computed for another
+    version can be detected.
+
+    Args:
+        index_path (str): path of the stored index
+
+    Returns:
+        tuple(int, int): size and modification time (ns) of the index file
+    """
+    st = os.stat(index_path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def compute_doc_norms(index, doc_freq, num_docs, idf_func):
+    """Compute the norms of every document vector for all the variants in one
+    pass over the index. The values are the same as the ones computed by the
+    get_doc_to_norm functions.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        doc_freq (dict(str : int)): document frequency for each term
+        num_docs (int): number of documents in the corpus
+        idf_func (callable): idf of a term from (df, num_docs), e.g., query_tfidf.calc_idf
+
+    Returns:
+        dict(str : array(float)): dense arrays of document norms indexed by
+            doc_id, one for each variant in NORM_VARIANTS
+    """
+    tf_norms = array("d", bytes(8 * num_docs))
+    tfidf_norms = array("d", bytes(8 * num_docs))
+
+    # calculate square of norm for all docs
+    for term in index:
+        idf = idf_func(doc_freq[term], num_docs)
+        for (docid, tf) in index[term]:
+            tf_norms[docid] += tf**2
+            tfidf_norms[docid] += (tf*idf)**2
+
+    # take square root
+    for docid in range(num_docs):
+        tf_norms[docid] = math.sqrt(tf_norms[docid])
+        tfidf_norms[docid] = math.sqrt(tfidf_norms[docid])
+
+    return {"tf": tf_norms, "tfidf": tfidf_norms}
+
+
+def compute_term_upper_bounds(index, tfidf_norms):
+    """Compute, for every term, the largest tf / norm over its postings. Times
+    idf**2 * tf_query / query_norm, this bounds the cosine TF-IDF score a
+    single term can add to a document (see query_tfidf.run_query_maxscore).
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        tfidf_norms (array(float)): TF-IDF document norms indexed by doc_id
+
+    Returns:
+        dict(str : float): upper bound of tf / norm for each term
+    """
+    bounds = {}
+    for term in index:
+        bounds[term] = max((tf / tfidf_norms[docid] for (docid, tf) in index[term] if tfidf_norms[docid] > 0),
+                           default=0.0)
+    return bounds
+
+
+def stored_norms_path(index_path):
+    """Get the path of the norms stored with an index: NORMS_PATH for the
+    index of indexer.py, and the same file name next to the manifest for the
+    segmented index of segments.py, so that neither overwrites the other."""
+    if os.path.basename(index_path) == os.path.basename(SEGMENTS_MANIFEST_PATH):
+        return os.path.join(os.path.dirname(index_path), NORMS_PATH)
+    return NORMS_PATH
+
+
+def save_doc_norms(norms, index_path, norms_path=None, fingerprint=None):
+    """Store the document norms next to the index they were computed from.
+
+    Args:
+        norms (dict(str : array(float))): output of compute_doc_norms
+        index_path (str): path of the stored index
+        norms_path (str): path of the norms file (default: stored_norms_path(index_path))
+        fingerprint (tuple(int, int)): index_fingerprint of the version of the
+            index the norms were computed from (default: the current version)
+    """
+    if norms_path is None:
+        norms_path = stored_norms_path(index_path)
+    if fingerprint is None:
+        fingerprint = index_fingerprint(index_path)
+    # readers of another process never see a partly written file
+    tmp_path = "{path}.{pid}.tmp".format(path=norms_path, pid=os.getpid())
+    with open(tmp_path, "wb") as f:
+        pickle.dump((fingerprint, norms), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, norms_path)
+
+
+def load_doc_norms(variant, index_path, norms_path=None):
+    """Load stored document norms.
+
+    Args:
+        variant (str): one of NORM_VARIANTS
+        index_path (str): path of the stored index the norms are used with
+        norms_path (str): path of the norms file (default: stored_norms_path(index_path))
+
+    Returns:
+        array(float): document norms indexed by doc_id (dict(str : float) of
+            the term upper bounds for "tfidf_bounds"), or None if there are
+            no stored norms or they were computed for another version of the index
+    """
+    if norms_path is None:
+        norms_path = stored_norms_path(index_path)
+    if not os.path.exists(norms_path):
+        return None
+    with open(norms_path, "rb") as f:
+        (fingerprint, norms) = pickle.load(f)
+    if fingerprint != index_fingerprint(index_path) or variant not in norms:
+        return None
+    return norms[variant]
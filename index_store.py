@@ -0,0 +1,363 @@
+import os
+import sys
+import mmap
+import pickle
+import struct
+from array import array
+from collections.abc import Mapping
+
+INDEX_PKL_PATH = "stored_index.pkl"
+INDEX_BIN_PATH = "stored_index.bin"
+# Manifest of the segmented index maintained by segments.py
+SEGMENTS_MANIFEST_PATH = os.path.join("segments", "manifest.pkl")
+
+# Layout of stored_index.bin (all integers little-endian, sections 8-byte aligned):
+#   header        : magic, num_terms, num_docs and the offset of every section below
+#   postings      : for each term, uint32 doc_ids[df] followed by uint32 tfs[df]
+#   term blob     : utf-8 terms in asc order, concatenated
+#   term offsets  : uint64[num_terms + 1], start of each term in the term blob
+#   post offsets  : uint64[num_terms], start of each term's postings
+#   doc freqs     : uint32[num_terms]
+#   path blob     : utf-8 document paths in doc_id order, concatenated
+#   path offsets  : uint64[num_docs + 1], start of each path in the path blob
+MAGIC = b"GOVIDX01"
+HEADER = struct.Struct("<8sII8Q")
+
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % 8))
+    return f.tell()
+
+
+def _write_array(f, typecode, values):
+    offset = _pad(f)
+    array(typecode, values).tofile(f)
+    return offset
+
+
+def write_index(index_path, postings, doc_ids, num_docs):
+    """Write an index in the binary format. Postings are written as they are
+    consumed, so only the term dictionary is kept in memory.
+
+    Args:
+        index_path (str): path of the binary index file
+        postings (iterable(tuple(str, list(tuple(int, int))))): (token, postings)
+            in asc token order, e.g., sorted index.items() or indexer.merge_blocks(...)
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id in [0, num_docs)
+        num_docs (int): number of documents in the corpus
+    """
+    if sys.byteorder != "little":
+        raise RuntimeError("The binary index format requires a little-endian platform")
+
+    terms = []
+    post_offsets = []
+    dfs = []
+
+    with open(index_path, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+
+        _pad(f)
+        for (term, term_postings) in postings:
+            if len(terms) > 0 and term <= terms[-1]:
+                raise ValueError("Terms must be written in asc order: {prev} {cur}".format(prev=terms[-1], cur=term))
+            terms.append(term)
+            post_offsets.append(f.tell())
+            dfs.append(len(term_postings))
+            array("I", [docid for (docid, tf) in term_postings]).tofile(f)
+            array("I", [tf for (docid, tf) in term_postings]).tofile(f)
+
+        term_bytes = [term.encode("utf-8") for term in terms]
+        term_blob_offset = _pad(f)
+        f.write(b"".join(term_bytes))
+        term_offsets = [0]
+        for b in term_bytes:
+            term_offsets.append(term_offsets[-1] + len(b))
+        term_offsets_offset = _write_array(f, "Q", term_offsets)
+        post_offsets_offset = _write_array(f, "Q", post_offsets)
+        dfs_offset = _write_array(f, "I", dfs)
+
+        paths = [None] * num_docs
+        for (path, docid) in doc_ids.items():
+            paths[docid] = path
+        path_bytes = [path.encode("utf-8") for path in paths]
+        path_blob_offset = _pad(f)
+        f.write(b"".join(path_bytes))
+        path_offsets = [0]
+        for b in path_bytes:
+            path_offsets.append(path_offsets[-1] + len(b))
+        path_offsets_offset = _write_array(f, "Q", path_offsets)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(terms), num_docs,
+                            term_blob_offset, term_offsets_offset, post_offsets_offset, dfs_offset,
+                            path_blob_offset, path_offsets_offset, 0, 0))
+
+
+class MmapIndex(Mapping):
+    """Read-only view of a binary index file. The file is memory-mapped, so
+    opening it is cheap, only the posting lists a query touches are read, and
+    processes reading the same file share the page cache.
+
+    Behaves like the dict(str : list(tuple(int, int))) built by the indexer.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mm)
+
+        (magic, self.num_terms, self.num_docs,
+         term_blob, term_offsets, post_offsets, dfs,
+         path_blob, path_offsets, _, _) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("{path} is not a binary index file".format(path=index_path))
+
+        n = self.num_terms
+        self._terms = buf[term_blob:term_offsets]
+        self._term_offsets = buf[term_offsets:term_offsets + 8 * (n + 1)].cast("Q")
+        self._post_offsets = buf[post_offsets:post_offsets + 8 * n].cast("Q")
+        self._dfs = buf[dfs:dfs + 4 * n].cast("I")
+        self._buf = buf
+        self._paths = buf[path_blob:path_offsets]
+        self._path_offsets = buf[path_offsets:path_offsets + 8 * (self.num_docs + 1)].cast("Q")
+
+    def _term_at(self, pos):
+        return bytes(self._terms[self._term_offsets[pos]:self._term_offsets[pos + 1]])
+
+    def find(self, term):
+        """Binary search the term dictionary.
+
+        Args:
+            term (str): the term
+
+        Returns:
+            int: position of the term in the dictionary, -1 if not found
+        """
+        key = term.encode("utf-8")
+        lo = 0
+        hi = self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self._term_at(lo) == key:
+            return lo
+        return -1
+
+    def term_at(self, pos):
+        """Get the term at a position of the dictionary."""
+        return self._term_at(pos).decode("utf-8")
+
+    def doc_freq_at(self, pos):
+        """Get the document frequency of the term at a position of the dictionary."""
+        return self._dfs[pos]
+
+    def arrays_at(self, pos):
+        """Get the postings of the term at a position of the dictionary as two
+        zero-copy uint32 arrays.
+
+        Returns:
+            tuple(memoryview, memoryview): (doc_ids, term_frequencies)
+        """
+        start = self._post_offsets[pos]
+        size = 4 * self._dfs[pos]
+        return (self._buf[start:start + size].cast("I"),
+                self._buf[start + size:start + 2 * size].cast("I"))
+
+    def doc_ids_of(self, term):
+        """Get the asc sorted doc_ids of a term without building the tuples.
+
+        Args:
+            term (str): the term
+
+        Returns:
+            list(int): doc_ids containing the term (empty if term is not indexed)
+        """
+        pos = self.find(term)
+        if pos < 0:
+            return []
+        return self.arrays_at(pos)[0].tolist()
+
+    def path_at(self, docid):
+        """Get the path of a document from its doc_id."""
+        return bytes(self._paths[self._path_offsets[docid]:self._path_offsets[docid + 1]]).decode("utf-8")
+
+    def __getitem__(self, term):
+        pos = self.find(term)
+        if pos < 0:
+            raise KeyError(term)
+        (docids, tfs) = self.arrays_at(pos)
+        return list(zip(docids.tolist(), tfs.tolist()))
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __iter__(self):
+        for pos in range(self.num_terms):
+            yield self.term_at(pos)
+
+    def __len__(self):
+        return self.num_terms
+
+    def close(self):
+        """Release the memory map. Views handed out before must not be used afterwards."""
+        for view in (self._terms, self._term_offsets, self._post_offsets, self._dfs,
+                     self._paths, self._path_offsets, self._buf):
+            view.release()
+        self._mm.close()
+
+
+class MmapDocFreq(Mapping):
+    """dict(str : int) view of the document frequencies of an MmapIndex."""
+
+    def __init__(self, mmap_index):
+        self._index = mmap_index
+
+    def __getitem__(self, term):
+        pos = self._index.find(term)
+        if pos < 0:
+            raise KeyError(term)
+        return self._index.doc_freq_at(pos)
+
+    def __contains__(self, term):
+        return self._index.find(term) >= 0
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+class MmapDocIds(Mapping):
+    """dict(str : int) view of the path to doc_id mapping of an MmapIndex.
+    Iteration goes through the doc_ids in order without building a dict, the
+    reverse dict is only built on the first lookup by path.
+    """
+
+    def __init__(self, mmap_index):
+        self._index = mmap_index
+        self._path_to_id = None
+
+    def __getitem__(self, path):
+        if self._path_to_id is None:
+            self._path_to_id = {p: docid for (p, docid) in self.items()}
+        return self._path_to_id[path]
+
+    def __iter__(self):
+        for docid in range(self._index.num_docs):
+            yield self._index.path_at(docid)
+
+    def __len__(self):
+        return self._index.num_docs
+
+    def items(self):
+        return ((self._index.path_at(docid), docid) for docid in range(self._index.num_docs))
+
+
+class DocPaths:
+    """Compact doc_id to path lookup, replacing a dict(int : str) of every path.
+    The paths of the binary index are read from the file; otherwise they are
+    packed into one UTF-8 blob and an array of offsets, on the first lookup,
+    so that starting a query script does not walk through every document.
+    """
+
+    def __init__(self, doc_ids):
+        """
+        Args:
+            doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+        """
+        self._doc_ids = doc_ids
+        self._index = doc_ids._index if isinstance(doc_ids, MmapDocIds) else None
+        self._paths = None
+        self._offsets = None
+
+    def build(self):
+        """Pack the paths now, e.g. before forking workers that all look them up."""
+        if self._index is not None or self._paths is not None:
+            return
+        paths = [b""] * len(self._doc_ids)
+        for (path, docid) in self._doc_ids.items():
+            paths[docid] = path.encode("utf-8")
+        self._offsets = array("Q", [0])
+        for path in paths:
+            self._offsets.append(self._offsets[-1] + len(path))
+        self._paths = b"".join(paths)
+        self._doc_ids = None
+
+    def __getitem__(self, docid):
+        if self._index is not None:
+            return self._index.path_at(docid)
+        if self._paths is None:
+            self.build()
+        return self._paths[self._offsets[docid]:self._offsets[docid + 1]].decode("utf-8")
+
+    def __len__(self):
+        if self._paths is not None:
+            return len(self._offsets) - 1
+        return len(self._doc_ids) if self._index is None else self._index.num_docs
+
+
+def load_index(index_path):
+    """Open a binary index file.
+
+    Args:
+        index_path (str): path of the binary index file
+
+    Returns:
+        tuple: (index, doc_freq, doc_ids, num_docs) like the pickled index,
+            except that index, doc_freq and doc_ids are read-only views on the file
+    """
+    index = MmapIndex(index_path)
+    return (index, MmapDocFreq(index), MmapDocIds(index), index.num_docs)
+
+
+def built_index_path():
+    """Get the path of the index written by indexer.py, the most recently
+    written of its binary and pickled formats, so that rebuilding the index in
+    one format is not shadowed by an older index in the other."""
+    paths = [path for path in (INDEX_BIN_PATH, INDEX_PKL_PATH) if os.path.exists(path)]
+    if len(paths) == 0:
+        return INDEX_PKL_PATH
+    return max(paths, key=lambda path: os.stat(path).st_mtime_ns)
+
+
+def stored_index_path():
+    """Get the path of the stored index: the segmented index maintained by
+    segments.py if it was changed after indexer.py last wrote the index,
+    otherwise the index of indexer.py (see built_index_path)."""
+    index_path = built_index_path()
+    if os.path.exists(SEGMENTS_MANIFEST_PATH) and \
+            (not os.path.exists(index_path) or
+             os.stat(SEGMENTS_MANIFEST_PATH).st_mtime_ns > os.stat(index_path).st_mtime_ns):
+        return SEGMENTS_MANIFEST_PATH
+    return index_path
+
+
+def open_stored_index(index_path=None):
+    """Load the stored index, see stored_index_path. Only the binary index is
+    opened lazily, its terms and postings are read from the memory map as the
+    queries need them. A pickle can only be loaded whole, so the pickled index
+    and each segment of the segmented index are read in full before the first
+    query: use indexer.py --format binary for a fast start.
+
+    Args:
+        index_path (str): path of the index or of the segments manifest
+            (default: stored_index_path())
+
+    Returns:
+        tuple: (index, doc_freq, doc_ids, num_docs)
+    """
+    if index_path is None:
+        index_path = stored_index_path()
+    if index_path == SEGMENTS_MANIFEST_PATH:
+        # segments.py builds on the indexer, which uses this module
+        from segments import open_segments
+        return open_segments()
+    if index_path == INDEX_BIN_PATH:
+        return load_index(INDEX_BIN_PATH)
+    with open(index_path, "rb") as f:
+        return pickle.load(f)
@@ -1,10 +1,54 @@
 import os
+import heapq
 import pickle
+import argparse
+import tempfile
+from collections import Counter
 from itertools import groupby
+from multiprocessing import Pool
 from string_processing import (
     process_tokens,
     tokenize_text,
+    analyze_file,
 )
+from index_store import (
+    INDEX_BIN_PATH,
+    INDEX_PKL_PATH,
+    load_index,
+    write_index,
+)
+from doc_norms import (
+    compute_doc_norms,
+    compute_term_upper_bounds,
+    save_doc_norms,
+)
+from query_tfidf import calc_idf
+from postings_codec import (
+    CODECS,
+    CompressedIndex,
+)
+from bitmap import (
+    DEFAULT_THRESHOLD,
+    build_bitmaps,
+    save_bitmaps,
+)
+from lexicon import (
+    Lexicon,
+    save_lexicon,
+)
+from positions import (
+    build_positional_index,
+    save_positions,
+)
+import instrument
+
+# Rough in-memory cost of the postings dictionary used by the SPIMI indexer:
+# a (doc_id, tf) tuple with its list slot, and a token key with its list
+POSTING_BYTES = 80
+TERM_BYTES = 160
+
+# Number of characters of a document read, tokenized and normalized at a time
+DOC_CHUNK_SIZE = 2**20
 
 def read_doc(file_path):
     """Read a document from a path, tokenize, process it and return
@@ -22,6 +66,27 @@ def read_doc(file_path):
     return process_tokens(toks)
 
 
+def count_doc_terms(file_path, chunk_size=DOC_CHUNK_SIZE):
+    """Count the processed tokens of a document. The file is read, tokenized
+    and normalized a chunk at a time, so only the term counts of the whole
+    document are held in memory. Same counts as Counter(read_doc(file_path)).
+
+    Args:
+        file_path (str): path to document file
+        chunk_size (int): number of characters read at a time
+
+    Returns:
+        Counter(str : int): term frequency of each processed token
+    """
+    counts = Counter()
+    for toks in analyze_file(file_path, chunk_size=chunk_size):
+        instrument.count("tokens", len(toks))
+        with instrument.stage("count"):
+            counts.update(toks)
+    instrument.count("documents")
+    return counts
+
+
 def gov_list_docs(docs_path):
     """List the documents in the gov directory.
 
@@ -62,7 +127,8 @@ def get_token_list(path_list, doc_ids):
         docid = doc_ids[path]
         toks = read_doc(path)
         all_toks.extend([(tok, docid) for tok in toks])
-    return sorted(all_toks)
+    with instrument.stage("sort"):
+        return sorted(all_toks)
 
 
 def index_from_tokens(all_toks):
@@ -80,10 +146,230 @@ def index_from_tokens(all_toks):
 
     # First grouping the list of (tok, docid) by tok (i.e., one group for each unique token)
     # then grouping each group (for a particular tok) by docid (i.e., one subgroup for each unique docid)
-    index = {
-        tok: [(docid, len(list(sg))) for (docid, sg) in groupby(g, key=lambda y: y[1])] \
-             for (tok, g) in groupby(all_toks, key=lambda x: x[0])
-    }
+    with instrument.stage("group"):
+        index = {
+            tok: [(docid, len(list(sg))) for (docid, sg) in groupby(g, key=lambda y: y[1])] \
+                 for (tok, g) in groupby(all_toks, key=lambda x: x[0])
+        }
+
+    doc_freq = {tok: len(index[tok]) for tok in index}
+
+    return index, doc_freq
+
+
+def index_doc_slice(doc_slice):
+    """Build a partial index for a slice of documents. This is the work done
+    by each process of the parallel build.
+
+    Args:
+        doc_slice (list(tuple(str, int))): (path, doc_id) pairs, asc sorted by doc_id
+
+    Returns:
+        dict(str : list(tuple(int, int))): a dictionary that maps tokens to
+            list of (doc_id, term_frequency) tuples for the documents in the slice.
+    """
+    partial_index = {}
+    for (path, docid) in doc_slice:
+        counts = count_doc_terms(path)
+        with instrument.stage("group"):
+            for (tok, tf) in counts.items():
+                partial_index.setdefault(tok, []).append((docid, tf))
+    return partial_index
+
+
+def merge_partial_indexes(partial_indexes):
+    """Merge partial indexes built over consecutive slices of doc_ids.
+
+    Args:
+        partial_indexes (list(dict(str : list(tuple(int, int))))): partial indexes,
+            ordered so that every doc_id in one is smaller than those in the next
+
+    Returns:
+        dict(str : list(tuple(int, int))): a dictionary that maps tokens to
+            list of (doc_id, term_frequency) tuples.
+        dict(str : int): a dictionary that maps tokens to document frequency.
+    """
+    merged = {}
+    for partial_index in partial_indexes:
+        for (tok, postings) in partial_index.items():
+            if tok in merged:
+                merged[tok].extend(postings)
+            else:
+                merged[tok] = postings
+
+    # Keep the same (sorted) token order as index_from_tokens
+    with instrument.stage("sort"):
+        index = {tok: merged[tok] for tok in sorted(merged)}
+    doc_freq = {tok: len(index[tok]) for tok in index}
+
+    return index, doc_freq
+
+
+def build_index_streaming(path_list, doc_ids):
+    """Build the index one document at a time, the term counts of each
+    document going straight into the postings. The result is identical to
+    index_from_tokens(get_token_list(...)), without the list of all the tokens.
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+
+    Returns:
+        dict(str : list(tuple(int, int))): a dictionary that maps tokens to
+            list of (doc_id, term_frequency) tuples.
+        dict(str : int): a dictionary that maps tokens to document frequency.
+    """
+    docs = sorted(((path, doc_ids[path]) for path in path_list), key=lambda x: x[1])
+    return merge_partial_indexes([index_doc_slice(docs)])
+
+
+def build_index_parallel(path_list, doc_ids, num_workers=None, slices_per_worker=4):
+    """Read, tokenize and index the documents using a pool of processes.
+    Each process indexes a slice of consecutive doc_ids, then the partial indexes
+    are merged. The result is identical to index_from_tokens(get_token_list(...)).
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+        num_workers (int): number of processes (default: number of CPUs)
+        slices_per_worker (int): number of slices per process, more slices
+            balance the load better when document sizes vary
+
+    Returns:
+        dict(str : list(tuple(int, int))): a dictionary that maps tokens to
+            list of (doc_id, term_frequency) tuples.
+        dict(str : int): a dictionary that maps tokens to document frequency.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 4
+
+    docs = sorted(((path, doc_ids[path]) for path in path_list), key=lambda x: x[1])
+    num_slices = max(1, min(len(docs), num_workers * slices_per_worker))
+    slice_len = -(-len(docs) // num_slices)
+    doc_slices = [docs[i:i + slice_len] for i in range(0, len(docs), slice_len)]
+
+    if num_workers <= 1:
+        return merge_partial_indexes(map(index_doc_slice, doc_slices))
+
+    with Pool(num_workers) as pool:
+        # imap keeps the slices in doc_id order
+        return merge_partial_indexes(pool.imap(index_doc_slice, doc_slices))
+
+
+def write_block(block, block_path):
+    """Write a block of in-memory postings to disk as a run sorted by token.
+
+    Args:
+        block (dict(str : list(tuple(int, int)))): postings of the block
+        block_path (str): path of the block file
+    """
+    with open(block_path, "wb") as f:
+        for tok in sorted(block):
+            pickle.dump((tok, block[tok]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_block(block_path):
+    """Read a block written by write_block, one token at a time.
+
+    Args:
+        block_path (str): path of the block file
+
+    Yields:
+        tuple(str, list(tuple(int, int))): (token, postings) in asc token order
+    """
+    with open(block_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def spimi_invert(path_list, doc_ids, block_dir, memory_budget):
+    """Single-pass in-memory indexing. Postings are accumulated in memory until
+    their estimated size reaches the memory budget, then spilled to disk as a
+    sorted block.
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+        block_dir (str): directory the blocks are written to
+        memory_budget (int): maximum estimated size of a block, in bytes
+
+    Returns:
+        list(str): paths of the blocks, in doc_id order
+    """
+    block_paths = []
+    block = {}
+    block_size = 0
+
+    def flush():
+        block_path = os.path.join(block_dir, "block_{:06d}.pkl".format(len(block_paths)))
+        with instrument.stage("serialize"):
+            write_block(block, block_path)
+        block_paths.append(block_path)
+
+    # postings have to be appended in doc_id order for the merge to stay sorted
+    for path in sorted(path_list, key=lambda x: doc_ids[x]):
+        docid = doc_ids[path]
+        for (tok, tf) in count_doc_terms(path).items():
+            if tok in block:
+                block[tok].append((docid, tf))
+            else:
+                block[tok] = [(docid, tf)]
+                block_size += TERM_BYTES
+            block_size += POSTING_BYTES
+
+        if block_size >= memory_budget:
+            flush()
+            block = {}
+            block_size = 0
+
+    if len(block) > 0 or len(block_paths) == 0:
+        flush()
+
+    return block_paths
+
+
+def merge_blocks(block_paths):
+    """K-way merge of sorted blocks. Only one record per block is held in
+    memory at a time.
+
+    Args:
+        block_paths (list(str)): paths of the blocks, in doc_id order
+
+    Yields:
+        tuple(str, list(tuple(int, int))): (token, postings) in asc token order
+    """
+    # heapq.merge is stable, so postings of the same token come out in block order
+    runs = heapq.merge(*[read_block(path) for path in block_paths], key=lambda x: x[0])
+    for (tok, g) in groupby(runs, key=lambda x: x[0]):
+        postings = []
+        for (_, block_postings) in g:
+            postings.extend(block_postings)
+        yield tok, postings
+
+
+def build_index_spimi(path_list, doc_ids, memory_budget=256 * 2**20, block_dir=None):
+    """Build the index with the SPIMI indexer. The result is identical to
+    index_from_tokens(get_token_list(...)). The merged index is returned in
+    memory: to keep memory use flat, stream merge_blocks into
+    index_store.write_index instead, like indexer.py --memory-budget does.
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+        memory_budget (int): maximum estimated size of a block, in bytes
+        block_dir (str): directory for the blocks (default: a temporary directory)
+
+    Returns:
+        dict(str : list(tuple(int, int))): a dictionary that maps tokens to
+            list of (doc_id, term_frequency) tuples.
+        dict(str : int): a dictionary that maps tokens to document frequency.
+    """
+    with tempfile.TemporaryDirectory(dir=block_dir) as tmp_dir:
+        block_paths = spimi_invert(path_list, doc_ids, tmp_dir, memory_budget)
+        index = dict(merge_blocks(block_paths))
 
     doc_freq = {tok: len(index[tok]) for tok in index}
 
@@ -91,8 +377,38 @@ def index_from_tokens(all_toks):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the index of the gov collection")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes used to build the index (0: number of CPUs)")
+    parser.add_argument("--memory-budget", type=int, default=0,
+                        help="build with the SPIMI indexer, spilling blocks of at most this many MB, "
+                             "and stream the merged blocks into the binary index")
+    parser.add_argument("--format", choices=["pickle", "binary"], default=None,
+                        help="store the index as {pkl} or as the memory-mapped {bin} (default: binary with "
+                             "--memory-budget, else pickle)".format(pkl=INDEX_PKL_PATH, bin=INDEX_BIN_PATH))
+    parser.add_argument("--codec", choices=CODECS, default=None,
+                        help="keep the posting lists of the pickled index compressed with this codec")
+    parser.add_argument("--bitmap-threshold", type=float, default=0,
+                        help="store bitmaps for boolean queries of the terms in at least this fraction "
+                             "of the documents, e.g. {t} (default: no bitmaps)".format(t=DEFAULT_THRESHOLD))
+    parser.add_argument("--lexicon", action="store_true",
+                        help="store the front-coded lexicon of the terms, for wildcard queries")
+    parser.add_argument("--positions", action="store_true",
+                        help="store the positions of the terms, for phrase queries")
+    parser.add_argument("--profile", default=None,
+                        help="time and count each stage and write the report to this file (.prom: Prometheus text, else JSON)")
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = "binary" if args.memory_budget > 0 else "pickle"
+    if args.memory_budget > 0 and args.format != "binary":
+        # the pickle of the index can only be written from the whole index in memory
+        parser.error("--memory-budget needs --format binary, a pickled index is built in memory")
+    if args.profile is not None:
+        instrument.enable()
+
     # get a list of documents 
-    doc_list = gov_list_docs("./gov/documents")
+    with instrument.stage("list_files"):
+        doc_list = gov_list_docs("./gov/documents")
     num_docs = len(doc_list)
     # In Windows, the path is displayed as beow by default:
     # ./gov/documents/70\G00-70-0584855
@@ -102,22 +418,82 @@ if __name__ == '__main__':
 
     # assign unique doc_ids to each of the documents
     print("Assigning ID to documents ...")
-    doc_ids = make_doc_ids(doc_list)
+    with instrument.stage("assign_ids"):
+        doc_ids = make_doc_ids(doc_list)
     print("Done!\n")
 
-    # get the list of tokens in all the documents
-    print("Retrieving token list ...")
-    tok_list = get_token_list(doc_list, doc_ids)
-    print("Done!\n")
+    if args.memory_budget > 0:
+        # stream the merged blocks straight into the binary index
+        print("Indexing with SPIMI ...")
+        with tempfile.TemporaryDirectory() as block_dir:
+            with instrument.stage("index"):
+                block_paths = spimi_invert(doc_list, doc_ids, block_dir, args.memory_budget * 2**20)
+            print("Done!\n")
 
-    # build the index from the list of tokens
-    print("Indexing ...")
-    index, doc_freq = index_from_tokens(tok_list)
-    del tok_list # free some memory
-    print("Done!\n")
+            print("Merging and saving results ...")
+            with instrument.stage("serialize"):
+                write_index(INDEX_BIN_PATH, merge_blocks(block_paths), doc_ids, num_docs)
+            print("Done\n")
+
+        print("Computing document norms ...")
+        (index, doc_freq, _, _) = load_index(INDEX_BIN_PATH)
+        with instrument.stage("norms"):
+            norms = compute_doc_norms(index, doc_freq, num_docs, calc_idf)
+            norms["tfidf_bounds"] = compute_term_upper_bounds(index, norms["tfidf"])
+        with instrument.stage("serialize"):
+            save_doc_norms(norms, INDEX_BIN_PATH)
+        print("Done\n")
+    else:
+        # the stages run by worker processes are only counted in "index"
+        with instrument.stage("index"):
+            if args.workers == 1:
+                print("Indexing ...")
+                index, doc_freq = build_index_streaming(doc_list, doc_ids)
+                print("Done!\n")
+            else:
+                num_workers = args.workers if args.workers > 1 else None
+                print("Indexing in parallel ...")
+                index, doc_freq = build_index_parallel(doc_list, doc_ids, num_workers)
+                print("Done!\n")
+
+        print("Saving results ...")
+        # store the index to disk
+        with instrument.stage("norms"):
+            norms = compute_doc_norms(index, doc_freq, num_docs, calc_idf)
+            norms["tfidf_bounds"] = compute_term_upper_bounds(index, norms["tfidf"])
+        with instrument.stage("serialize"):
+            if args.format == "binary":
+                write_index(INDEX_BIN_PATH, index.items(), doc_ids, num_docs)
+                save_doc_norms(norms, INDEX_BIN_PATH)
+            else:
+                if args.codec is not None:
+                    index = CompressedIndex(index, args.codec)
+                with open(INDEX_PKL_PATH, "wb") as f:
+                    pickle.dump((index, doc_freq, doc_ids, num_docs), f)
+                save_doc_norms(norms, INDEX_PKL_PATH)
+        print("Done\n")
+
+    if args.bitmap_threshold > 0:
+        print("Building bitmaps of the frequent terms ...")
+        index_path = INDEX_BIN_PATH if args.format == "binary" else INDEX_PKL_PATH
+        with instrument.stage("bitmaps"):
+            bitmaps = build_bitmaps(index, doc_freq, num_docs, args.bitmap_threshold)
+            save_bitmaps(bitmaps, index_path)
+        print(f"{len(bitmaps)} terms\n")
+
+    if args.lexicon:
+        print("Building the lexicon ...")
+        with instrument.stage("lexicon"):
+            lexicon = Lexicon(doc_freq)
+            save_lexicon(lexicon, INDEX_BIN_PATH if args.format == "binary" else INDEX_PKL_PATH)
+        print(f"{len(lexicon)} terms, {lexicon.size_in_bytes()} bytes\n")
+
+    if args.positions:
+        print("Indexing positions ...")
+        with instrument.stage("positions"):
+            positional_index = build_positional_index(doc_list, doc_ids)
+            save_positions(positional_index, INDEX_BIN_PATH if args.format == "binary" else INDEX_PKL_PATH)
+        print(f"{positional_index.size_in_bytes()} bytes\n")
 
-    print("Saving results ...")
-    # store the index to disk
-    pickle.dump((index, doc_freq, doc_ids, num_docs), open("stored_index.pkl", "wb"))
-    print("Done\n")
-    
\ No newline at end of file
+    if args.profile is not None:
+        instrument.write_report(args.profile)
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+
+# Set IR_PROFILE to a file path to profile any entry point (indexer.py,
+# query.py, ...) and write the report there when it exits, see write_report
+PROFILE_ENV = "IR_PROFILE"
+
+# Upper bounds in seconds of the latency histogram buckets (Prometheus style)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Checked by the instrumented code before doing any work, so that the
+# instrumentation costs a global lookup and a branch when disabled
+enabled = False
+
+stage_seconds = {}
+stage_calls = {}
+counters = {}
+histograms = {}
+lock = threading.Lock()
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, with their sum and count."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            buckets (tuple(float)): asc sorted upper bounds of the buckets,
+                larger values go in an extra +Inf bucket
+        """
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Get the number of values at most each bound, the last one being +Inf.
+
+        Returns:
+            list(tuple(float, int)): (upper bound, cumulative count) pairs
+        """
+        res = []
+        total = 0
+        for (bound, n) in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            total += n
+            res.append((bound, total))
+        return res
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            q (float): between 0 and 1
+
+        Returns:
+            float: the estimate, None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+        for (bound, total) in self.cumulative_counts():
+            if total >= q * self.count:
+                return bound
+
+
+class Stage:
+    """Context manager adding the time spent in a block to a stage."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullStage:
+    """Stand-in for Stage when the instrumentation is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Drop everything measured so far."""
+    with lock:
+        stage_seconds.clear()
+        stage_calls.clear()
+        counters.clear()
+        histograms.clear()
+
+
+def stage(name):
+    """Time a block of code as a stage. Stages may nest, e.g. "query.fetch"
+    inside the time of a whole query, so their times do not add up to the total.
+
+        with instrument.stage("index.sort"):
+            ...
+
+    Args:
+        name (str): name of the stage
+
+    Returns:
+        Stage, or a shared no-op context manager when disabled
+    """
+    if not enabled:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def add_time(name, seconds):
+    """Add time measured by the caller to a stage, for code timed with
+    time.perf_counter() where a with block does not fit.
+    """
+    with lock:
+        stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+        stage_calls[name] = stage_calls.get(name, 0) + 1
+
+
+def count(name, n=1):
+    """Add n to a counter, when enabled."""
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS):
+    """Add a value, e.g. a query latency in seconds, to a histogram, when enabled."""
+    if enabled:
+        with lock:
+            if name not in histograms:
+                histograms[name] = Histogram(buckets)
+            histograms[name].observe(value)
+
+
+def snapshot():
+    """Get everything measured so far.
+
+    Returns:
+        dict: {"stages": {name: {"seconds", "calls"}}, "counters": {name: value},
+            "histograms": {name: {"count", "sum", "p50", "p90", "p99", "buckets"}}}
+    """
+    with lock:
+        return {
+            "stages": {name: {"seconds": stage_seconds[name], "calls": stage_calls[name]}
+                       for name in sorted(stage_seconds)},
+            "counters": dict(sorted(counters.items())),
+            "histograms": {name: {
+                "count": h.count,
+                "sum": h.sum,
+                "p50": h.quantile(0.5),
+                "p90": h.quantile(0.9),
+                "p99": h.quantile(0.99),
+                "buckets": [["+Inf" if bound == float("inf") else bound, n] for (bound, n) in h.cumulative_counts()],
+            } for (name, h) in sorted(histograms.items())},
+        }
+
+
+def to_json(indent=2):
+    return json.dumps(snapshot(), indent=indent)
+
+
+def metric_name(prefix, name):
+    return prefix + "".join(ch if ch.isalnum() else "_" for ch in name)
+
+
+def to_prometheus(prefix="ir_"):
+    """Format everything measured so far in the Prometheus text exposition format.
+
+    Args:
+        prefix (str): prefix of the metric names
+
+    Returns:
+        str: the stages as {prefix}stage_seconds_total and {prefix}stage_calls_total
+            labelled by stage, a {prefix}<name>_total per counter and a
+            {prefix}<name> histogram per histogram
+    """
+    snap = snapshot()
+    lines = []
+    if len(snap["stages"]) > 0:
+        lines.append("# TYPE {p}stage_seconds_total counter".format(p=prefix))
+        for (name, s) in snap["stages"].items():
+            lines.append('{p}stage_seconds_total{{stage="{n}"}} {v!r}'.format(p=prefix, n=name, v=s["seconds"]))
+        lines.append("# TYPE {p}stage_calls_total counter".format(p=prefix))
+        for (name, s) in snap["stages"].items():
+            lines.append('{p}stage_calls_total{{stage="{n}"}} {v}'.format(p=prefix, n=name, v=s["calls"]))
+    for (name, value) in snap["counters"].items():
+        metric = metric_name(prefix, name) + "_total"
+        lines.append("# TYPE {m} counter".format(m=metric))
+        lines.append("{m} {v}".format(m=metric, v=value))
+    for (name, h) in snap["histograms"].items():
+        metric = metric_name(prefix, name)
+        lines.append("# TYPE {m} histogram".format(m=metric))
+        for (bound, n) in h["buckets"]:
+            lines.append('{m}_bucket{{le="{b}"}} {n}'.format(m=metric, b=bound, n=n))
+        lines.append("{m}_sum {v!r}".format(m=metric, v=h["sum"]))
+        lines.append("{m}_count {v}".format(m=metric, v=h["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(path):
+    """Write everything measured so far to a file, in the Prometheus text
+    format if its name ends with .prom and as JSON otherwise.
+    """
+    with open(path, "w") as f:
+        f.write(to_prometheus() if path.endswith(".prom") else to_json())
+
+
+if os.environ.get(PROFILE_ENV):
+    enable()
+    # processes forked by multiprocessing exit without running atexit, only
+    # the parent writes its report
+    atexit.register(write_report, os.path.abspath(os.environ[PROFILE_ENV]))
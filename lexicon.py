@@ -0,0 +1,214 @@
+import os
+import re
+import sys
+import pickle
+from array import array
+from postings_codec import (
+    vbyte_encode,
+    vbyte_decode,
+)
+from doc_norms import index_fingerprint
+
+LEXICON_PATH = "stored_lexicon.pkl"
+
+# The sorted terms are stored front-coded in blocks of BLOCK_SIZE terms: the
+# first term of a block in full, every other term as the length of the prefix
+# it shares with the previous term and the rest of its bytes. Lengths are
+# vbyte-encoded, terms are UTF-8, whose byte order is the code point order
+# of sorted(). Only the offset of each block is kept besides the bytes.
+BLOCK_SIZE = 16
+
+# Wildcard character of the patterns, matching any sequence of characters
+WILDCARD = "*"
+
+# Default maximum number of terms a wildcard pattern can expand to
+MAX_EXPANSIONS = 100
+
+
+class Lexicon:
+    """Compact sorted term dictionary, for prefix and wildcard lookups.
+    A term's id is its rank in sorted order.
+    """
+
+    def __init__(self, terms):
+        """
+        Args:
+            terms (iterable(str)): the terms, in any order, without duplicates
+        """
+        self.data = bytearray()
+        self.block_offsets = array("I")
+        self.num_terms = 0
+        prev = b""
+        for term in sorted(terms):
+            term = term.encode("utf-8")
+            if self.num_terms % BLOCK_SIZE == 0:
+                self.block_offsets.append(len(self.data))
+                vbyte_encode([len(term)], self.data)
+                self.data.extend(term)
+            else:
+                shared = 0
+                limit = min(len(prev), len(term))
+                while shared < limit and prev[shared] == term[shared]:
+                    shared += 1
+                vbyte_encode([shared, len(term) - shared], self.data)
+                self.data.extend(term[shared:])
+            prev = term
+            self.num_terms += 1
+        self.data = bytes(self.data)
+
+    def first_term_of_block(self, block):
+        pos = self.block_offsets[block]
+        ([length], pos) = vbyte_decode(self.data, pos, 1)
+        return self.data[pos:pos + length]
+
+    def block_terms(self, block):
+        """Decode the terms of a block.
+
+        Returns:
+            list(bytes): the UTF-8 encoded terms of the block
+        """
+        data = self.data
+        pos = self.block_offsets[block]
+        ([length], pos) = vbyte_decode(data, pos, 1)
+        term = data[pos:pos + length]
+        pos += length
+        terms = [term]
+        for _ in range(min(BLOCK_SIZE, self.num_terms - block * BLOCK_SIZE) - 1):
+            ([shared, length], pos) = vbyte_decode(data, pos, 2)
+            term = term[:shared] + data[pos:pos + length]
+            pos += length
+            terms.append(term)
+        return terms
+
+    def lower_bound(self, key):
+        """Find the id of the first term not smaller than key.
+
+        Args:
+            key (bytes): UTF-8 encoded term
+
+        Returns:
+            int: the id, len(self) if all the terms are smaller
+        """
+        # last block whose first term is at most key
+        lo = 0
+        hi = len(self.block_offsets)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.first_term_of_block(mid) <= key:
+                lo = mid
+            else:
+                hi = mid
+        if self.num_terms == 0:
+            return 0
+        for (i, term) in enumerate(self.block_terms(lo)):
+            if term >= key:
+                return lo * BLOCK_SIZE + i
+        return min(self.num_terms, (lo + 1) * BLOCK_SIZE)
+
+    def find(self, term):
+        """Get the id of a term.
+
+        Returns:
+            int: the id of the term, -1 if it is not in the lexicon
+        """
+        key = term.encode("utf-8")
+        term_id = self.lower_bound(key)
+        if term_id < self.num_terms and self.term_at(term_id) == term:
+            return term_id
+        return -1
+
+    def term_at(self, term_id):
+        return self.block_terms(term_id // BLOCK_SIZE)[term_id % BLOCK_SIZE].decode("utf-8")
+
+    def iter_range(self, start, end):
+        """Iterate over the terms with ids in range(start, end), in sorted order."""
+        for block in range(start // BLOCK_SIZE, (end + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            base = block * BLOCK_SIZE
+            for (i, term) in enumerate(self.block_terms(block)):
+                if start <= base + i < end:
+                    yield term.decode("utf-8")
+
+    def prefix_range(self, prefix):
+        """Get the ids of the terms starting with a prefix.
+
+        Returns:
+            tuple(int, int): the terms with the prefix have the ids in range(start, end)
+        """
+        if prefix == "":
+            return (0, self.num_terms)
+        key = prefix.encode("utf-8")
+        # no UTF-8 byte is 0xff, every term with the prefix sorts before key + b"\xff"
+        return (self.lower_bound(key), self.lower_bound(key + b"\xff"))
+
+    def expand(self, pattern, max_terms=MAX_EXPANSIONS):
+        """Find the terms matching a pattern, e.g. "econom*" (prefix) or
+        "col*r" (* matches any sequence of characters). Only the terms starting
+        with the part before the first * are scanned, so a leading * scans the
+        whole lexicon.
+
+        Args:
+            pattern (str): the pattern, a term if it has no *
+            max_terms (int): stop after this many terms
+
+        Returns:
+            list(str): at most max_terms matching terms, in sorted order
+            bool: whether more terms match
+        """
+        if WILDCARD not in pattern:
+            return ([pattern], False) if pattern in self else ([], False)
+        parts = pattern.split(WILDCARD)
+        (start, end) = self.prefix_range(parts[0])
+        terms = self.iter_range(start, end)
+        if pattern != parts[0] + WILDCARD:
+            regex = re.compile(".*".join(re.escape(part) for part in parts), re.DOTALL)
+            terms = (term for term in terms if regex.fullmatch(term))
+        res = []
+        for term in terms:
+            if len(res) == max_terms:
+                return (res, True)
+            res.append(term)
+        return (res, False)
+
+    def size_in_bytes(self):
+        return sys.getsizeof(self.data) + sys.getsizeof(self.block_offsets)
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __iter__(self):
+        return self.iter_range(0, self.num_terms)
+
+    def __len__(self):
+        return self.num_terms
+
+
+def save_lexicon(lexicon, index_path, lexicon_path=LEXICON_PATH):
+    """Store a lexicon next to the index it was built from.
+
+    Args:
+        lexicon (Lexicon): the lexicon of the index terms
+        index_path (str): path of the stored index
+        lexicon_path (str): path of the lexicon file
+    """
+    with open(lexicon_path, "wb") as f:
+        pickle.dump((index_fingerprint(index_path), lexicon), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_lexicon(index_path, lexicon_path=LEXICON_PATH):
+    """Load a stored lexicon.
+
+    Args:
+        index_path (str): path of the stored index the lexicon is used with
+        lexicon_path (str): path of the lexicon file
+
+    Returns:
+        Lexicon: the lexicon, or None if there is no stored lexicon or it was
+            built for another version of the index
+    """
+    if not os.path.exists(lexicon_path):
+        return None
+    with open(lexicon_path, "rb") as f:
+        (fingerprint, lexicon) = pickle.load(f)
+    if fingerprint != index_fingerprint(index_path):
+        return None
+    return lexicon
@@ -0,0 +1,367 @@
+import os
+import re
+import sys
+import time
+import heapq
+import pickle
+from bisect import bisect_left
+from itertools import accumulate
+from collections.abc import Mapping
+from string_processing import (
+    process_tokens,
+    tokenize_text,
+    analyze_file,
+)
+from postings_codec import (
+    vbyte_encode,
+    vbyte_decode,
+)
+from doc_norms import index_fingerprint
+
+POSITIONS_PATH = "stored_positions.pkl"
+
+# A phrase of a query, e.g. "nuclear power plant", with an optional slop,
+# e.g. "nuclear plant"~3 (the words in any order within a window of the
+# phrase length plus the slop)
+phrase_re = re.compile(r'"([^"]*)"(?:~(\d+))?')
+
+# Positions are those of the processed tokens of a document (the stopwords
+# are removed first), so "house of commons" matches "house commons".
+# The positions of a term are stored with vbyte, as:
+#   number of documents, doc_id gaps, byte length of the positions of each
+#   document, then the position gaps of each document
+# The doc_ids and lengths are decoded together, the positions of a document
+# only when it is verified.
+
+
+class PositionalIndex(Mapping):
+    """Compressed positions of every term in every document. Behaves like a
+    dict(str : list(tuple(int, list(int)))) of (doc_id, positions) lists.
+    Documents are added in doc_id order with add_document, then finish is called.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        # term -> [last doc_id, number of documents, doc_id gaps, lengths, positions]
+        self.building = {}
+
+    def add_document(self, docid, toks):
+        """Add the processed tokens of a document, doc_ids in asc order.
+
+        Args:
+            docid (int): doc_id of the document
+            toks (list(str)): its processed tokens, in order
+        """
+        term_positions = {}
+        for (pos, tok) in enumerate(toks):
+            if tok in term_positions:
+                term_positions[tok].append(pos)
+            else:
+                term_positions[tok] = [pos]
+        for (tok, positions) in term_positions.items():
+            state = self.building.get(tok)
+            if state is None:
+                state = self.building[tok] = [0, 0, bytearray(), bytearray(), bytearray()]
+            vbyte_encode([docid - state[0]], state[2])
+            run_start = len(state[4])
+            prev = 0
+            for pos in positions:
+                vbyte_encode([pos - prev], state[4])
+                prev = pos
+            vbyte_encode([len(state[4]) - run_start], state[3])
+            state[0] = docid
+            state[1] += 1
+
+    def finish(self):
+        """Compress the terms added so far, in sorted order."""
+        for tok in sorted(self.building):
+            (_, count, gaps, lengths, runs) = self.building[tok]
+            out = bytearray()
+            vbyte_encode([count], out)
+            self.postings[tok] = bytes(out + gaps + lengths + runs)
+        self.building = {}
+
+    def term_entry(self, term):
+        """Decode the doc_ids of a term and where their positions are.
+
+        Returns:
+            list(int): asc sorted doc_ids containing the term
+            list(int): start of the positions of each doc_id in data, and the end
+            bytes: the compressed positions
+        """
+        data = self.postings[term]
+        ([count], pos) = vbyte_decode(data, 0, 1)
+        (numbers, pos) = vbyte_decode(data, pos, 2 * count)
+        doc_ids = list(accumulate(numbers[:count]))
+        offsets = list(accumulate(numbers[count:], initial=pos))
+        return (doc_ids, offsets, data)
+
+    def doc_freq(self, term):
+        return vbyte_decode(self.postings[term], 0, 1)[0][0]
+
+    def doc_ids_of(self, term):
+        if term not in self.postings:
+            return []
+        return self.term_entry(term)[0]
+
+    def __getitem__(self, term):
+        (doc_ids, offsets, data) = self.term_entry(term)
+        return [(docid, decode_positions(data, offsets, i)) for (i, docid) in enumerate(doc_ids)]
+
+    def __contains__(self, term):
+        return term in self.postings
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+    def size_in_bytes(self):
+        """Get the total size of the compressed positions."""
+        return sum(len(data) for data in self.postings.values())
+
+
+def decode_positions(data, offsets, i):
+    """Decode the positions of the i-th document of a term (see PositionalIndex.term_entry)."""
+    return list(accumulate(vbyte_decode(data[offsets[i]:offsets[i + 1]])[0]))
+
+
+def build_positional_index(path_list, doc_ids):
+    """Build the positional index of the documents, one document at a time,
+    from the same processed tokens as the index (see indexer.get_token_list).
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+
+    Returns:
+        PositionalIndex: the positions of every term
+    """
+    positional_index = PositionalIndex()
+    for path in sorted(path_list, key=lambda x: doc_ids[x]):
+        toks = []
+        for chunk_toks in analyze_file(path):
+            toks.extend(chunk_toks)
+        positional_index.add_document(doc_ids[path], toks)
+    positional_index.finish()
+    return positional_index
+
+
+def phrase_terms(text):
+    """Process the words of a phrase like the documents are."""
+    return process_tokens(tokenize_text(text))
+
+
+def split_phrases(query_string):
+    """Take the quoted phrases out of a ranked query.
+
+    Args:
+        query_string (str): the query string, e.g. 'safety "nuclear power plant"'
+
+    Returns:
+        str: the query without the quotes and slops, its words still scored
+        list(tuple(list(str), int)): the processed terms and slop of each phrase,
+            without the phrases of stopwords only
+    """
+    phrases = [(phrase_terms(m.group(1)), int(m.group(2) or 0)) for m in phrase_re.finditer(query_string)]
+    phrases = [(terms, slop) for (terms, slop) in phrases if len(terms) > 0]
+    return (phrase_re.sub(lambda m: " " + m.group(1) + " ", query_string), phrases)
+
+
+def has_phrase(term_positions, offsets):
+    """Check that a document has the terms at consecutive positions.
+
+    Args:
+        term_positions (list(list(int))): positions of each distinct term, rarest first
+        offsets (list(list(int))): offsets of each distinct term in the phrase
+
+    Returns:
+        bool: whether the phrase is in the document
+    """
+    starts = None
+    for (positions, term_offsets) in zip(term_positions, offsets):
+        for offset in term_offsets:
+            term_starts = {pos - offset for pos in positions}
+            starts = term_starts if starts is None else starts & term_starts
+            if len(starts) == 0:
+                return False
+    return True
+
+
+def min_window(term_positions):
+    """Get the smallest number of positions between the first and the last of
+    a window containing every term.
+
+    Args:
+        term_positions (list(list(int))): asc sorted positions of each distinct term
+
+    Returns:
+        int: the span of the smallest window
+    """
+    heap = [(positions[0], t, 0) for (t, positions) in enumerate(term_positions)]
+    heapq.heapify(heap)
+    end = max(positions[0] for positions in term_positions)
+    best = end - heap[0][0]
+    while True:
+        (pos, t, i) = heapq.heappop(heap)
+        best = min(best, end - pos)
+        if i + 1 == len(term_positions[t]):
+            return best
+        nxt = term_positions[t][i + 1]
+        end = max(end, nxt)
+        heapq.heappush(heap, (nxt, t, i + 1))
+
+
+def match_phrase(terms, positional_index, slop=0):
+    """Find the documents containing a phrase. The doc_ids of the rarest term
+    are intersected with those of the other terms, rarest first, and the
+    positions are only decoded for the documents containing all the terms.
+
+    Args:
+        terms (list(str)): processed terms of the phrase
+        positional_index (PositionalIndex): positions of every term
+        slop (int): 0 for the exact phrase, otherwise the terms in any order
+            within len(terms) - 1 + slop positions
+
+    Returns:
+        list(int): asc sorted doc_ids containing the phrase
+    """
+    distinct = list(dict.fromkeys(terms))
+    if len(distinct) == 0 or any(term not in positional_index for term in distinct):
+        return []
+    entries = [positional_index.term_entry(term) for term in distinct]
+    order = sorted(range(len(distinct)), key=lambda t: len(entries[t][0]))
+    entries = [entries[t] for t in order]
+    offsets = [[i for (i, term) in enumerate(terms) if term == distinct[t]] for t in order]
+
+    res = []
+    cursors = [0] * len(entries)
+    for (i, docid) in enumerate(entries[0][0]):
+        found = [i]
+        for (t, (doc_ids, _, _)) in enumerate(entries[1:], 1):
+            j = bisect_left(doc_ids, docid, cursors[t])
+            cursors[t] = j
+            if j == len(doc_ids) or doc_ids[j] != docid:
+                break
+            found.append(j)
+        else:
+            term_positions = [decode_positions(data, term_offsets, j)
+                              for ((_, term_offsets, data), j) in zip(entries, found)]
+            if slop == 0:
+                matched = has_phrase(term_positions, offsets)
+            else:
+                matched = min_window(term_positions) <= len(terms) - 1 + slop
+            if matched:
+                res.append(docid)
+    return res
+
+
+def phrase_filter(phrases, positional_index):
+    """Get the documents containing all the phrases of a query.
+
+    Args:
+        phrases (list(tuple(list(str), int))): see split_phrases
+        positional_index (PositionalIndex): positions of every term
+
+    Returns:
+        set(int): doc_ids containing every phrase
+    """
+    allowed = None
+    # longer phrases are usually rarer
+    for (terms, slop) in sorted(phrases, key=lambda x: len(x[0]), reverse=True):
+        docs = set(match_phrase(terms, positional_index, slop))
+        allowed = docs if allowed is None else allowed & docs
+        if len(allowed) == 0:
+            break
+    return allowed
+
+
+def positions_report(index, positional_index, phrases):
+    """Measure the extra size of the positions and the cost of phrase queries.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): the index
+        positional_index (PositionalIndex): its positions
+        phrases (list(str)): phrases to time, e.g. "nuclear power plant"
+
+    Returns:
+        dict: sizes, and for each phrase the time of the doc-level intersection
+            of its terms and of the phrase match, and the number of documents
+    """
+    from query_boolean import intersect_many
+
+    num_positions = sum(tf for term in index for (_, tf) in index[term])
+    size = positional_index.size_in_bytes()
+    report = {
+        "terms": len(positional_index),
+        "positions": num_positions,
+        "bytes": size,
+        "bytes_per_position": size / max(1, num_positions),
+        # a list slot and an int for every position
+        "python_bytes": num_positions * (8 + sys.getsizeof(2**20)),
+        "phrases": [],
+    }
+    for phrase in phrases:
+        terms = phrase_terms(phrase)
+        start = time.perf_counter()
+        docs = intersect_many([[docid for (docid, _) in index.get(term, [])] for term in dict.fromkeys(terms)])
+        and_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        matched = match_phrase(terms, positional_index)
+        phrase_seconds = time.perf_counter() - start
+        report["phrases"].append({"phrase": phrase, "and_docs": len(docs), "and_ms": 1000 * and_seconds,
+                                  "phrase_docs": len(matched), "phrase_ms": 1000 * phrase_seconds})
+    return report
+
+
+def save_positions(positional_index, index_path, positions_path=POSITIONS_PATH):
+    """Store the positions next to the index they were built with.
+
+    Args:
+        positional_index (PositionalIndex): the positions
+        index_path (str): path of the stored index
+        positions_path (str): path of the positions file
+    """
+    with open(positions_path, "wb") as f:
+        pickle.dump((index_fingerprint(index_path), positional_index.postings), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_positions(index_path, positions_path=POSITIONS_PATH):
+    """Load stored positions.
+
+    Args:
+        index_path (str): path of the stored index the positions are used with
+        positions_path (str): path of the positions file
+
+    Returns:
+        PositionalIndex: the positions, or None if there are no stored positions
+            or they were built for another version of the index
+    """
+    if not os.path.exists(positions_path):
+        return None
+    with open(positions_path, "rb") as f:
+        (fingerprint, postings) = pickle.load(f)
+    if fingerprint != index_fingerprint(index_path):
+        return None
+    positional_index = PositionalIndex()
+    positional_index.postings = postings
+    return positional_index
+
+
+if __name__ == '__main__':
+    import json
+    from index_store import (
+        open_stored_index,
+        stored_index_path,
+    )
+
+    # report the size and cost of the positions stored by indexer.py --positions
+    (index, doc_freq, doc_ids, num_docs) = open_stored_index()
+    positional_index = load_positions(stored_index_path())
+    if positional_index is None:
+        raise Exception("No positions stored for this index, run indexer.py with --positions")
+    phrases = sys.argv[1:] or ["nuclear power plant", "severe weather", "science and technology"]
+    report = positions_report(index, positional_index, phrases)
+    report["index_bytes"] = os.path.getsize(stored_index_path())
+    print(json.dumps(report, indent=2))
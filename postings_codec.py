@@ -0,0 +1,289 @@
+import sys
+import time
+import pickle
+from array import array
+from itertools import accumulate
+from collections.abc import Mapping
+
+# Posting lists are stored as the number of postings, the doc_id gaps, then
+# the term frequencies. Two codecs are available:
+#   vbyte   : byte-aligned variable-byte, 7 bits per byte, high bit set on the last byte
+#   bitpack : blocks of BLOCK_SIZE values bit-packed with the width of the largest value
+CODECS = ["vbyte", "bitpack"]
+BLOCK_SIZE = 128
+
+# array typecodes to unpack byte-aligned widths in C
+ALIGNED_TYPECODES = {8: "B", 16: "H", 32: "I"}
+
+
+def vbyte_encode(numbers, out):
+    """Append numbers to a bytearray with variable-byte encoding.
+
+    Args:
+        numbers (iterable(int)): non-negative integers
+        out (bytearray): output buffer
+    """
+    for n in numbers:
+        while n >= 128:
+            out.append(n & 127)
+            n >>= 7
+        out.append(n | 128)
+
+
+def vbyte_decode(data, pos=0, count=-1):
+    """Decode variable-byte encoded numbers.
+
+    Args:
+        data (bytes): encoded data
+        pos (int): position of the first byte to decode
+        count (int): number of values to decode (-1: until the end of data)
+
+    Returns:
+        list(int): the decoded numbers
+        int: position after the last decoded byte
+    """
+    numbers = []
+    n = 0
+    shift = 0
+    for b in memoryview(data)[pos:]:
+        pos += 1
+        if b < 128:
+            n |= b << shift
+            shift += 7
+        else:
+            numbers.append(n | ((b & 127) << shift))
+            n = 0
+            shift = 0
+            if len(numbers) == count:
+                break
+    return numbers, pos
+
+
+def bitpack_encode(numbers, out):
+    """Append numbers to a bytearray, bit-packed in blocks of BLOCK_SIZE values.
+    Each block is one byte with the bit width followed by the packed values.
+
+    Args:
+        numbers (list(int)): non-negative integers
+        out (bytearray): output buffer
+    """
+    for start in range(0, len(numbers), BLOCK_SIZE):
+        block = numbers[start:start + BLOCK_SIZE]
+        width = max(block).bit_length()
+        out.append(width)
+        if width == 0:
+            continue
+        if width in ALIGNED_TYPECODES:
+            out.extend(array(ALIGNED_TYPECODES[width], block).tobytes())
+            continue
+        packed = 0
+        for (i, n) in enumerate(block):
+            packed |= n << (i * width)
+        out.extend(packed.to_bytes((len(block) * width + 7) // 8, "little"))
+
+
+def bitpack_decode(data, pos, count):
+    """Decode numbers encoded with bitpack_encode.
+
+    Args:
+        data (bytes): encoded data
+        pos (int): position of the first block
+        count (int): number of values to decode
+
+    Returns:
+        list(int): the decoded numbers
+        int: position after the last decoded block
+    """
+    numbers = []
+    while count > 0:
+        n = min(count, BLOCK_SIZE)
+        width = data[pos]
+        pos += 1
+        size = (n * width + 7) // 8
+        if width == 0:
+            numbers.extend([0] * n)
+        elif width in ALIGNED_TYPECODES:
+            block = array(ALIGNED_TYPECODES[width])
+            block.frombytes(data[pos:pos + size])
+            numbers.extend(block)
+        else:
+            packed = int.from_bytes(data[pos:pos + size], "little")
+            mask = (1 << width) - 1
+            numbers.extend([(packed >> (i * width)) & mask for i in range(n)])
+        pos += size
+        count -= n
+    return numbers, pos
+
+
+def encode_postings(postings, codec="vbyte"):
+    """Compress a posting list.
+
+    Args:
+        postings (list(tuple(int, int))): asc sorted list of (doc_id, term_frequency)
+        codec (str): one of CODECS
+
+    Returns:
+        bytes: the compressed posting list
+    """
+    gaps = []
+    prev = 0
+    for (docid, tf) in postings:
+        gaps.append(docid - prev)
+        prev = docid
+    tfs = [tf for (docid, tf) in postings]
+
+    out = bytearray()
+    vbyte_encode([len(postings)], out)
+    if codec == "vbyte":
+        vbyte_encode(gaps, out)
+        vbyte_encode(tfs, out)
+    elif codec == "bitpack":
+        bitpack_encode(gaps, out)
+        bitpack_encode(tfs, out)
+    else:
+        raise ValueError("Unknown codec: {codec}".format(codec=codec))
+    return bytes(out)
+
+
+def decode_doc_ids(data, codec="vbyte"):
+    """Decode the doc_ids of a compressed posting list, skipping the term frequencies
+    when the codec allows it.
+
+    Args:
+        data (bytes): the compressed posting list
+        codec (str): one of CODECS
+
+    Returns:
+        list(int): asc sorted doc_ids
+    """
+    ([count], pos) = vbyte_decode(data, 0, 1)
+    if codec == "vbyte":
+        (gaps, pos) = vbyte_decode(data, pos, count)
+    else:
+        (gaps, pos) = bitpack_decode(data, pos, count)
+    return list(accumulate(gaps))
+
+
+def decode_postings(data, codec="vbyte"):
+    """Decode a compressed posting list.
+
+    Args:
+        data (bytes): the compressed posting list
+        codec (str): one of CODECS
+
+    Returns:
+        list(tuple(int, int)): asc sorted list of (doc_id, term_frequency)
+    """
+    ([count], pos) = vbyte_decode(data, 0, 1)
+    if count == 0:
+        return []
+    if codec == "vbyte":
+        (numbers, pos) = vbyte_decode(data, pos, 2 * count)
+        gaps = numbers[:count]
+        tfs = numbers[count:]
+    else:
+        (gaps, pos) = bitpack_decode(data, pos, count)
+        (tfs, pos) = bitpack_decode(data, pos, count)
+    return list(zip(accumulate(gaps), tfs))
+
+
+class CompressedIndex(Mapping):
+    """An index whose posting lists are kept compressed in memory and decoded
+    on access. Behaves like the dict(str : list(tuple(int, int))) built by the
+    indexer, so it can be passed to the query functions as is.
+    """
+
+    def __init__(self, index, codec="vbyte"):
+        """
+        Args:
+            index (dict(str : list(tuple(int, int)))): the index to compress
+            codec (str): one of CODECS
+        """
+        self.codec = codec
+        self.postings = {term: encode_postings(index[term], codec) for term in index}
+
+    def __getitem__(self, term):
+        return decode_postings(self.postings[term], self.codec)
+
+    def __contains__(self, term):
+        return term in self.postings
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+    def doc_ids_of(self, term):
+        """Get the asc sorted doc_ids of a term without decoding the term frequencies.
+
+        Args:
+            term (str): the term
+
+        Returns:
+            list(int): doc_ids containing the term (empty if term is not indexed)
+        """
+        if term not in self.postings:
+            return []
+        return decode_doc_ids(self.postings[term], self.codec)
+
+    def size_in_bytes(self):
+        """Get the total size of the compressed posting lists."""
+        return sum(len(data) for data in self.postings.values())
+
+
+def codec_report(index, codecs=CODECS):
+    """Measure the compression ratio and the decoding throughput of each codec.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): the index
+        codecs (list(str)): codecs to measure
+
+    Returns:
+        list(dict): one entry per codec with the compressed size, the compression
+            ratio over uint32 (doc_id, tf) pairs and over the Python lists, and the
+            decoding throughput in postings per second
+    """
+    num_postings = sum(len(postings) for postings in index.values())
+    raw_size = 8 * num_postings
+    # a list slot, a tuple and (at worst) two ints for each posting
+    py_size = num_postings * (8 + sys.getsizeof((0, 0)) + 2 * sys.getsizeof(2**30))
+
+    report = []
+    for codec in codecs:
+        compressed = CompressedIndex(index, codec)
+        size = compressed.size_in_bytes()
+
+        start = time.perf_counter()
+        for data in compressed.postings.values():
+            decode_postings(data, codec)
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in compressed.postings.values():
+            decode_doc_ids(data, codec)
+        elapsed_doc_ids = time.perf_counter() - start
+
+        report.append({
+            "codec": codec,
+            "postings": num_postings,
+            "bytes": size,
+            "bytes_per_posting": size / max(1, num_postings),
+            "ratio_vs_uint32": raw_size / max(1, size),
+            "ratio_vs_python": py_size / max(1, size),
+            "postings_per_sec": num_postings / max(elapsed, 1e-9),
+            "doc_ids_per_sec": num_postings / max(elapsed_doc_ids, 1e-9),
+        })
+    return report
+
+
+if __name__ == '__main__':
+    # load the stored index and compare the codecs on it
+    from index_store import INDEX_PKL_PATH
+    (index, doc_freq, doc_ids, num_docs) = pickle.load(open(INDEX_PKL_PATH, "rb"))
+
+    print("{:<8} {:>12} {:>10} {:>10} {:>10} {:>14} {:>14}".format(
+        "codec", "bytes", "B/posting", "x uint32", "x python", "postings/s", "doc_ids/s"))
+    for r in codec_report(index):
+        print("{codec:<8} {bytes:>12} {bytes_per_posting:>10.2f} {ratio_vs_uint32:>10.2f} "
+              "{ratio_vs_python:>10.2f} {postings_per_sec:>14.0f} {doc_ids_per_sec:>14.0f}".format(**r))
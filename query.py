@@ -1,26 +1,58 @@
 import os
+import argparse
 import math
-import pickle
+import time
+import heapq
+import multiprocessing
 from collections import defaultdict
 from string_processing import (
     process_tokens,
     tokenize_text,
+    normalize_pattern,
 )
+from index_store import (
+    DocPaths,
+    open_stored_index,
+    stored_index_path,
+)
+from doc_norms import load_doc_norms
+from lexicon import (
+    WILDCARD,
+    MAX_EXPANSIONS,
+)
+from positions import (
+    split_phrases,
+    phrase_filter,
+)
+import instrument
 
 
-def get_query_tokens(query_string):
+def get_query_tokens(query_string, lexicon=None, max_expansions=MAX_EXPANSIONS):
     """Turns a query text string into a sequence of tokens.
     Applies the same set of linguistic modules as during
     index construction.
 
     Args:
         query_string (str): the input query string
+        lexicon (lexicon.Lexicon): terms of the index, to expand the tokens
+            with a * (e.g. econom*) into the matching terms (optional)
+        max_expansions (int): maximum number of terms a token expands to,
+            the first ones in sorted order are kept
 
     Returns:
         list(str): a list of processed tokens
     """
     toks = tokenize_text(query_string)
-    return process_tokens(toks)
+    if lexicon is None or not any(WILDCARD in tok for tok in toks):
+        return process_tokens(toks)
+    processed_toks = []
+    for tok in toks:
+        if WILDCARD in tok:
+            # the expanded terms are already processed
+            processed_toks.extend(lexicon.expand(normalize_pattern(tok), max_expansions)[0])
+        else:
+            processed_toks.extend(process_tokens([tok]))
+    return processed_toks
 
 
 def count_query_tokens(query_tokens):
@@ -63,8 +95,27 @@ def get_doc_to_norm(index, doc_freq, num_docs):
 
     return doc_norm
 
+get_doc_to_norm.norm_variant = "tf"
+
 
-def run_query(query_string, index, doc_freq, doc_norm, num_docs):
+def top_k(doc_to_score, k=None):
+    """Sort scored documents from most to least similar, ties staying in the
+    order they were scored in.
+
+    Args:
+        doc_to_score (dict(int : float)): a map from docid to similarity score
+        k (int): only return the k most similar documents (default: all of them)
+
+    Returns:
+        list(tuple(int, float)): the (doc_id, score) sorted by descending score
+    """
+    if k is None or k >= len(doc_to_score):
+        return sorted(doc_to_score.items(), key=lambda x:-x[1])
+    # same as sorted(...)[:k], with a heap of size k
+    return heapq.nlargest(k, doc_to_score.items(), key=lambda x: x[1])
+
+
+def run_query(query_string, index, doc_freq, doc_norm, num_docs, k=None, lexicon=None, positions=None):
     """Run a query on the index and return a sorted list of documents. 
     Sorted by most similar to least similar.
     Documents not returned in the sorted list are assumed to have 0 similarity.
@@ -75,14 +126,24 @@ def run_query(query_string, index, doc_freq, doc_norm, num_docs):
         doc_freq (dict(str : int)): document frequency for each term
         doc_norm (dict(int : float)): a map from docid to pre-computed document norms
         num_docs (int): number of documents in the corpus
+        k (int): only return the k most similar documents (default: all of them)
+        lexicon (lexicon.Lexicon): terms of the index, for the query tokens
+            with a * (optional, see get_query_tokens)
+        positions (positions.PositionalIndex): positions of the terms, to only
+            keep the documents containing the quoted phrases of the query (optional)
 
     Returns:
         list(tuple(int, float)): a list of document ids and the similarity scores with the query
             sorted so that the most similar documents to the query are at the top
     """
+    phrases = []
+    if positions is not None:
+        (query_string, phrases) = split_phrases(query_string)
+
     # pre-process the query string
-    qt = get_query_tokens(query_string)
-    query_token_counts = count_query_tokens(qt)
+    with instrument.stage("query.normalize"):
+        qt = get_query_tokens(query_string, lexicon)
+        query_token_counts = count_query_tokens(qt)
 
     # calculate the norm of the query vector
     query_norm = 0
@@ -100,15 +161,58 @@ def run_query(query_string, index, doc_freq, doc_norm, num_docs):
         # ignore query terms not in the index
         if term not in index:
             continue
+        with instrument.stage("query.fetch"):
+            postings = index[term]
         # add to similarity for documents that contain current query word
-        for (docid, tf_doc) in index[term]:
-            doc_to_score[docid] += tf_query * tf_doc / (doc_norm[docid] * query_norm)
+        with instrument.stage("query.score"):
+            for (docid, tf_doc) in postings:
+                doc_to_score[docid] += tf_query * tf_doc / (doc_norm[docid] * query_norm)
 
-    sorted_docs = sorted(doc_to_score.items(), key=lambda x:-x[1])
+    if len(phrases) > 0:
+        with instrument.stage("query.phrase"):
+            allowed = phrase_filter(phrases, positions)
+            doc_to_score = {docid: score for (docid, score) in doc_to_score.items() if docid in allowed}
+
+    with instrument.stage("query.sort"):
+        sorted_docs = top_k(doc_to_score, k)
     return sorted_docs
 
 
-def query_main(queries=None, query_func=None, doc_norm_func=None):
+# Everything the evaluation queries need, set by query_main before forking the
+# worker processes so they share the loaded index copy-on-write
+batch_state = None
+
+
+def run_topic(line):
+    """Run one line of gov.topics and format the result in the trec_eval format.
+
+    Args:
+        line (str): a line of gov.topics, the query id followed by the query
+
+    Returns:
+        str: the lines of the run file for this query
+    """
+    (query_func, index, doc_freq, doc_norms, num_docs, ids_to_doc, k) = batch_state
+
+    # read the evaluation query
+    terms = line.split()
+    qid = terms[0]
+    query_string = " ".join(terms[1:])
+
+    # run the query
+    start = time.perf_counter()
+    res = query_func(query_string, index, doc_freq, doc_norms, num_docs, k=k)
+    instrument.observe("query_seconds", time.perf_counter() - start)
+    instrument.count("queries")
+
+    # write the results in the correct trec_eval format
+    # see https://trec.nist.gov/data/terabyte/04/04.guidelines.html
+    with instrument.stage("query.write"):
+        return "".join(f"{qid} Q0 {os.path.split(ids_to_doc[docid])[-1]} {rank+1} {sim} MY_IR_SYSTEM\n"
+                       for rank, (docid, sim) in enumerate(res))
+
+
+def query_main(queries=None, query_func=None, doc_norm_func=None, k=None, index_func=None, workers=1):
     """Run all the queries in the evaluation dataset (and the specific queries if given)
     and store the result for evaluation.
 
@@ -117,51 +221,71 @@ def query_main(queries=None, query_func=None, doc_norm_func=None):
         query_func (callable): a function to run the query, e.g., the run_query function.
         doc_norm_func (callable): a function to compute the norms for document vectors,
             e.g., the get_doc_to_norm function.
+        k (int): number of documents retrieved for each evaluation query (default: all of them)
+        index_func (callable): a function applied to the loaded index before running
+            the queries, e.g., query_numpy.build_array_index (optional)
+        workers (int): number of processes running the evaluation queries (None: number
+            of CPUs). The results are written in the order of gov.topics as they come.
     """
     assert query_func is not None
     assert doc_norm_func is not None
 
-    # load the index from disk
-    (index, doc_freq, doc_ids, num_docs) = pickle.load(open("stored_index.pkl", "rb"))
+    # load the index from disk (in full, unless it is the memory-mapped binary index)
+    (index, doc_freq, doc_ids, num_docs) = open_stored_index()
+    if index_func is not None:
+        index = index_func(index)
 
-    # compute doc norms (in practice we would want to store this on disk, for
-    # simplicity in this assignment it is computed here)
-    doc_norms = doc_norm_func(index, doc_freq, num_docs) 
+    # load the doc norms stored by the indexer, and only compute them if they
+    # are missing or were computed for another version of the index
+    doc_norms = None
+    if hasattr(doc_norm_func, "norm_variant"):
+        doc_norms = load_doc_norms(doc_norm_func.norm_variant, stored_index_path())
+    if doc_norms is None:
+        print("Stored document norms are missing or stale, computing them ...")
+        doc_norms = doc_norm_func(index, doc_freq, num_docs)
 
-    # get a reverse mapping from doc_ids to document paths
-    ids_to_doc = {docid: path for (path, docid) in doc_ids.items()}
+    # get a reverse mapping from doc_ids to document paths, built on the first lookup
+    ids_to_doc = DocPaths(doc_ids)
 
     # if a list of query strings are specified, run the query and output the top ranked documents
     if queries is not None and len(queries) > 0:
         for query_string in queries:
             print(f'Query: {query_string}')
-            res = query_func(query_string, index, doc_freq, doc_norms, num_docs)
+            res = query_func(query_string, index, doc_freq, doc_norms, num_docs, k=5)
             print('Top-5 documents (similarity scores):')
-            for (docid, sim) in res[:5]:
+            for (docid, sim) in res:
                 print(f'{ids_to_doc[docid]} {sim:.4f}')
 
     # run all the queries in the evaluation dataset and store the result for evaluation
-    result_strs = []
-    with open(os.path.join('gov', 'topics', 'gov.topics'), 'r') as f:
-        for line in f:
-            # read the evaluation query
-            terms = line.split()
-            qid = terms[0]
-            query_string = " ".join(terms[1:])
-
-            # run the query
-            res = query_func(query_string, index, doc_freq, doc_norms, num_docs)
-
-            # write the results in the correct trec_eval format
-            # see https://trec.nist.gov/data/terabyte/04/04.guidelines.html
-            for rank, (docid, sim) in enumerate(res):
-                result_strs.append(f"{qid} Q0 {os.path.split(ids_to_doc[docid])[-1]} {rank+1} {sim} MY_IR_SYSTEM\n")
-
-    with open('retrieved.txt', 'w') as fout:
-        for line in result_strs:
-            fout.write(line)
-
+    global batch_state
+    batch_state = (query_func, index, doc_freq, doc_norms, num_docs, ids_to_doc, k)
+    if workers is None:
+        workers = os.cpu_count() or 4
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        # the workers would have to unpickle the whole index
+        print("Processes can't be forked on this platform, running the queries one by one ...")
+        workers = 1
+
+    with open(os.path.join('gov', 'topics', 'gov.topics'), 'r') as f, open('retrieved.txt', 'w') as fout:
+        if workers > 1:
+            # build it once before forking, not once in every worker
+            ids_to_doc.build()
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                # imap keeps the order of the topics
+                for result_str in pool.imap(run_topic, f, chunksize=4):
+                    fout.write(result_str)
+        else:
+            for line in f:
+                fout.write(run_topic(line))
+    batch_state = None
 
 if __name__ == '__main__':
-    query_main(query_func=run_query, doc_norm_func=get_doc_to_norm)
+    parser = argparse.ArgumentParser(description="Run the evaluation queries")
+    parser.add_argument("--k", type=int, default=None,
+                        help="number of documents retrieved for each query (default: all of them)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes running the evaluation queries (0: number of CPUs)")
+    args = parser.parse_args()
+
+    query_main(query_func=run_query, doc_norm_func=get_doc_to_norm, k=args.k, workers=args.workers or None)
 
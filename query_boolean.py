@@ -1,10 +1,37 @@
-import pickle
 from string_processing import (
     run_normalization,
     tokenize_text,
 )
 import os
-from multiprocessing.pool import ThreadPool
+import re
+import time
+import heapq
+import atexit
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from index_store import (
+    DocPaths,
+    MmapIndex,
+    open_stored_index,
+    stored_index_path,
+)
+from bitmap import (
+    Bitmap,
+    load_bitmaps,
+)
+from lexicon import (
+    WILDCARD,
+    MAX_EXPANSIONS,
+    Lexicon,
+    load_lexicon,
+)
+from positions import (
+    phrase_re,
+    phrase_terms,
+    match_phrase,
+    load_positions,
+)
+import instrument
 
 operation_map = {}
 
@@ -33,6 +60,75 @@ def intersect_query(doc_list1, doc_list2):
 
     return res
 
+# Above this ratio of list lengths, galloping through the long list beats a linear merge
+GALLOP_RATIO = 16
+
+def galloping_search(doc_list, target, lo):
+    """Find the first position at or after lo holding a doc_id >= target. The
+    step doubles until it overshoots, then the last step is binary searched,
+    so the cost grows with the log of the distance skipped.
+
+    Args:
+        doc_list (list(int)): asc sorted doc_ids
+        target (int): doc_id to look for
+        lo (int): position to start from
+
+    Returns:
+        int: the position (len(doc_list) if every doc_id is smaller)
+    """
+    n = len(doc_list)
+    step = 1
+    hi = lo
+    while hi < n and doc_list[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(doc_list, target, lo, min(hi, n))
+
+def intersect_galloping(doc_list1, doc_list2):
+    """Intersect a short list with a long one, galloping through the long one.
+
+    Args:
+        doc_list1 (list(int)): asc sorted doc_ids
+        doc_list2 (list(int)): asc sorted doc_ids
+
+    Returns:
+        list(int): asc sorted doc_ids in both lists
+    """
+    if len(doc_list1) > len(doc_list2):
+        doc_list1, doc_list2 = doc_list2, doc_list1
+
+    res = []
+    pos = 0
+    len2 = len(doc_list2)
+    for doc in doc_list1:
+        pos = galloping_search(doc_list2, doc, pos)
+        if pos == len2:
+            break
+        if doc_list2[pos] == doc:
+            res.append(doc)
+            pos += 1
+    return res
+
+def intersect_adaptive(doc_list1, doc_list2):
+    """Intersect two lists, picking the linear merge for lists of similar
+    lengths and galloping when one is much longer than the other.
+
+    Args:
+        doc_list1 (list(int)): asc sorted doc_ids
+        doc_list2 (list(int)): asc sorted doc_ids
+
+    Returns:
+        list(int): asc sorted doc_ids in both lists
+    """
+    len1 = len(doc_list1)
+    len2 = len(doc_list2)
+    if len1 == 0 or len2 == 0:
+        return []
+    if max(len1, len2) >= GALLOP_RATIO * min(len1, len2):
+        return intersect_galloping(doc_list1, doc_list2)
+    return intersect_query(doc_list1, doc_list2)
+
 def union_query(doc_list1, doc_list2):
     res = []
     idx1 = 0
@@ -73,6 +169,82 @@ def union_query(doc_list1, doc_list2):
     
     return res
 
+def union_many(doc_lists):
+    """Union any number of lists in one pass, with a k-way heap merge instead
+    of a union_query per list.
+
+    Args:
+        doc_lists (list(list(int))): asc sorted doc_ids lists
+
+    Returns:
+        list(int): asc sorted doc_ids in any of the lists
+    """
+    if len(doc_lists) == 1:
+        return list(doc_lists[0])
+    res = []
+    last = -1
+    for doc in heapq.merge(*doc_lists):
+        if doc != last:
+            res.append(doc)
+            last = doc
+    return res
+
+def intersect_many(doc_lists):
+    """Intersect any number of lists in one pass. The two shortest lists are
+    intersected first, then every doc_id left is searched for in the other lists
+    from the shortest to the longest, galloping from where the previous search
+    stopped.
+
+    Args:
+        doc_lists (list(list(int))): asc sorted doc_ids lists
+
+    Returns:
+        list(int): asc sorted doc_ids in all the lists
+    """
+    if len(doc_lists) == 0:
+        return []
+    if len(doc_lists) <= 2:
+        return intersect_adaptive(doc_lists[0], doc_lists[-1]) if len(doc_lists) == 2 else list(doc_lists[0])
+    doc_lists = sorted(doc_lists, key=len)
+    candidates = intersect_adaptive(doc_lists[0], doc_lists[1])
+    
+    others = doc_lists[2:]
+    lens = [len(doc_list) for doc_list in others]
+    cursors = [0] * len(others)
+    res = []
+    for doc in candidates:
+        for i in range(len(others)):
+            cursors[i] = galloping_search(others[i], doc, cursors[i])
+            if cursors[i] == lens[i]:
+                return res
+            if others[i][cursors[i]] != doc:
+                break
+        else:
+            res.append(doc)
+    return res
+
+def difference_query(doc_list1, doc_list2):
+    """Get the doc_ids of the first list which are not in the second one
+    (doc_list1 AND NOT doc_list2).
+
+    Args:
+        doc_list1 (list(int)): asc sorted doc_ids
+        doc_list2 (list(int)): asc sorted doc_ids
+
+    Returns:
+        list(int): asc sorted doc_ids
+    """
+    res = []
+    idx2 = 0
+    len2 = len(doc_list2)
+    
+    for doc1 in doc_list1:
+        idx2 = galloping_search(doc_list2, doc1, idx2)
+        if idx2 == len2 or doc_list2[idx2] != doc1:
+            res.append(doc1)
+    
+    return res
+
 def get_doc_list(term, posting_list, index):
     """Get posting list of term
 
@@ -89,12 +261,70 @@ def get_doc_list(term, posting_list, index):
         
     if term not in index:
         return
+    elif hasattr(index, "doc_ids_of"):
+        # compressed or disk-backed index, skip decoding the term frequencies
+        occurences = index.doc_ids_of(term)
     else:
         for doc in index[term]: # [(1, 2), (3, 4), (5, 6)]
             occurences.append(doc[0])
             
     posting_list[term] = occurences
 
+# Threads reading the posting lists of disk-backed indexes, shared by all the
+# queries of the process. Created on first use, see get_fetch_executor.
+FETCH_WORKERS = 4
+fetch_executor = None
+
+def get_fetch_executor():
+    """Get the shared posting list fetching executor, creating it if needed.
+
+    Returns:
+        ThreadPoolExecutor: the executor
+    """
+    global fetch_executor
+    if fetch_executor is None:
+        fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="posting-fetch")
+    return fetch_executor
+
+def shutdown_fetch_executor():
+    """Stop the threads of the shared executor, waiting for pending fetches.
+    Called at exit, a later query creates a new executor.
+    """
+    global fetch_executor
+    if fetch_executor is not None:
+        fetch_executor.shutdown(wait=True)
+        fetch_executor = None
+
+def forget_fetch_executor():
+    # the threads of the parent are not copied into a forked child
+    global fetch_executor
+    fetch_executor = None
+
+atexit.register(shutdown_fetch_executor)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forget_fetch_executor)
+
+def fetch_doc_lists(query_terms, posting_list, index):
+    """Retrieve the posting lists of the query terms into posting_list. The
+    lists of an in-memory index are looked up directly. The ones of a
+    disk-backed index (index_store.MmapIndex) are read by the shared executor,
+    so the reads overlap with each other and with the query planning.
+
+    Args:
+        query_terms (list(str)): terms of the query
+        posting_list (dict): Posting list of terms appear in the query, filled in
+        index (dict)       : Posting lists for all terms appear in the gov data
+
+    Returns:
+        list(Future): fetches still running, wait for them before using posting_list
+    """
+    if not isinstance(index, MmapIndex):
+        for term in query_terms:
+            get_doc_list(term, posting_list, index)
+        return []
+    executor = get_fetch_executor()
+    return [executor.submit(get_doc_list, term, posting_list, index) for term in query_terms]
+
 def parse_query(query_string):
     """Parse a querry into 2 lists: 1 list of terms and 1 list of operations.
     \nReturns a tuple (terms, operations, message).
@@ -131,74 +361,457 @@ def parse_query(query_string):
         
     return (terms, ops, "OK")
 
-def run_boolean_query(query_string, index):
-    """Runs a boolean query using the index.
+# Unary operation, and brackets of the boolean query language
+NOT_OPERATION = "NOT"
+query_token_re = re.compile(r'"[^"]*"(?:~\d+)?|\(|\)|[^\s()]+')
+
+def expand_term(term, lexicon, max_expansions=MAX_EXPANSIONS):
+    """Expand a term with a * (e.g. econom*) into the OR of the matching terms.
+
+    Args:
+        term (str): the term
+        lexicon (lexicon.Lexicon): terms of the index
+        max_expansions (int): maximum number of matching terms
+
+    Returns:
+        tuple: expression tree, ("TERM", term) if no term matches
+    """
+    (terms, truncated) = lexicon.expand(term, max_expansions)
+    if truncated:
+        raise ValueError("INVALID: {t} matches more than {n} terms".format(t=term, n=max_expansions))
+    if len(terms) == 0:
+        return ("TERM", term)
+    if len(terms) == 1:
+        return ("TERM", terms[0])
+    return ("OR", [("TERM", t) for t in terms])
+
+def phrase_key(terms, slop=0):
+    """Name a phrase of processed terms, e.g. '"nuclear power plant"' or
+    '"nuclear plant"~3'. Phrases are ("TERM", key) nodes of the expression
+    trees, resolved with the positional index.
+    """
+    return '"' + " ".join(terms) + '"' + ("~{s}".format(s=slop) if slop > 0 else "")
+
+def parse_expression(query_string, lexicon=None, max_expansions=MAX_EXPANSIONS):
+    """Parse a boolean query into an expression tree. NOT binds tighter than AND,
+    which binds tighter than OR, and brackets group sub-expressions.
+    \nNodes are ("TERM", term), ("NOT", node), and ("AND", [nodes]) / ("OR", [nodes])
+    with all the operands of a chain of the same operation in one node. A quoted
+    phrase, e.g. "nuclear power plant" or "nuclear plant"~3, is a term named by phrase_key.
+    \nIf the query has been parsed successfully, the message would be "OK"
+
+    Args:
+        query_string (str): boolean query string
+        lexicon (lexicon.Lexicon): terms of the index, to expand the terms
+            with a * into the OR of the matching terms (optional)
+        max_expansions (int): maximum number of terms a term with a * expands to
+
+    Returns:
+        tuple(tree: tuple, message: str)
+    """
+    
+    tokens = query_token_re.findall(query_string)
+    pos = 0
+    
+    def is_operand_start(token):
+        return token == "(" or token == NOT_OPERATION or token not in operation_map and token != ")"
+    
+    def parse_operand():
+        nonlocal pos
+        token = tokens[pos]
+        if token == NOT_OPERATION:
+            pos += 1
+            if pos == len(tokens) or not is_operand_start(tokens[pos]):
+                raise ValueError("INVALID: Operation cannot be at the end of a query" if pos == len(tokens) else
+                                 "INVALID: 2 operations cannot appear next to each other: {prev} {cur}".format(prev=token, cur=tokens[pos]))
+            return (NOT_OPERATION, parse_operand())
+        if token == "(":
+            pos += 1
+            if pos == len(tokens):
+                raise ValueError("INVALID: Missing closing bracket")
+            if tokens[pos] == ")":
+                raise ValueError("INVALID: Empty brackets")
+            if not is_operand_start(tokens[pos]):
+                raise ValueError("INVALID: Operation cannot be at the start of brackets")
+            node = parse_binary(list(operation_priority))
+            if pos == len(tokens) or tokens[pos] != ")":
+                raise ValueError("INVALID: Missing closing bracket")
+            pos += 1
+            return node
+        if not is_operand_start(token):
+            # never a term, whatever the caller checked
+            raise ValueError("INVALID: Unexpected closing bracket" if token == ")" else
+                             "INVALID: 2 operations cannot appear next to each other: {prev} {cur}".format(prev=tokens[pos - 1], cur=token))
+        pos += 1
+        phrase = phrase_re.fullmatch(token)
+        if phrase is not None:
+            return ("TERM", phrase_key(phrase_terms(phrase.group(1)), int(phrase.group(2) or 0)))
+        if lexicon is not None and WILDCARD in token:
+            return expand_term(token.lower(), lexicon, max_expansions)
+        return ("TERM", token.lower())
+    
+    def parse_binary(ops):
+        # ops: binary operations from the loosest to the tightest binding
+        nonlocal pos
+        if len(ops) == 0:
+            return parse_operand()
+        operands = [parse_binary(ops[1:])]
+        while pos < len(tokens) and tokens[pos] == ops[0]:
+            pos += 1
+            if pos == len(tokens):
+                raise ValueError("INVALID: Operation cannot be at the end of a query")
+            if not is_operand_start(tokens[pos]):
+                raise ValueError("INVALID: 2 operations cannot appear next to each other: {prev} {cur}".format(prev=ops[0], cur=tokens[pos]))
+            operands.append(parse_binary(ops[1:]))
+        if len(operands) == 1:
+            return operands[0]
+        return (ops[0], operands)
+    
+    if len(tokens) == 0:
+        return (None, "INVALID: Empty query")
+    if tokens[0] in operation_map:
+        return (None, "INVALID: Operation cannot be at the start of a query")
+    try:
+        if not is_operand_start(tokens[0]):
+            raise ValueError("INVALID: Unexpected closing bracket")
+        tree = parse_binary(list(operation_priority))
+        if pos < len(tokens):
+            if tokens[pos] == ")":
+                raise ValueError("INVALID: Unexpected closing bracket")
+            raise ValueError("INVALID: 2 terms cannot appear next to each other: {prev} {cur}".format(prev=tokens[pos - 1], cur=tokens[pos]))
+    except ValueError as e:
+        return (None, str(e))
+    
+    return (tree, "OK")
+
+def get_query_terms(node, terms):
+    """Collect the terms of an expression tree, in order of appearance.
+
+    Args:
+        node (tuple): expression tree
+        terms (list(str)): list the terms are appended to
+    """
+    if node[0] == "TERM":
+        if node[1] not in terms:
+            terms.append(node[1])
+    elif node[0] == NOT_OPERATION:
+        get_query_terms(node[1], terms)
+    else:
+        for child in node[1]:
+            get_query_terms(child, terms)
+
+def canonicalize_query(node):
+    """Rewrite an expression tree into a canonical form, the same for all the
+    queries matching the same documents by commutativity, associativity,
+    duplicated operands and double negation, e.g. for caching the results.
+
+    Args:
+        node (tuple): expression tree
+
+    Returns:
+        tuple: the canonical expression tree (hashable)
+    """
+    if node[0] == "TERM":
+        return node
+    if node[0] == NOT_OPERATION:
+        child = canonicalize_query(node[1])
+        return child[1] if child[0] == NOT_OPERATION else (NOT_OPERATION, child)
+    
+    children = set()
+    for child in node[1]:
+        child = canonicalize_query(child)
+        if child[0] == node[0]:
+            children.update(child[1])
+        else:
+            children.add(child)
+    if len(children) == 1:
+        return children.pop()
+    return (node[0], tuple(sorted(children, key=repr)))
+
+def estimate_size(node, doc_freq, num_docs):
+    """Estimate the number of documents an expression tree matches.
+
+    Args:
+        node (tuple): expression tree
+        doc_freq (dict(str : int)): document frequency for each term
+        num_docs (int): number of documents in the corpus
+
+    Returns:
+        int: upper bound of the number of matching documents
+    """
+    if node[0] == "TERM":
+        return doc_freq.get(node[1], 0)
+    if node[0] == NOT_OPERATION:
+        return num_docs - estimate_size(node[1], doc_freq, num_docs) if num_docs is not None else 0
+    sizes = [estimate_size(child, doc_freq, num_docs) for child in node[1] if child[0] != NOT_OPERATION]
+    if node[0] == "AND":
+        # AND NOT only removes documents
+        return min(sizes) if len(sizes) > 0 else num_docs or 0
+    size = sum(estimate_size(child, doc_freq, num_docs) for child in node[1])
+    return min(size, num_docs) if num_docs is not None else size
+
+def plan_query(node, doc_freq, num_docs):
+    """Rewrite an expression tree so it can be evaluated with small intermediate
+    results: nested chains of the same operation are flattened, the operands of
+    AND are sorted from the rarest (so the first intersections shrink the result
+    the most) and the ones of OR from the smallest.
+
+    Args:
+        node (tuple): expression tree
+        doc_freq (dict(str : int)): document frequency for each term
+        num_docs (int): number of documents in the corpus
+
+    Returns:
+        tuple: the planned expression tree
+    """
+    if node[0] == "TERM":
+        return node
+    if node[0] == NOT_OPERATION:
+        child = plan_query(node[1], doc_freq, num_docs)
+        # NOT NOT x = x
+        return child[1] if child[0] == NOT_OPERATION else (NOT_OPERATION, child)
+    
+    children = []
+    for child in node[1]:
+        child = plan_query(child, doc_freq, num_docs)
+        if child[0] == node[0]:
+            children.extend(child[1])
+        else:
+            children.append(child)
+    if node[0] == "AND":
+        # negated operands last, they are subtracted from the result of the others
+        children.sort(key=lambda x: (x[0] == NOT_OPERATION, estimate_size(x, doc_freq, num_docs)))
+    else:
+        children.sort(key=lambda x: estimate_size(x, doc_freq, num_docs))
+    return (node[0], children)
+
+def and_operands(operands):
+    """Intersect doc_ids lists and bitmaps. Bitmaps are intersected with each
+    other first, then the lists, and the lists are filtered by the bitmap.
+
+    Args:
+        operands (list(list(int) or Bitmap)): asc sorted doc_ids lists and bitmaps
+
+    Returns:
+        list(int) or Bitmap: the doc_ids in all the operands (a bitmap only if
+            all the operands are bitmaps)
+    """
+    bitmaps = [operand for operand in operands if isinstance(operand, Bitmap)]
+    lists = [operand for operand in operands if not isinstance(operand, Bitmap)]
+    res_bitmap = None
+    for bitmap in bitmaps:
+        res_bitmap = bitmap if res_bitmap is None else res_bitmap & bitmap
+    if len(lists) == 0:
+        return res_bitmap
+    res = nary_operation_map["AND"](lists)
+    return res_bitmap.filter(res) if res_bitmap is not None else res
+
+def or_operands(operands):
+    """Union doc_ids lists and bitmaps.
+
+    Args:
+        operands (list(list(int) or Bitmap)): asc sorted doc_ids lists and bitmaps
+
+    Returns:
+        list(int) or Bitmap: the doc_ids in any of the operands (a bitmap if
+            any of the operands is a bitmap)
+    """
+    bitmaps = [operand for operand in operands if isinstance(operand, Bitmap)]
+    lists = [operand for operand in operands if not isinstance(operand, Bitmap)]
+    if len(bitmaps) == 0:
+        return nary_operation_map["OR"](lists)
+    res = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        res = res | bitmap
+    if len(lists) > 0:
+        res = res | Bitmap.from_doc_ids(nary_operation_map["OR"](lists))
+    return res
+
+def subtract_operand(operand1, operand2):
+    """Get the doc_ids of operand1 which are not in operand2, for doc_ids lists
+    and bitmaps.
+
+    Args:
+        operand1 (list(int) or Bitmap): asc sorted doc_ids or bitmap
+        operand2 (list(int) or Bitmap): asc sorted doc_ids or bitmap
+
+    Returns:
+        list(int) or Bitmap: a bitmap if operand1 is one
+    """
+    if isinstance(operand1, Bitmap):
+        return operand1 - (operand2 if isinstance(operand2, Bitmap) else Bitmap.from_doc_ids(operand2))
+    if isinstance(operand2, Bitmap):
+        if isinstance(operand1, range) and operand1.start == 0 and operand1.step == 1:
+            # NOT of a bitmap over all the documents
+            return Bitmap.from_range(operand1.stop) - operand2
+        return operand2.exclude(operand1)
+    return difference_query(operand1, operand2)
+
+def evaluate_query(node, posting_list, all_doc_ids):
+    """Evaluate a (planned) expression tree. An AND stops as soon as its result
+    is empty.
+
+    Args:
+        node (tuple): expression tree
+        posting_list (dict(str : list(int) or Bitmap)): doc_ids of the terms of the query
+        all_doc_ids (list(int)): asc sorted doc_ids of every document, used by NOT
+
+    Returns:
+        list(int) or Bitmap: asc sorted doc_ids matching the expression
+    """
+    if node[0] == "TERM":
+        return posting_list.get(node[1], [])
+    if node[0] == NOT_OPERATION:
+        return subtract_operand(all_doc_ids, evaluate_query(node[1], posting_list, all_doc_ids))
+    
+    if node[0] not in nary_operation_map:
+        raise Exception("Please makse sure that you've added this operation to nary_operation_map")
+    
+    if node[0] == "AND":
+        # all the term operands are intersected in one pass, sub-expressions are
+        # only evaluated while the result isn't empty
+        terms = [posting_list.get(child[1], []) for child in node[1] if child[0] == "TERM"]
+        others = [child for child in node[1] if child[0] != "TERM" and child[0] != NOT_OPERATION]
+        negatives = [child[1] for child in node[1] if child[0] == NOT_OPERATION]
+        if len(terms) > 0:
+            res = and_operands(terms)
+        elif len(others) > 0:
+            res = evaluate_query(others.pop(0), posting_list, all_doc_ids)
+        else:
+            res = all_doc_ids
+        for child in others:
+            if not res:
+                return []
+            res = and_operands([res, evaluate_query(child, posting_list, all_doc_ids)])
+        for child in negatives:
+            if not res:
+                return []
+            res = subtract_operand(res, evaluate_query(child, posting_list, all_doc_ids))
+        return res if isinstance(res, Bitmap) else list(res)
+    
+    operands = [evaluate_query(child, posting_list, all_doc_ids) for child in node[1]]
+    if node[0] == "OR":
+        return or_operands(operands)
+    return nary_operation_map[node[0]](operands)
+
+def run_boolean_query(query_string, index, doc_freq=None, num_docs=None, all_doc_ids=None, bitmaps=None, cache=None,
+                      lexicon=None, max_expansions=MAX_EXPANSIONS, positions=None):
+    """Runs a boolean query using the index. AND, OR and NOT follow the usual
+    precedence and can be grouped with brackets. The query is planned with the
+    document frequencies so the intermediate results stay small.
 
     Args:
         query_string (str): boolean query string
         index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        doc_freq (dict(str : int)): document frequency for each term (optional, for planning)
+        num_docs (int): number of documents in the corpus (needed by NOT)
+        all_doc_ids (list(int)): asc sorted doc_ids NOT is taken against
+            (default: range(num_docs))
+        bitmaps (dict(str : Bitmap)): bitmaps of the frequent terms, used instead
+            of their posting lists (optional, see bitmap.build_bitmaps)
+        cache (query_cache.QueryResultCache): results of the previous queries,
+            keyed on the canonical expression tree (optional)
+        lexicon (lexicon.Lexicon): terms of the index, for the terms with a *
+            (optional, see parse_expression)
+        max_expansions (int): maximum number of terms a term with a * expands to
+        positions (positions.PositionalIndex): positions of the terms, for the
+            quoted phrases (optional)
 
     Returns:
         list(int): a list of doc_ids which are relevant to the query
     """
     
     posting_list = {}
-    query_terms = []
-    ops = []
     
-    if(query_string == ""):
+    if(query_string.strip() == ""):
         return []
     
-    (query_terms, ops, msg) =  parse_query(query_string)
+    with instrument.stage("query.parse"):
+        (tree, msg) = parse_expression(query_string, lexicon, max_expansions)
     if(msg != "OK"):
         return [msg]
+    
+    if all_doc_ids is None and num_docs is not None:
+        all_doc_ids = range(num_docs)
+    if all_doc_ids is None and NOT_OPERATION in query_token_re.findall(query_string):
+        return ["INVALID: NOT needs the number of documents"]
+    
+    if cache is not None:
+        key = ("boolean", canonicalize_query(tree), len(all_doc_ids) if all_doc_ids is not None else None)
+        res = cache.get(key)
+        if res is not None:
+            return res
+        res = run_boolean_query(query_string, index, doc_freq, num_docs, all_doc_ids, bitmaps,
+                                lexicon=lexicon, max_expansions=max_expansions, positions=positions)
+        cache.put(key, res)
+        return res
+    
+    query_terms = []
+    get_query_terms(tree, query_terms)
+    
+    # Match the phrases, only verifying the positions of the documents with all their terms
+    phrases = [term for term in query_terms if phrase_re.fullmatch(term)]
+    if len(phrases) > 0:
+        if positions is None:
+            return ["INVALID: Phrases need a positional index"]
+        with instrument.stage("query.phrase"):
+            for phrase in phrases:
+                m = phrase_re.fullmatch(phrase)
+                posting_list[phrase] = match_phrase(m.group(1).split(), positions, int(m.group(2) or 0))
+        query_terms = [term for term in query_terms if term not in posting_list]
               
-    # Concurrently retrieve document list corresponding to each query term
-    core_num = os.cpu_count()
-    if(core_num == None): core_num = 4
-    pool = ThreadPool(core_num)
-    args = []
-    for term in query_terms:
-        args.append((term, posting_list, index))
-    pool.starmap(get_doc_list, args)
-    
-    # If there is only 1 term, then we only need to find occurences of that term
-    if(1 == len(query_terms)):
-        return posting_list[query_terms[0]]
-    
-    # As there is no procedence and bracket, we will save results obtained from previous queries to list1
-    list1 = posting_list[query_terms[0]]
-    list2 = posting_list[query_terms[1]]
-    operation = ops.pop(0)
-    if operation not in operation_map:
-        raise Exception("Please makse sure that you've added this operation to operation_map")
-    # Invoke the corresponding operation
-    list1 = operation_map[operation](list1, list2)
-    
-    for i in range(2, len(query_terms)):
-        list2 = posting_list[query_terms[i]]
-        operation = ops.pop(0)
-        if operation not in operation_map:
-            raise Exception("Please makse sure that you've added this operation to operation_map")
-        list1 = operation_map[operation](list1, list2)
-        
-    return list1
+    # Retrieve document list corresponding to each query term
+    if bitmaps is not None:
+        for term in query_terms:
+            if term in bitmaps:
+                posting_list[term] = bitmaps[term]
+        query_terms = [term for term in query_terms if term not in posting_list]
+    with instrument.stage("query.fetch"):
+        pending = fetch_doc_lists(query_terms, posting_list, index)
+    
+    if doc_freq is None:
+        with instrument.stage("query.fetch"):
+            for fetch in pending:
+                fetch.result()
+        doc_freq = {term: len(doc_list) for (term, doc_list) in posting_list.items()}
+    with instrument.stage("query.plan"):
+        tree = plan_query(tree, doc_freq, num_docs if num_docs is not None else len(all_doc_ids or []))
+    
+    # the fetches still running overlap with the planning
+    with instrument.stage("query.fetch"):
+        for fetch in pending:
+            fetch.result()
+    with instrument.stage("query.evaluate"):
+        res = evaluate_query(tree, posting_list, all_doc_ids)
+        return res.to_list() if isinstance(res, Bitmap) else res
 
 #############  ADD OPERATION  ##############
 
-operation_map["AND"] = intersect_query
+operation_map["AND"] = intersect_adaptive
 operation_map["OR"] = union_query
 
+# Operations merging all the operands of a chain at once, used by evaluate_query
+nary_operation_map = {}
+nary_operation_map["AND"] = intersect_many
+nary_operation_map["OR"] = union_many
+
+# from the loosest to the tightest binding operation
+operation_priority = ["OR", "AND"]
+
 ############################################
 
 if __name__ == '__main__':
     # load the stored index
-    (index, doc_freq, doc_ids, num_docs) = pickle.load(open("stored_index.pkl", "rb"))
+    (index, doc_freq, doc_ids, num_docs) = open_stored_index()
+    bitmaps = load_bitmaps(stored_index_path())
+    # without a stored lexicon, one is only built for the first query with a *
+    lexicon = load_lexicon(stored_index_path())
+    positions = load_positions(stored_index_path())
 
     print("Index length:", len(index))
     if len(index) != 808777:
         print("Warning: the length of the index looks wrong.")
-        print("Make sure you are using `process_tokens_original` when you build the index.")
+        print('Make sure string_processing.ACTIVE_VARIANT is "original" when you build the index.')
         raise Exception()
 
     # the list of queries asked for in the assignment text
@@ -212,13 +825,18 @@ if __name__ == '__main__':
     ]
 
     # run each of the queries and print the result
-    ids_to_doc = {docid: path for (path, docid) in doc_ids.items()}
+    ids_to_doc = DocPaths(doc_ids)
     for query_string in queries:
         print(query_string)
-        doc_list = run_boolean_query(query_string, index)
+        if lexicon is None and WILDCARD in query_string:
+            lexicon = Lexicon(index)
+        start = time.perf_counter()
+        doc_list = run_boolean_query(query_string, index, doc_freq, num_docs, bitmaps=bitmaps, lexicon=lexicon,
+                                     positions=positions)
+        instrument.observe("query_seconds", time.perf_counter() - start)
         
         # Handle invalid queries
-        if isinstance(doc_list[0], str):
+        if len(doc_list) > 0 and isinstance(doc_list[0], str):
             print(doc_list[0])
         else:
             res = sorted([ids_to_doc[docid] for docid in doc_list])
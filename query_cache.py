@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from query import (
+    get_query_tokens,
+    count_query_tokens,
+)
+from positions import split_phrases
+
+# Default number of query results remembered by a cache
+QUERY_CACHE_SIZE = 4096
+
+
+class QueryResultCache:
+    """Bounded LRU cache of query results. Queries are keyed on their
+    normalized form, so differently worded queries with the same processed
+    terms share an entry, and the entries are dropped when the index changes.
+    """
+
+    def __init__(self, maxsize=QUERY_CACHE_SIZE, index_version=None):
+        """
+        Args:
+            maxsize (int): maximum number of cached results
+            index_version: identifies the index the results are computed on,
+                e.g. doc_norms.index_fingerprint of the stored index
+        """
+        self.maxsize = maxsize
+        self.index_version = index_version
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def set_index_version(self, index_version):
+        """Set the version of the index the next queries run on, dropping all
+        the entries if it changed.
+        """
+        if index_version != self.index_version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.index_version = index_version
+
+    def get(self, key):
+        """Look a result up.
+
+        Args:
+            key (tuple): normalized query, see ranked_query_key and
+                query_boolean.canonicalize_query
+
+        Returns:
+            list: a copy of the cached result, or None if not cached
+        """
+        res = self.entries.get(key)
+        if res is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(res)
+
+    def put(self, key, res):
+        """Store a result, evicting the least recently used one if the cache is full.
+
+        Args:
+            key (tuple): normalized query
+            res (list): the result of the query
+        """
+        self.entries[key] = list(res)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all the entries and reset the statistics."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        """Get the hit/miss statistics.
+
+        Returns:
+            dict(str : int or float): hits, misses, evictions, invalidations, size, maxsize and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+def ranked_query_key(query_string, k=None, namespace=""):
+    """Normalize a ranked query into a cache key.
+
+    Args:
+        query_string (str): the query string
+        k (int): number of documents retrieved
+        namespace (str): identifies the scoring function, e.g. its name
+
+    Returns:
+        tuple: (namespace, sorted (term, term frequency) pairs, sorted (phrase
+            terms, slop) pairs of the quoted phrases, k)
+    """
+    query_token_counts = count_query_tokens(get_query_tokens(query_string))
+    # the quotes are stripped with the punctuation, but the phrases filter the documents
+    (_, phrases) = split_phrases(query_string)
+    phrases = sorted((tuple(terms), slop) for (terms, slop) in phrases)
+    return (namespace, tuple(sorted(query_token_counts)), tuple(phrases), k)
+
+
+def cached_query_func(query_func, cache, namespace=None):
+    """Wrap a ranked query function, e.g. query_tfidf.run_query, so that its
+    results are looked up in a cache first. Queries with the same processed
+    terms share an entry: documents with equal scores may come in another
+    order than a fresh run of a differently worded query would give.
+
+    Args:
+        query_func (callable): called as query_func(query_string, index, doc_freq, doc_norm, num_docs, k=k)
+        cache (QueryResultCache): the cache, its index_version has to be kept up to date
+        namespace (str): identifies query_func in the keys (default: its module and name)
+
+    Returns:
+        callable: the function with the same arguments as query_func
+    """
+    if namespace is None:
+        namespace = getattr(query_func, "__module__", "") + "." + getattr(query_func, "__qualname__", repr(query_func))
+
+    def run_cached_query(query_string, index, doc_freq, doc_norm, num_docs, k=None):
+        key = ranked_query_key(query_string, k, namespace)
+        res = cache.get(key)
+        if res is None:
+            res = query_func(query_string, index, doc_freq, doc_norm, num_docs, k=k)
+            cache.put(key, res)
+        return res
+
+    return run_cached_query
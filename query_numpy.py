@@ -0,0 +1,195 @@
+import math
+import argparse
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+from query import (
+    get_query_tokens,
+    count_query_tokens,
+    query_main,
+)
+from query_tfidf import calc_idf
+import query
+import query_tfidf
+
+# Default number of posting lists kept as arrays by an ArrayIndex
+ARRAY_CACHE_SIZE = 1024
+
+
+class ArrayIndex(Mapping):
+    """View of an index whose posting lists are parallel numpy arrays of int32
+    doc_ids and uint32 term frequencies. Lists are converted on first use and
+    the most recently used ones are kept in a bounded LRU cache; the lists of
+    a binary index (index_store.MmapIndex) are wrapped without copying.
+    """
+
+    def __init__(self, index, maxsize=ARRAY_CACHE_SIZE):
+        """
+        Args:
+            index (dict(str : list(tuple(int, int)))): the index, or an MmapIndex
+            maxsize (int): maximum number of posting lists kept as arrays
+        """
+        self.index = index
+        self.maxsize = maxsize
+        self.arrays = OrderedDict()
+
+    def get_arrays(self, term):
+        """Get the posting list of a term as arrays.
+
+        Args:
+            term (str): a term of the index
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): (doc_ids, term_frequencies)
+        """
+        arrays = self.arrays.get(term)
+        if arrays is not None:
+            self.arrays.move_to_end(term)
+            return arrays
+        if hasattr(self.index, "find"):
+            (doc_ids, tfs) = self.index.arrays_at(self.index.find(term))
+            arrays = (np.frombuffer(doc_ids, dtype=np.uint32).view(np.int32), np.frombuffer(tfs, dtype=np.uint32))
+        else:
+            postings = np.array(self.index[term], dtype=np.int64).reshape(-1, 2)
+            arrays = (postings[:, 0].astype(np.int32), postings[:, 1].astype(np.uint32))
+        if self.maxsize > 0:
+            self.arrays[term] = arrays
+            if len(self.arrays) > self.maxsize:
+                self.arrays.popitem(last=False)
+        return arrays
+
+    def __getitem__(self, term):
+        return self.index[term]
+
+    def __contains__(self, term):
+        return term in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def build_array_index(index, maxsize=ARRAY_CACHE_SIZE):
+    """Wrap an index for the numpy scorer, see ArrayIndex."""
+    return index if isinstance(index, ArrayIndex) else ArrayIndex(index, maxsize)
+
+
+def norm_array(doc_norm, num_docs):
+    """Get the document norms as a dense float64 array indexed by doc_id.
+
+    Args:
+        doc_norm (dict(int : float) or array(float)): pre-computed document norms
+        num_docs (int): number of documents in the corpus
+
+    Returns:
+        np.ndarray: the norms (zero-copy for the arrays stored by the indexer)
+    """
+    if isinstance(doc_norm, np.ndarray):
+        return doc_norm
+    if isinstance(doc_norm, Mapping):
+        norms = np.zeros(num_docs, dtype=np.float64)
+        for (docid, norm) in doc_norm.items():
+            norms[docid] = norm
+        return norms
+    return np.frombuffer(doc_norm, dtype=np.float64)
+
+
+def run_query(query_string, index, doc_freq, doc_norm, num_docs, k=None, weighting="tfidf", lexicon=None,
+              positions=None):
+    """Run a query with vectorized scoring and return a sorted list of documents.
+    Scores are added up per query term into a dense accumulator of num_docs
+    floats, with the same operations in the same order as the pure Python
+    scorers, and the top-k is selected with argpartition.
+
+    Args:
+        query_string (str): the query string
+        index (ArrayIndex): the index, see build_array_index (other indexes are wrapped)
+        doc_freq (dict(str : int)): document frequency for each term
+        doc_norm (dict(int : float) or array(float)): pre-computed document norms
+        num_docs (int): number of documents in the corpus
+        k (int): only return the k most similar documents (default: all of them)
+        weighting (str): "tfidf" to rank like query_tfidf.run_query, "tf" like query.run_query
+        lexicon (lexicon.Lexicon): terms of the index, for the query tokens
+            with a * (optional, see query.get_query_tokens)
+        positions (positions.PositionalIndex): positions of the terms, to only
+            keep the documents containing the quoted phrases of the query (optional).
+            With a lexicon or positions, the query runs on the pure Python scorer.
+
+    Returns:
+        list(tuple(int, float)): a list of document ids and the similarity scores with the query
+        sorted so that the most similar documents to the query are at the top.
+    """
+    if lexicon is not None or positions is not None:
+        # wildcards and phrases are only handled by the pure Python scorers
+        scorer = query_tfidf.run_query if weighting == "tfidf" else query.run_query
+        return scorer(query_string, index, doc_freq, doc_norm, num_docs, k=k, lexicon=lexicon, positions=positions)
+
+    index = build_array_index(index)
+    norms = norm_array(doc_norm, num_docs)
+
+    qt = get_query_tokens(query_string)
+    query_token_counts = [(term, tf) for (term, tf) in count_query_tokens(qt) if term in index]
+    if len(query_token_counts) == 0:
+        return []
+
+    # query weights, and the norm of the query vector
+    weights = []
+    query_norm = 0.0
+    for (term, tf) in query_token_counts:
+        idf = calc_idf(doc_freq[term], num_docs) if weighting == "tfidf" else 1
+        weights.append((tf * idf, idf))
+        query_norm += (tf * idf)**2
+    query_norm = math.sqrt(query_norm)
+
+    scores = np.zeros(num_docs, dtype=np.float64)
+    # position of the first query term containing each document, for run_query's tie order
+    first_term = np.full(num_docs, len(query_token_counts), dtype=np.int32)
+    for (qi, (term, tf)) in enumerate(query_token_counts):
+        (doc_ids, tfs) = index.get_arrays(term)
+        (weight_query, idf) = weights[qi]
+        if weighting == "tfidf":
+            contribs = (weight_query * (tfs * idf)) / (norms[doc_ids] * query_norm)
+        else:
+            contribs = (weight_query * tfs.astype(np.float64)) / (norms[doc_ids] * query_norm)
+        # doc_ids are unique within a posting list, so a fancy-indexed add is a scatter-add
+        scores[doc_ids] += contribs
+        first_term[doc_ids] = np.minimum(first_term[doc_ids], qi)
+
+    candidates = np.flatnonzero(first_term < len(query_token_counts))
+    candidate_scores = scores[candidates]
+    if k is not None and k < len(candidates):
+        # everything scoring at least the k-th score, so ties at the boundary are kept
+        kth = candidate_scores[np.argpartition(-candidate_scores, k - 1)[k - 1]]
+        candidates = candidates[candidate_scores >= kth]
+        candidate_scores = scores[candidates]
+    order = np.lexsort((candidates, first_term[candidates], -candidate_scores))
+    if k is not None:
+        order = order[:k]
+
+    return list(zip(candidates[order].tolist(), candidate_scores[order].tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the evaluation queries with the numpy scorer")
+    parser.add_argument("--weighting", choices=["tfidf", "tf"], default="tfidf")
+    parser.add_argument("--k", type=int, default=None,
+                        help="number of documents retrieved for each query (default: all of them)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes running the evaluation queries (0: number of CPUs)")
+    parser.add_argument("--array-cache-size", type=int, default=ARRAY_CACHE_SIZE,
+                        help="number of posting lists kept as arrays (0: convert them on every use)")
+    args = parser.parse_args()
+
+    queries = [
+        'Is nuclear power plant eco-friendly?',
+        'How to stay safe during severe weather?',
+    ]
+    doc_norm_func = query_tfidf.get_doc_to_norm if args.weighting == "tfidf" else query.get_doc_to_norm
+    def query_func(*query_args, **query_kwargs):
+        return run_query(*query_args, weighting=args.weighting, **query_kwargs)
+    def index_func(index):
+        return build_array_index(index, args.array_cache_size)
+    query_main(queries=queries, query_func=query_func, doc_norm_func=doc_norm_func, k=args.k,
+               index_func=index_func, workers=args.workers or None)
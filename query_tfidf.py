@@ -1,4 +1,7 @@
 import math
+import heapq
+import argparse
+from bisect import bisect_left
 from collections import defaultdict
 from string_processing import (
     run_normalization,
@@ -8,7 +11,25 @@ from query import (
     get_query_tokens,
     count_query_tokens,
     query_main,
+    top_k,
 )
+from index_store import stored_index_path
+from doc_norms import (
+    index_fingerprint,
+    load_doc_norms,
+)
+from query_cache import (
+    QueryResultCache,
+    cached_query_func,
+)
+from lexicon import load_lexicon
+from positions import (
+    phrase_re,
+    split_phrases,
+    phrase_filter,
+    load_positions,
+)
+import instrument
 
 def calc_idf(df, num_docs):
     """Calculate IDF of a particular term
@@ -47,8 +68,10 @@ def get_doc_to_norm(index, doc_freq, num_docs):
 
     return doc_norms
 
+get_doc_to_norm.norm_variant = "tfidf"
+
 
-def run_query(query_string, index, doc_freq, doc_norm, num_docs):
+def run_query(query_string, index, doc_freq, doc_norm, num_docs, k=None, lexicon=None, positions=None):
     """ Run a query on the index and return a sorted list of documents. 
     Sorted by most similar to least similar.
     Documents not returned in the sorted list are assumed to have 0 similarity.
@@ -59,6 +82,11 @@ def run_query(query_string, index, doc_freq, doc_norm, num_docs):
         doc_freq (dict(str : int)): document frequency for each term
         doc_norm (dict(int : float)): a map from doc_ids to pre-computed document norms
         num_docs (int): number of documents in the corpus
+        k (int): only return the k most similar documents (default: all of them)
+        lexicon (lexicon.Lexicon): terms of the index, for the query tokens
+            with a * (optional, see query.get_query_tokens)
+        positions (positions.PositionalIndex): positions of the terms, to only
+            keep the documents containing the quoted phrases of the query (optional)
 
     Returns:
         list(tuple(int, float)): a list of document ids and the similarity scores with the query
@@ -66,9 +94,13 @@ def run_query(query_string, index, doc_freq, doc_norm, num_docs):
     """
 
     sorted_docs = []
+    phrases = []
+    if positions is not None:
+        (query_string, phrases) = split_phrases(query_string)
     
     # preprocess the query string
-    qt = get_query_tokens(query_string)
+    with instrument.stage("query.normalize"):
+        qt = get_query_tokens(query_string, lexicon)
     
     # calculate norm of the query
     query_norm = 0.0
@@ -90,22 +122,222 @@ def run_query(query_string, index, doc_freq, doc_norm, num_docs):
         if term not in index:
             continue
         else:
-            for (doc_id, tf_doc) in index[term]:
-                idf = calc_idf(doc_freq[term], num_docs)
-                
-                tfidf_query = tf_query * idf
-                tfidf_doc = tf_doc * idf
-                
-                doc_to_score[doc_id] += ((tfidf_query * tfidf_doc) / (doc_norm[doc_id] * query_norm))
+            with instrument.stage("query.fetch"):
+                postings = index[term]
+            with instrument.stage("query.score"):
+                for (doc_id, tf_doc) in postings:
+                    idf = calc_idf(doc_freq[term], num_docs)
+                    
+                    tfidf_query = tf_query * idf
+                    tfidf_doc = tf_doc * idf
+                    
+                    doc_to_score[doc_id] += ((tfidf_query * tfidf_doc) / (doc_norm[doc_id] * query_norm))
     
-    sorted_docs = sorted(doc_to_score.items(), key=lambda x:-x[1])
+    if len(phrases) > 0:
+        with instrument.stage("query.phrase"):
+            allowed = phrase_filter(phrases, positions)
+            doc_to_score = {doc_id: score for (doc_id, score) in doc_to_score.items() if doc_id in allowed}
+    
+    with instrument.stage("query.sort"):
+        sorted_docs = top_k(doc_to_score, k)
         
     return sorted_docs
 
 
+def get_term_upper_bound(term, index, doc_norm):
+    """Largest tf / doc_norm over the postings of a term. Used when the bounds
+    stored by the indexer are not available.
+
+    Args:
+        term (str): the term
+        index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        doc_norm (dict(int : float)): a map from doc_ids to pre-computed document norms
+
+    Returns:
+        float: upper bound of tf / norm for the term
+    """
+    return max((tf / doc_norm[doc_id] for (doc_id, tf) in index[term] if doc_norm[doc_id] > 0), default=0.0)
+
+
+def run_query_maxscore(query_string, index, doc_freq, doc_norm, num_docs, k=None, term_bounds=None, lexicon=None,
+                       positions=None):
+    """ Run a query with MaxScore pruning. Returns exactly the same top-k as
+    run_query, without reading most of the long posting lists of low-idf terms.
+
+    The query terms are sorted by the largest score they can add to a document.
+    The lists of the terms with the largest bounds are accumulated first, until
+    the bounds of the remaining (non-essential) terms add up to less than the
+    k-th best partial score: no other document can enter the top-k. The
+    remaining candidates are then scored document-at-a-time by binary searching
+    the non-essential lists, largest bound first, and dropped as soon as they
+    can't reach the k-th best score any more.
+
+    Args:
+        query_string (str): the query string
+        index (dict(str : list(tuple(int, int)))): The index aka dictionary of posting lists
+        doc_freq (dict(str : int)): document frequency for each term
+        doc_norm (dict(int : float)): a map from doc_ids to pre-computed document norms
+        num_docs (int): number of documents in the corpus
+        k (int): only return the k most similar documents (default: all of them,
+            which can't be pruned and is left to run_query, like k <= 0)
+        term_bounds (dict(str : float)): upper bound of tf / doc_norm for each
+            term, stored by the indexer (computed for the query terms if not given)
+        lexicon (lexicon.Lexicon): terms of the index, for the query tokens
+            with a * (optional, see query.get_query_tokens)
+        positions (positions.PositionalIndex): positions of the terms, for the
+            quoted phrases (optional, such queries are left to run_query)
+
+    Returns:
+        list(tuple(int, float)): a list of document ids and the similarity scores with the query
+        sorted so that the most similar documents to the query are at the top.
+    """
+    if positions is not None and phrase_re.search(query_string):
+        # the phrases filter the documents after scoring, which can't be pruned
+        return run_query(query_string, index, doc_freq, doc_norm, num_docs, k, lexicon=lexicon, positions=positions)
+    qt = get_query_tokens(query_string, lexicon)
+    query_token_counts = count_query_tokens(qt)
+
+    query_norm = 0.0
+    for (term, tf) in query_token_counts:
+        if term in index:
+            idf = calc_idf(doc_freq[term], num_docs)
+            query_norm += (tf * idf)**2
+    query_norm = math.sqrt(query_norm)
+
+    if k is None or k <= 0 or query_norm == 0:
+        return run_query(query_string, index, doc_freq, doc_norm, num_docs, k, lexicon=lexicon)
+
+    # one entry per query term in the index, with its position in the query (qi)
+    terms = []
+    for (term, tf_query) in query_token_counts:
+        if term not in index:
+            continue
+        idf = calc_idf(doc_freq[term], num_docs)
+        bound = term_bounds[term] if term_bounds is not None else get_term_upper_bound(term, index, doc_norm)
+        # inflate the bound a little so rounding can't make it too tight
+        bound = bound * tf_query * idf * idf / query_norm * (1 + 1e-9) + 1e-12
+        terms.append((len(terms), tf_query * idf, idf, index[term], bound))
+
+    # essential terms: largest bounds first, until the others can't add a new document
+    terms.sort(key=lambda x: -x[4])
+    remaining = sum(t[4] for t in terms)
+    partial_scores = defaultdict(float)
+    threshold = 0.0
+    num_essential = 0
+    for (qi, tfidf_query, idf, postings, bound) in terms:
+        for (doc_id, tf_doc) in postings:
+            partial_scores[doc_id] += (tfidf_query * (tf_doc * idf)) / (doc_norm[doc_id] * query_norm)
+        num_essential += 1
+        remaining -= bound
+        if len(partial_scores) >= k:
+            # partial scores only grow, the k-th one is a lower bound of the final k-th score
+            threshold = heapq.nlargest(k, partial_scores.values())[-1] * (1 - 1e-12)
+            if remaining < threshold:
+                break
+
+    # min-heap of (score, -qi, -doc_id, doc_id): the root is the worst of the top-k,
+    # ties broken like run_query, by first query term then by doc_id
+    top = []
+    essential = sorted(terms[:num_essential], key=lambda x: x[0])
+    non_essential = terms[num_essential:]
+    cum_bounds = [0.0] * (len(non_essential) + 1)
+    for i in range(len(non_essential) - 1, -1, -1):
+        cum_bounds[i] = cum_bounds[i + 1] + non_essential[i][4]
+    cursors = [0] * len(terms)
+
+    for doc_id in sorted(partial_scores):
+        partial = partial_scores[doc_id]
+        if partial + cum_bounds[0] < threshold:
+            continue
+
+        # probe the non-essential terms while the document can still make it
+        contribs = {}
+        pruned = False
+        for (i, (qi, tfidf_query, idf, postings, bound)) in enumerate(non_essential):
+            if partial + cum_bounds[i] < threshold:
+                pruned = True
+                break
+            pos = bisect_left(postings, (doc_id,), cursors[qi])
+            cursors[qi] = pos
+            if pos < len(postings) and postings[pos][0] == doc_id:
+                contribs[qi] = (tfidf_query * (postings[pos][1] * idf)) / (doc_norm[doc_id] * query_norm)
+                partial += contribs[qi]
+        if pruned:
+            continue
+
+        for (qi, tfidf_query, idf, postings, bound) in essential:
+            pos = bisect_left(postings, (doc_id,), cursors[qi])
+            cursors[qi] = pos
+            if pos < len(postings) and postings[pos][0] == doc_id:
+                contribs[qi] = (tfidf_query * (postings[pos][1] * idf)) / (doc_norm[doc_id] * query_norm)
+
+        # same additions in the same order as run_query, for the exact same score
+        score = 0.0
+        for qi in sorted(contribs):
+            score += contribs[qi]
+        entry = (score, -min(contribs), -doc_id, doc_id)
+
+        if len(top) < k:
+            heapq.heappush(top, entry)
+        elif entry > top[0]:
+            heapq.heapreplace(top, entry)
+        if len(top) == k:
+            threshold = max(threshold, top[0][0] * (1 - 1e-12))
+
+    return [(doc_id, score) for (score, _, _, doc_id) in sorted(top, reverse=True)]
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the evaluation queries with TF-IDF ranking")
+    parser.add_argument("--k", type=int, default=None,
+                        help="number of documents retrieved for each query (default: all of them)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes running the evaluation queries (0: number of CPUs)")
+    parser.add_argument("--maxscore", action="store_true",
+                        help="use MaxScore pruning (needs --k)")
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="cache the results of this many queries (default: no cache)")
+    parser.add_argument("--wildcards", action="store_true",
+                        help="expand the query words with a * (e.g. econom*) with the lexicon stored by indexer.py --lexicon")
+    parser.add_argument("--phrases", action="store_true",
+                        help="only keep the documents containing the quoted phrases of the queries, with the "
+                             "positions stored by indexer.py --positions")
+    parser.add_argument("--profile", default=None,
+                        help="time each query stage and write the report to this file (.prom: Prometheus text, else JSON)")
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
     queries = [
         'Is nuclear power plant eco-friendly?',
         'How to stay safe during severe weather?',
     ]
-    query_main(queries=queries, query_func=run_query, doc_norm_func=get_doc_to_norm)
+    lexicon = None
+    if args.wildcards:
+        lexicon = load_lexicon(stored_index_path())
+        if lexicon is None:
+            raise Exception("No lexicon stored for this index, run indexer.py with --lexicon")
+    positions = None
+    if args.phrases:
+        positions = load_positions(stored_index_path())
+        if positions is None:
+            raise Exception("No positions stored for this index, run indexer.py with --positions")
+    def query_func(*query_args, **query_kwargs):
+        return run_query(*query_args, lexicon=lexicon, positions=positions, **query_kwargs)
+    if args.maxscore:
+        term_bounds = load_doc_norms("tfidf_bounds", stored_index_path())
+        def query_func(*query_args, **query_kwargs):
+            return run_query_maxscore(*query_args, term_bounds=term_bounds, lexicon=lexicon, positions=positions,
+                                      **query_kwargs)
+    cache = None
+    if args.cache_size > 0:
+        cache = QueryResultCache(args.cache_size, index_fingerprint(stored_index_path()))
+        query_func = cached_query_func(query_func, cache)
+    query_main(queries=queries, query_func=query_func, doc_norm_func=get_doc_to_norm, k=args.k,
+               workers=args.workers or None)
+    if cache is not None:
+        # with several workers, each process has its own cache
+        print("Query cache:", cache.stats())
+    if args.profile is not None:
+        # with several workers, only the stages of this process are reported
+        instrument.write_report(args.profile)
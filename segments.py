@@ -0,0 +1,640 @@
+import os
+import math
+import time
+import pickle
+import argparse
+import threading
+from array import array
+from contextlib import contextmanager
+from collections.abc import Mapping
+from index_store import (
+    SEGMENTS_MANIFEST_PATH,
+    built_index_path,
+    open_stored_index,
+)
+from indexer import (
+    gov_list_docs,
+    build_index_streaming,
+)
+from doc_norms import (
+    index_fingerprint,
+    compute_doc_norms,
+    compute_term_upper_bounds,
+    save_doc_norms,
+    load_doc_norms,
+)
+from query_tfidf import calc_idf
+
+try:
+    import fcntl
+except ImportError:
+    # no lock between processes on Windows, only between threads
+    fcntl = None
+
+# An index made of immutable segments, for adding and deleting documents
+# without rebuilding everything:
+#   segments/seg_NNNNNN.pkl : pickled dict with the "index", "doc_freq" and
+#                             "paths" (local doc_id -> path) of a segment
+#   segments/seg_NNNNNN.terms.pkl : the terms of each document of the segment,
+#                             read when one of its documents is deleted
+#   segments/manifest.pkl   : the live segments, their deleted local doc_ids
+#                             (tombstones), the document frequencies of their
+#                             deleted documents and where each path is indexed
+#   segments/manifest.lock  : locked while a process changes the manifest
+#   segments/stored_norms.pkl : the norms of the live documents, see doc_norms.py
+# Segments are never modified: deleting a document adds a tombstone, updating
+# one deletes it and adds it to a new segment. The manifest is replaced
+# atomically, so readers always see a consistent set of segments. Adding and
+# deleting documents only costs as much as the documents changed; the norms,
+# which depend on the idf of every term, are computed afterwards over the whole
+# collection by the background thread (see SegmentManager.refresh_norms).
+SEGMENTS_DIR = os.path.dirname(SEGMENTS_MANIFEST_PATH)
+
+# Merge policy: segments are grouped in tiers of MERGE_FACTOR times more
+# documents, and MERGE_FACTOR segments of the same tier are merged into one.
+# A segment with more than MAX_DELETED_RATIO of its documents deleted is
+# rewritten without them.
+MERGE_FACTOR = 4
+MAX_DELETED_RATIO = 0.5
+
+
+def write_segment(index, doc_freq, paths, segment_path):
+    """Store a segment.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): the index of the segment, with local doc_ids
+        doc_freq (dict(str : int)): document frequency for each term in the segment
+        paths (list(str)): path of each local doc_id
+        segment_path (str): path of the segment file
+    """
+    write_pickle(doc_terms_path(segment_path), build_doc_terms(index, len(paths)))
+    write_pickle(segment_path, {"index": index, "doc_freq": doc_freq, "paths": paths})
+
+
+def write_pickle(path, obj):
+    """Atomically replace a file with a pickled object."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_segment(segment_path):
+    """Load a segment stored by write_segment.
+
+    Returns:
+        dict: the "index", "doc_freq" and "paths" of the segment
+    """
+    with open(segment_path, "rb") as f:
+        return pickle.load(f)
+
+
+def doc_terms_path(segment_path):
+    return segment_path[:-len(".pkl")] + ".terms.pkl"
+
+
+def build_doc_terms(index, num_docs):
+    """Invert the index of a segment into the terms of each document.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): the index of the segment, with local doc_ids
+        num_docs (int): number of documents of the segment
+
+    Returns:
+        list(str): the terms of the segment
+        array(int): ids (positions in the list above) of the terms of each
+            document, one document after the other
+        array(int): start of the term ids of each local doc_id, and the end
+    """
+    lengths = [0] * num_docs
+    for postings in index.values():
+        for (docid, _) in postings:
+            lengths[docid] += 1
+    offsets = array("Q", [0])
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    term_ids = array("I", bytes(4 * offsets[-1]))
+    fill = list(offsets[:-1])
+    for (term_id, postings) in enumerate(index.values()):
+        for (docid, _) in postings:
+            term_ids[fill[docid]] = term_id
+            fill[docid] += 1
+    return (list(index), term_ids, offsets)
+
+
+def read_doc_terms(segment_path):
+    """Load the terms of each document of a segment (see build_doc_terms).
+
+    Returns:
+        tuple: (terms, term_ids, offsets), None for the segments written
+            before they were stored
+    """
+    path = doc_terms_path(segment_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def count_deleted_doc_freq(segment, deleted):
+    """Count the document frequencies of the deleted documents of a segment
+    from its postings, for the segments without their terms stored.
+
+    Args:
+        segment (dict): the segment (see read_segment)
+        deleted (set(int)): its deleted local doc_ids
+
+    Returns:
+        dict(str : int): document frequency of each term of the deleted documents
+    """
+    doc_freq = {}
+    for (term, postings) in segment["index"].items():
+        df = sum(1 for (docid, _) in postings if docid in deleted)
+        if df > 0:
+            doc_freq[term] = df
+    return doc_freq
+
+
+class SegmentedIndex(Mapping):
+    """Read-only view of segments as a single index. Live documents get new
+    consecutive doc_ids, segment after segment, so doc_ids are in range(num_docs)
+    and doc_freq and num_docs only count live documents, like an index rebuilt
+    from scratch. Behaves like the dict(str : list(tuple(int, int))) built by
+    the indexer.
+    """
+
+    def __init__(self, segments, deleted_doc_freqs=None):
+        """
+        Args:
+            segments (list(tuple(dict, set(int)))): the segments (see read_segment)
+                and their deleted local doc_ids
+            deleted_doc_freqs (list(dict(str : int))): document frequencies of the
+                deleted documents of each segment, None for the ones to count
+                from their postings (default: count them for every segment with
+                deleted documents)
+        """
+        self.segments = []
+        self.doc_ids = {}
+        base = 0
+        for (segment, deleted) in segments:
+            paths = segment["paths"]
+            if len(deleted) == 0:
+                remap = None
+                for (local, path) in enumerate(paths):
+                    self.doc_ids[path] = base + local
+                self.segments.append((segment["index"], None, base))
+                base += len(paths)
+            else:
+                # doc_id of every local doc_id, -1 for deleted documents
+                remap = [-1] * len(paths)
+                for (local, path) in enumerate(paths):
+                    if local not in deleted:
+                        remap[local] = base
+                        self.doc_ids[path] = base
+                        base += 1
+                self.segments.append((segment["index"], remap, 0))
+        self.num_docs = base
+
+        if deleted_doc_freqs is None:
+            deleted_doc_freqs = [None] * len(segments)
+        self.doc_freq = {}
+        for ((segment, deleted), deleted_doc_freq) in zip(segments, deleted_doc_freqs):
+            if len(deleted) == 0:
+                deleted_doc_freq = {}
+            elif deleted_doc_freq is None:
+                deleted_doc_freq = count_deleted_doc_freq(segment, deleted)
+            for (term, df) in segment["doc_freq"].items():
+                df -= deleted_doc_freq.get(term, 0)
+                if df > 0:
+                    self.doc_freq[term] = self.doc_freq.get(term, 0) + df
+
+    def __getitem__(self, term):
+        if term not in self.doc_freq:
+            raise KeyError(term)
+        if len(self.segments) == 1 and self.segments[0][1] is None:
+            return self.segments[0][0][term]
+        postings = []
+        for (index, remap, base) in self.segments:
+            segment_postings = index.get(term)
+            if segment_postings is None:
+                continue
+            if remap is None:
+                postings.extend([(base + docid, tf) for (docid, tf) in segment_postings])
+            else:
+                postings.extend([(remap[docid], tf) for (docid, tf) in segment_postings if remap[docid] >= 0])
+        return postings
+
+    def __contains__(self, term):
+        return term in self.doc_freq
+
+    def __iter__(self):
+        return iter(self.doc_freq)
+
+    def __len__(self):
+        return len(self.doc_freq)
+
+
+class SegmentManager:
+    """Add and delete documents of a segmented index, and merge its segments.
+    Changes are committed to the manifest as soon as they are made. All the
+    methods can be called from several threads, and several processes can
+    change the same segments.
+    """
+
+    def __init__(self, segments_dir=SEGMENTS_DIR):
+        """
+        Args:
+            segments_dir (str): directory of the segments and the manifest
+        """
+        self.segments_dir = segments_dir
+        self.manifest_path = os.path.join(segments_dir, os.path.basename(SEGMENTS_MANIFEST_PATH))
+        self.lock_path = os.path.join(segments_dir, "manifest.lock")
+        self.lock = threading.Lock()
+        self.merge_thread = None
+        # segments and terms of their documents already read, they are never modified
+        self.segment_cache = {}
+        self.doc_terms_cache = {}
+        os.makedirs(segments_dir, exist_ok=True)
+        self.manifest = {
+            "segments": [],             # live segment names, oldest first
+            "num_docs": {},             # segment name -> number of documents (deleted included)
+            "deleted": {},              # segment name -> set of deleted local doc_ids
+            "deleted_doc_freq": {},     # segment name -> document frequencies of its deleted documents
+            "paths": {},                # path -> (segment name, local doc_id) of its live version
+            "next_segment": 0,
+        }
+        # index_fingerprint of the manifest file self.manifest was read from or written to
+        self.manifest_version = None
+        self.reload()
+
+    def reload(self):
+        """Read the manifest again if another process changed it. Called with the lock held."""
+        if os.path.exists(self.manifest_path) and index_fingerprint(self.manifest_path) != self.manifest_version:
+            with open(self.manifest_path, "rb") as f:
+                self.manifest = pickle.load(f)
+            self.manifest_version = index_fingerprint(self.manifest_path)
+            self.manifest.setdefault("deleted_doc_freq", {})
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of this manager and the manifest lock file, with the
+        latest manifest, around a read-modify-write of the manifest."""
+        with self.lock:
+            with open(self.lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    # released when the file is closed
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.reload()
+                yield
+
+    def segment_path(self, name):
+        return os.path.join(self.segments_dir, name + ".pkl")
+
+    def get_segment(self, name):
+        """Read a segment, or get it from the segments already read. Called with the lock held."""
+        segment = self.segment_cache.get(name)
+        if segment is None:
+            segment = self.segment_cache[name] = read_segment(self.segment_path(name))
+        return segment
+
+    def get_doc_terms(self, name):
+        """Read the terms of the documents of a segment (see build_doc_terms). Called with the lock held."""
+        if name not in self.doc_terms_cache:
+            self.doc_terms_cache[name] = read_doc_terms(self.segment_path(name))
+        return self.doc_terms_cache[name]
+
+    def view(self, names=None):
+        """Build the view of the live documents. Called with the lock held.
+
+        Args:
+            names (list(str)): names of the segments (default: all the live segments)
+
+        Returns:
+            SegmentedIndex: the live documents of the segments
+        """
+        if names is None:
+            names = self.manifest["segments"]
+        segments = [(self.get_segment(name), set(self.manifest["deleted"][name])) for name in names]
+        deleted_doc_freqs = [self.manifest["deleted_doc_freq"].get(name) for name in names]
+        return SegmentedIndex(segments, deleted_doc_freqs)
+
+    def commit(self):
+        """Atomically replace the manifest on disk. Called with the lock held."""
+        write_pickle(self.manifest_path, self.manifest)
+        self.manifest_version = index_fingerprint(self.manifest_path)
+
+    def new_segment_name(self):
+        """Reserve a segment name by creating its file, so that no other
+        process picks it before the segment is committed. Called with the lock held."""
+        while True:
+            name = "seg_{n:06d}".format(n=self.manifest["next_segment"])
+            self.manifest["next_segment"] += 1
+            try:
+                open(self.segment_path(name), "x").close()
+                return name
+            except FileExistsError:
+                continue
+
+    def remove_segment_files(self, name):
+        for path in [self.segment_path(name), doc_terms_path(self.segment_path(name))]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.segment_cache.pop(name, None)
+        self.doc_terms_cache.pop(name, None)
+
+    def tombstone(self, name, local):
+        """Delete a document of a segment, and remove its terms from the
+        document frequencies. Called with the lock held."""
+        self.manifest["deleted"][name].add(local)
+        doc_terms = self.get_doc_terms(name)
+        if doc_terms is None:
+            # counted from the postings of the segment when it is opened
+            return
+        (terms, term_ids, offsets) = doc_terms
+        deleted_doc_freq = self.manifest["deleted_doc_freq"].setdefault(name, {})
+        for term_id in term_ids[offsets[local]:offsets[local + 1]]:
+            term = terms[term_id]
+            deleted_doc_freq[term] = deleted_doc_freq.get(term, 0) + 1
+
+    def delete_path(self, path):
+        """Tombstone the live version of a document. Called with the lock held.
+
+        Returns:
+            bool: False if the document is not indexed
+        """
+        location = self.manifest["paths"].pop(path, None)
+        if location is None:
+            return False
+        self.tombstone(*location)
+        return True
+
+    def add_segment(self, index, doc_freq, paths):
+        """Write a segment and make it live, replacing the previous version of
+        its documents.
+
+        Args:
+            index (dict(str : list(tuple(int, int)))): the index of the segment, with local doc_ids
+            doc_freq (dict(str : int)): document frequency for each term in the segment
+            paths (list(str)): path of each local doc_id
+
+        Returns:
+            str: name of the segment
+        """
+        with self.locked():
+            name = self.new_segment_name()
+        write_segment(index, doc_freq, paths, self.segment_path(name))
+        with self.locked():
+            self.segment_cache[name] = {"index": index, "doc_freq": doc_freq, "paths": paths}
+            for (local, path) in enumerate(paths):
+                self.delete_path(path)
+                self.manifest["paths"][path] = (name, local)
+            self.manifest["segments"].append(name)
+            self.manifest["num_docs"][name] = len(paths)
+            self.manifest["deleted"][name] = set()
+            self.commit()
+        return name
+
+    def add_documents(self, path_list):
+        """Index documents into a new segment. Documents already indexed are
+        updated.
+
+        Args:
+            path_list (list(str)): paths of the documents
+
+        Returns:
+            str: name of the segment (None if path_list is empty)
+        """
+        # the last version of each path
+        paths = list(dict.fromkeys(path_list))
+        if len(paths) == 0:
+            return None
+        (index, doc_freq) = build_index_streaming(paths, {path: local for (local, path) in enumerate(paths)})
+        return self.add_segment(index, doc_freq, paths)
+
+    def delete_documents(self, path_list):
+        """Delete documents from the index.
+
+        Args:
+            path_list (list(str)): paths of the documents
+
+        Returns:
+            int: number of documents deleted
+        """
+        with self.locked():
+            deleted = sum(1 for path in path_list if self.delete_path(path))
+            if deleted > 0:
+                self.commit()
+        return deleted
+
+    def open_index(self):
+        """Get a consistent view of the live documents of all the segments.
+
+        Returns:
+            tuple: (index, doc_freq, doc_ids, num_docs) like index_store.load_index
+        """
+        # segments are only removed with the lock held, after a merge
+        with self.locked():
+            index = self.view()
+        return (index, index.doc_freq, index.doc_ids, index.num_docs)
+
+    def refresh_norms(self):
+        """Store the norms and the term upper bounds of the live documents for
+        the queries (see doc_norms.py), unless they are up to date. Every idf
+        changes with the documents, so they are computed over the whole
+        collection: without holding the lock, by the background thread.
+
+        Returns:
+            bool: whether the norms were computed
+        """
+        with self.locked():
+            if not os.path.exists(self.manifest_path) or load_doc_norms("tf", self.manifest_path) is not None:
+                return False
+            fingerprint = self.manifest_version
+            index = self.view()
+        norms = compute_doc_norms(index, index.doc_freq, index.num_docs, calc_idf)
+        norms["tfidf_bounds"] = compute_term_upper_bounds(index, norms["tfidf"])
+        # stale, and computed again, if the manifest changed meanwhile
+        save_doc_norms(norms, self.manifest_path, fingerprint=fingerprint)
+        return True
+
+    def merge(self, names):
+        """Merge segments into one, dropping their deleted documents. The
+        segments are read and written without holding the lock, so documents
+        can be added and deleted meanwhile.
+
+        Args:
+            names (list(str)): names of live segments, oldest first
+
+        Returns:
+            str: name of the merged segment (None if all the documents were deleted)
+        """
+        with self.locked():
+            view = self.view(names)
+            name = self.new_segment_name()
+        paths = [None] * view.num_docs
+        for (path, docid) in view.doc_ids.items():
+            paths[docid] = path
+        if len(paths) > 0:
+            index = {term: view[term] for term in view}
+            write_segment(index, view.doc_freq, paths, self.segment_path(name))
+
+        with self.locked():
+            if any(n not in self.manifest["segments"] for n in names):
+                # merged by another process meanwhile
+                self.remove_segment_files(name)
+                return None
+            if len(paths) > 0:
+                self.segment_cache[name] = {"index": index, "doc_freq": view.doc_freq, "paths": paths}
+            else:
+                self.remove_segment_files(name)
+            merged = set(names)
+            position = self.manifest["segments"].index(names[0])
+            self.manifest["segments"] = [n for n in self.manifest["segments"] if n not in merged]
+            if len(paths) > 0:
+                self.manifest["segments"].insert(position, name)
+                self.manifest["num_docs"][name] = len(paths)
+                self.manifest["deleted"][name] = set()
+            else:
+                name = None
+            for (local, path) in enumerate(paths):
+                location = self.manifest["paths"].get(path)
+                if location is not None and location[0] in merged:
+                    self.manifest["paths"][path] = (name, local)
+                else:
+                    # deleted or updated during the merge
+                    self.tombstone(name, local)
+            for n in names:
+                del self.manifest["num_docs"][n]
+                del self.manifest["deleted"][n]
+                self.manifest["deleted_doc_freq"].pop(n, None)
+            self.commit()
+            for n in names:
+                self.remove_segment_files(n)
+        return name
+
+    def find_merge(self):
+        """Pick segments to merge according to the merge policy.
+
+        Returns:
+            list(str): names of the segments to merge, oldest first (empty if none)
+        """
+        with self.locked():
+            segments = [(name, self.manifest["num_docs"][name], len(self.manifest["deleted"][name]))
+                        for name in self.manifest["segments"]]
+        tiers = {}
+        for (name, num_docs, num_deleted) in segments:
+            if num_docs > 0 and num_deleted > MAX_DELETED_RATIO * num_docs:
+                return [name]
+            tier = int(math.log(max(1, num_docs - num_deleted), MERGE_FACTOR))
+            tiers.setdefault(tier, []).append(name)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= MERGE_FACTOR:
+                return tiers[tier][:MERGE_FACTOR]
+        return []
+
+    def maybe_merge(self):
+        """Merge segments until the merge policy finds nothing to merge.
+
+        Returns:
+            int: number of merges done
+        """
+        merges = 0
+        while True:
+            names = self.find_merge()
+            if len(names) == 0:
+                return merges
+            self.merge(names)
+            merges += 1
+
+    def maintain(self):
+        """Merge segments according to the merge policy, then store the norms
+        of the live documents."""
+        self.maybe_merge()
+        self.refresh_norms()
+
+    def start_background_merge(self):
+        """Run maintain in a background thread, unless one is running.
+
+        Returns:
+            threading.Thread: the merging thread
+        """
+        with self.lock:
+            if self.merge_thread is None or not self.merge_thread.is_alive():
+                self.merge_thread = threading.Thread(target=self.maintain, name="segment-merge")
+                self.merge_thread.start()
+            return self.merge_thread
+
+    def wait_for_merges(self):
+        """Wait for the background merges and norms to finish."""
+        thread = self.merge_thread
+        if thread is not None:
+            thread.join()
+
+    def import_stored_index(self):
+        """Make the index stored by indexer.py the first segment.
+
+        Returns:
+            str: name of the segment
+        """
+        (index, doc_freq, doc_ids, num_docs) = open_stored_index(built_index_path())
+        paths = [None] * num_docs
+        for (path, docid) in doc_ids.items():
+            paths[docid] = path
+        return self.add_segment({term: list(index[term]) for term in index}, dict(doc_freq.items()), paths)
+
+
+def normalize_path(path):
+    """Write a document path the way indexer.py does, e.g. ./gov/documents/00/G00-00-0000000"""
+    return "./" + os.path.relpath(path).replace("\\", "/")
+
+
+def open_segments(segments_dir=SEGMENTS_DIR):
+    """Open the segmented index of a directory.
+
+    Returns:
+        tuple: (index, doc_freq, doc_ids, num_docs)
+    """
+    return SegmentManager(segments_dir).open_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add and delete documents of a segmented index of the gov collection")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("init", help="make the index stored by indexer.py the first segment")
+    add_parser = subparsers.add_parser("add", help="index (or re-index) documents into a new segment")
+    add_parser.add_argument("paths", nargs="+", help="document files or directories")
+    delete_parser = subparsers.add_parser("delete", help="delete documents")
+    delete_parser.add_argument("paths", nargs="+", help="document files or directories")
+    subparsers.add_parser("merge", help="merge segments according to the merge policy")
+    subparsers.add_parser("status", help="list the segments")
+    args = parser.parse_args()
+
+    manager = SegmentManager()
+    start = time.perf_counter()
+    if args.command in ["add", "delete"]:
+        path_list = []
+        for path in args.paths:
+            path_list.extend(gov_list_docs(path) if os.path.isdir(path) else [path])
+        path_list = [normalize_path(path) for path in path_list]
+
+    if args.command == "init":
+        name = manager.import_stored_index()
+        print(f"Imported the stored index as {name}")
+        manager.start_background_merge()
+    elif args.command == "add":
+        name = manager.add_documents(path_list)
+        print(f"Indexed {len(path_list)} documents into {name} in {time.perf_counter() - start:.2f}s")
+        # compact in the background, the new documents can already be searched
+        manager.start_background_merge()
+    elif args.command == "delete":
+        deleted = manager.delete_documents(path_list)
+        print(f"Deleted {deleted} documents in {time.perf_counter() - start:.2f}s")
+        manager.start_background_merge()
+    elif args.command == "merge":
+        print(f"{manager.maybe_merge()} merges")
+        manager.refresh_norms()
+
+    manager.wait_for_merges()
+    for name in manager.manifest["segments"]:
+        num_docs = manager.manifest["num_docs"][name]
+        print(f"{name}: {num_docs} documents, {len(manager.manifest['deleted'][name])} deleted")
@@ -0,0 +1,382 @@
+import os
+import heapq
+import pickle
+import argparse
+import traceback
+import multiprocessing
+from bisect import bisect_left
+from itertools import islice
+from collections.abc import Mapping
+from indexer import (
+    gov_list_docs,
+    make_doc_ids,
+    build_index_streaming,
+)
+from index_store import open_stored_index
+from query import (
+    get_query_tokens,
+    count_query_tokens,
+)
+import query
+import query_tfidf
+from query_boolean import (
+    parse_expression,
+    run_boolean_query,
+)
+
+# A document-partitioned index: the doc_ids are split into contiguous ranges,
+# each shard holding the postings of its own documents only.
+#   shards/manifest.pkl  : pickled dict with the "bounds" of the shards (shard i
+#                          has the doc_ids in range(bounds[i], bounds[i + 1])),
+#                          the global "doc_freq" and "num_docs", and the
+#                          "paths" of the doc_ids
+#   shards/shard_NNN.pkl : pickled dict with the "index" and the document
+#                          "norms" (one dict per engine) of a shard
+# Doc_ids stay global, and every shard scores with the global doc_freq and
+# num_docs, so a document gets the exact same score as in the unsharded index.
+SHARDS_DIR = "shards"
+MANIFEST_NAME = "manifest.pkl"
+
+# Ranked query engines a shard can run: (run_query, get_doc_to_norm)
+ENGINES = {
+    "tf": (query.run_query, query.get_doc_to_norm),
+    "tfidf": (query_tfidf.run_query, query_tfidf.get_doc_to_norm),
+}
+
+
+def shard_path(shards_dir, shard_id):
+    return os.path.join(shards_dir, "shard_{:03d}.pkl".format(shard_id))
+
+
+def write_pickle(obj, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def shard_bounds(num_docs, num_shards):
+    """Split range(num_docs) into num_shards contiguous ranges of (almost) the same size.
+
+    Returns:
+        list(int): num_shards + 1 bounds, shard i has the doc_ids in range(bounds[i], bounds[i + 1])
+    """
+    return [i * num_docs // num_shards for i in range(num_shards + 1)]
+
+
+def split_postings(postings, bounds):
+    """Split a posting list asc sorted by doc_id between the shards.
+
+    Returns:
+        list(list(tuple(int, int))): the postings of each shard
+    """
+    res = []
+    start = 0
+    for hi in bounds[1:]:
+        end = bisect_left(postings, (hi,), start)
+        res.append(postings[start:end])
+        start = end
+    return res
+
+
+def finish_shards(shards_dir, bounds, doc_freq, num_docs, paths):
+    """Compute the document norms of every shard with the global statistics,
+    one shard in memory at a time, and write the manifest.
+
+    Args:
+        shards_dir (str): directory of the shards
+        bounds (list(int)): see shard_bounds
+        doc_freq (dict(str : int)): global document frequency for each term
+        num_docs (int): number of documents in the collection
+        paths (list(str)): path of each doc_id
+    """
+    for shard_id in range(len(bounds) - 1):
+        shard = read_pickle(shard_path(shards_dir, shard_id))
+        # same additions in the same order as doc_norms.compute_doc_norms
+        shard["norms"] = {name: dict(norm_func(shard["index"], doc_freq, num_docs))
+                          for (name, (_, norm_func)) in ENGINES.items()}
+        write_pickle(shard, shard_path(shards_dir, shard_id))
+    write_pickle({"bounds": bounds, "doc_freq": doc_freq, "num_docs": num_docs, "paths": paths},
+                 os.path.join(shards_dir, MANIFEST_NAME))
+
+
+def build_shards(path_list, doc_ids, num_shards, shards_dir=SHARDS_DIR):
+    """Index the documents of each shard separately, so only one shard's
+    postings are ever held in memory.
+
+    Args:
+        path_list (list(str)): list of paths
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id in range(len(path_list))
+        num_shards (int): number of shards
+        shards_dir (str): directory the shards are written to
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    num_docs = len(path_list)
+    bounds = shard_bounds(num_docs, num_shards)
+    paths = [None] * num_docs
+    for path in path_list:
+        paths[doc_ids[path]] = path
+
+    doc_freq = {}
+    for shard_id in range(num_shards):
+        shard_paths = paths[bounds[shard_id]:bounds[shard_id + 1]]
+        (index, shard_doc_freq) = build_index_streaming(shard_paths, doc_ids)
+        for (term, df) in shard_doc_freq.items():
+            doc_freq[term] = doc_freq.get(term, 0) + df
+        write_pickle({"index": index}, shard_path(shards_dir, shard_id))
+
+    finish_shards(shards_dir, bounds, dict(sorted(doc_freq.items())), num_docs, paths)
+
+
+def split_index(index, doc_freq, doc_ids, num_docs, num_shards, shards_dir=SHARDS_DIR):
+    """Split an existing index, e.g. the one stored by indexer.py, into shards.
+
+    Args:
+        index (dict(str : list(tuple(int, int)))): the index aka dictionary of posting lists
+        doc_freq (dict(str : int)): document frequency for each term
+        doc_ids (dict(str : int)): dictionary mapping a path to a doc_id
+        num_docs (int): number of documents in the corpus
+        num_shards (int): number of shards
+        shards_dir (str): directory the shards are written to
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    bounds = shard_bounds(num_docs, num_shards)
+    shard_indexes = [{} for _ in range(num_shards)]
+    for term in index:
+        for (shard_index, postings) in zip(shard_indexes, split_postings(list(index[term]), bounds)):
+            if len(postings) > 0:
+                shard_index[term] = postings
+    for (shard_id, shard_index) in enumerate(shard_indexes):
+        write_pickle({"index": shard_index}, shard_path(shards_dir, shard_id))
+
+    paths = [None] * num_docs
+    for (path, docid) in doc_ids.items():
+        paths[docid] = path
+    finish_shards(shards_dir, bounds, dict(doc_freq.items()), num_docs, paths)
+
+
+class ShardIndex(Mapping):
+    """The postings of a shard seen with the vocabulary of the whole
+    collection: a term of another shard is in the index, with no postings.
+    The query norms of run_query skip the terms not in the index, so they
+    have to be computed over the global vocabulary.
+    """
+
+    def __init__(self, index, doc_freq):
+        """
+        Args:
+            index (dict(str : list(tuple(int, int)))): postings of the shard
+            doc_freq (dict(str : int)): global document frequency for each term
+        """
+        self.index = index
+        self.doc_freq = doc_freq
+
+    def __getitem__(self, term):
+        if term not in self.doc_freq:
+            raise KeyError(term)
+        return self.index.get(term, [])
+
+    def __contains__(self, term):
+        return term in self.doc_freq
+
+    def __iter__(self):
+        return iter(self.doc_freq)
+
+    def __len__(self):
+        return len(self.doc_freq)
+
+
+def first_query_terms(res, query_string, index):
+    """Find, for each ranked document, the first query term it contains.
+    run_query scores the documents term after term, so documents with equal
+    scores are ranked by first query term, then by doc_id.
+
+    Args:
+        res (list(tuple(int, float))): ranked (doc_id, score) pairs
+        query_string (str): the query string
+        index (dict(str : list(tuple(int, int)))): the postings the documents come from
+
+    Returns:
+        list(tuple(float, int, int)): (score, first query term, doc_id) of each document
+    """
+    terms = [term for (term, _) in count_query_tokens(get_query_tokens(query_string))]
+    postings = [index.get(term, []) for term in terms]
+    ranked = []
+    for (docid, score) in res:
+        for (qi, term_postings) in enumerate(postings):
+            pos = bisect_left(term_postings, (docid,))
+            if pos < len(term_postings) and term_postings[pos][0] == docid:
+                break
+        ranked.append((score, qi, docid))
+    return ranked
+
+
+def shard_worker(conn, shards_dir, shard_id):
+    """Serve the queries of one shard, received over a pipe, until None is received.
+
+    Requests are ("ranked", engine, query_string, k), answered with the
+    first_query_terms of the shard's top-k, and ("boolean", query_string),
+    answered with the matching doc_ids of the shard. A failure is answered
+    with ("error", traceback).
+    """
+    manifest = read_pickle(os.path.join(shards_dir, MANIFEST_NAME))
+    (doc_freq, num_docs, bounds) = (manifest["doc_freq"], manifest["num_docs"], manifest["bounds"])
+    del manifest
+    shard = read_pickle(shard_path(shards_dir, shard_id))
+    index = shard["index"]
+    shard_index = ShardIndex(index, doc_freq)
+    shard_doc_ids = range(bounds[shard_id], bounds[shard_id + 1])
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        try:
+            if request[0] == "ranked":
+                (_, engine, query_string, k) = request
+                res = ENGINES[engine][0](query_string, shard_index, doc_freq, shard["norms"][engine], num_docs, k=k)
+                conn.send(first_query_terms(res, query_string, index))
+            else:
+                (_, query_string) = request
+                conn.send(run_boolean_query(query_string, index, doc_freq, num_docs, all_doc_ids=shard_doc_ids))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+    conn.close()
+
+
+class ShardCoordinator:
+    """Fan the queries out to one worker process per shard and merge their
+    results. Rankings and boolean results are the same as on the unsharded index.
+
+        with ShardCoordinator() as coordinator:
+            res = coordinator.run_query("nuclear power", "tfidf", k=10)
+    """
+
+    def __init__(self, shards_dir=SHARDS_DIR):
+        manifest = read_pickle(os.path.join(shards_dir, MANIFEST_NAME))
+        self.shards_dir = shards_dir
+        self.num_docs = manifest["num_docs"]
+        self.paths = manifest["paths"]
+        self.num_shards = len(manifest["bounds"]) - 1
+        self.workers = []
+
+    def start(self):
+        for shard_id in range(self.num_shards):
+            (conn, worker_conn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard_worker, args=(worker_conn, self.shards_dir, shard_id),
+                                              daemon=True)
+            process.start()
+            worker_conn.close()
+            self.workers.append((process, conn))
+
+    def close(self):
+        for (process, conn) in self.workers:
+            conn.send(None)
+            conn.close()
+        for (process, _) in self.workers:
+            process.join()
+        self.workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def scatter_gather(self, request):
+        """Send a request to every shard, then wait for all the answers.
+
+        Returns:
+            list: the answer of each shard, in shard order
+        """
+        for (_, conn) in self.workers:
+            conn.send(request)
+        answers = [conn.recv() for (_, conn) in self.workers]
+        for answer in answers:
+            if isinstance(answer, tuple) and answer[0] == "error":
+                raise RuntimeError("shard worker failed:\n" + answer[1])
+        return answers
+
+    def run_query(self, query_string, engine="tfidf", k=None):
+        """Run a ranked query on all the shards and merge their top-k lists.
+
+        Args:
+            query_string (str): the query string
+            engine (str): one of ENGINES
+            k (int): only return the k most similar documents (default: all of them)
+
+        Returns:
+            list(tuple(int, float)): the same (doc_id, score) pairs, in the same
+                order, as the engine's run_query on the unsharded index
+        """
+        answers = self.scatter_gather(("ranked", engine, query_string, k))
+        # every shard's list is sorted by (-score, first query term, doc_id),
+        # the order of run_query on the whole index
+        merged = heapq.merge(*answers, key=lambda x: (-x[0], x[1], x[2]))
+        return [(docid, score) for (score, _, docid) in islice(merged, k)]
+
+    def run_boolean_query(self, query_string):
+        """Run a boolean query on all the shards, NOT being taken against the
+        documents of each shard.
+
+        Returns:
+            list(int): the matching doc_ids, asc sorted, or [message] for an invalid query
+        """
+        (_, msg) = parse_expression(query_string)
+        if query_string.strip() != "" and msg != "OK":
+            return [msg]
+        res = []
+        # the shards hold consecutive ranges of doc_ids
+        for doc_list in self.scatter_gather(("boolean", query_string)):
+            res.extend(doc_list)
+        return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Document-partitioned sharded index of the gov collection")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index the gov documents into shards")
+    build_parser.add_argument("--shards", type=int, default=4, help="number of shards")
+    build_parser.add_argument("--from-index", action="store_true",
+                              help="split the index stored by indexer.py instead of reading the documents")
+    query_parser = subparsers.add_parser("query", help="run the evaluation queries on the shards")
+    query_parser.add_argument("--engine", choices=sorted(ENGINES), default="tfidf")
+    query_parser.add_argument("--k", type=int, default=None,
+                              help="number of documents retrieved for each query (default: all of them)")
+    query_parser.add_argument("--boolean", nargs="*", default=[], help="boolean queries to run and print")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.from_index:
+            (index, doc_freq, doc_ids, num_docs) = open_stored_index()
+            split_index(index, doc_freq, doc_ids, num_docs, args.shards)
+        else:
+            doc_list = [path.replace("\\", "/") for path in gov_list_docs("./gov/documents")]
+            build_shards(doc_list, make_doc_ids(doc_list), args.shards)
+        print(f"Built {args.shards} shards in {SHARDS_DIR}")
+    else:
+        with ShardCoordinator() as coordinator:
+            for query_string in args.boolean:
+                print(query_string)
+                doc_list = coordinator.run_boolean_query(query_string)
+                if len(doc_list) > 0 and isinstance(doc_list[0], str):
+                    print(doc_list[0])
+                else:
+                    for path in sorted(coordinator.paths[docid] for docid in doc_list):
+                        print(path)
+
+            # same run file as query_main
+            with open(os.path.join('gov', 'topics', 'gov.topics'), 'r') as f, open('retrieved.txt', 'w') as fout:
+                for line in f:
+                    terms = line.split()
+                    (qid, query_string) = (terms[0], " ".join(terms[1:]))
+                    res = coordinator.run_query(query_string, args.engine, args.k)
+                    fout.write("".join(f"{qid} Q0 {os.path.split(coordinator.paths[docid])[-1]} {rank+1} {sim} MY_IR_SYSTEM\n"
+                                       for rank, (docid, sim) in enumerate(res)))
@@ -1,6 +1,7 @@
-import nltk
-from nltk.stem import PorterStemmer, SnowballStemmer, LancasterStemmer
 import re
+import time
+from collections import OrderedDict
+import instrument
 
 punctuation_marks = [".", "?", "!", ",", ";",
                      ":","\"", "'", "(", ")",
@@ -12,16 +13,161 @@ patterns = [
     r'\b(?:https?://)?(?:www\.)?[A-Za-z0-9.-]+(?:\.[A-Z|a-z]{2,7})+\S*\b'           # Website
 ]
 
-def process_tokens(toks):
-    # return process_tokens_1(toks)                                                 # PorterStemmer only
-    # return process_tokens_2(toks)                                                 # Filter before running PorterStemmer
-    return process_tokens_3(toks)                                                 # Filter before running SnowballStemmer
-    # return process_tokens_4(toks)                                                 # Filter before running LancasterStemmer
-    # return process_tokens_5(toks)                                                   # Filter only
-    # return process_tokens_original(toks)
+# Precompiled forms of the above, used by the analyzer
+compiled_patterns = [re.compile(pattern) for pattern in patterns]
+punctuation_table = str.maketrans("", "", "".join(ch for ch in punctuation_marks if len(ch) == 1))
+# non-ASCII whitespace, which still separates tokens once the text is made ASCII-only
+non_ascii_space_re = re.compile('[\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]')
 
-# get the nltk stopwords list
-stopwords = set(nltk.corpus.stopwords.words("english"))
+# The process_tokens_N variant used for both the documents and the queries:
+#   1          : PorterStemmer only
+#   2          : Filter before running PorterStemmer
+#   3          : Filter before running SnowballStemmer
+#   4          : Filter before running LancasterStemmer
+#   5          : Filter only
+#   "original" : process_tokens_original
+ACTIVE_VARIANT = 3
+
+class ActiveProcessTokens:
+    """process_tokens_N of ACTIVE_VARIANT, looked up on each call."""
+
+    def __call__(self, toks):
+        return process_tokens_variants[ACTIVE_VARIANT](toks)
+
+    @property
+    def variant(self):
+        """int or str: the variant used, for the streaming analyzer (see analyze_stream)"""
+        return ACTIVE_VARIANT
+
+process_tokens = ActiveProcessTokens()
+
+# the nltk English stopwords list (nltk.corpus.stopwords.words("english")), frozen
+# here so that importing this module does not load nltk and its corpus reader
+stopwords = frozenset([
+    'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've",
+    "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself',
+    'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them',
+    'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll",
+    'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has',
+    'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or',
+    'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against',
+    'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from',
+    'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once',
+    'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more',
+    'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than',
+    'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now',
+    'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn',
+    "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn',
+    "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't",
+    'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn',
+    "wouldn't",
+])
+
+# Default number of distinct raw tokens remembered by each normalization cache
+NORMALIZATION_CACHE_SIZE = 2**18
+
+# stemmer instances shared by all documents and queries
+# nltk is only imported when a stemmer is first used, as importing it takes
+# most of the start-up time of the query scripts
+def make_porter_stemmer():
+    from nltk.stem.porter import PorterStemmer
+    return PorterStemmer()
+
+def make_snowball_stemmer():
+    from nltk.stem.snowball import SnowballStemmer
+    return SnowballStemmer(language='english')
+
+def make_lancaster_stemmer():
+    from nltk.stem.lancaster import LancasterStemmer
+    return LancasterStemmer()
+
+stemmer_classes = {
+    "porter": make_porter_stemmer,
+    "snowball": make_snowball_stemmer,
+    "lancaster": make_lancaster_stemmer,
+}
+stemmers = {}
+
+def get_stemmer(name):
+    """Get the shared instance of a stemmer.
+
+    Args:
+        name (str): one of stemmer_classes, or None for no stemming
+
+    Returns:
+        stemmer instance, None if name is None
+    """
+    if name is None:
+        return None
+    if name not in stemmers:
+        stemmers[name] = stemmer_classes[name]()
+    return stemmers[name]
+
+def normalize_token(tok, stemmer):
+    """ Normalize a single raw token the way run_normalization does.
+
+    Args:
+        tok (str)       : a raw token
+        stemmer         : stemmer used (default not used)
+
+    Returns:
+        tuple(str): tokens produced by the raw token (usually 0 or 1)
+    """
+    
+    # Remove all non-ASCII characters
+    tok = str(tok).encode("ascii", "ignore").decode()
+    if(tok == ""):
+        return ()
+    
+    # Convert to lower-case
+    tok = tok.lower()
+    
+    if tok in stopwords:
+        return ()
+
+    processed_toks = []
+    profiling = instrument.enabled
+
+    # Skip stemming for emails, websites (both need a '.')
+    if "." in tok:
+        if profiling: start = time.perf_counter()
+        for pattern in compiled_patterns:
+            matches = pattern.findall(tok)
+            if len(matches) != 0:
+                # Filter email, website from the token
+                for item in matches:
+                    processed_toks.append(item)
+                continue
+        if profiling: instrument.add_time("normalize.regex", time.perf_counter() - start)
+    
+    # Remove punctuation mark in token
+    if profiling: start = time.perf_counter()
+    tok = tok.translate(punctuation_table)
+    if profiling: instrument.add_time("normalize.punctuation", time.perf_counter() - start)
+    if(tok == ""):
+        return tuple(processed_toks)
+        
+    # Stem
+    if stemmer != None:
+        if profiling: start = time.perf_counter()
+        tok = stemmer.stem(tok)
+        if profiling: instrument.add_time("normalize.stem", time.perf_counter() - start)
+    
+    processed_toks.append(tok)
+    return tuple(processed_toks)
+
+def normalize_pattern(tok):
+    """ Normalize a wildcard pattern of a query, e.g. "Econom*", like normalize_token
+    without stopword removal and stemming: the pattern stands for processed tokens.
+
+    Args:
+        tok (str)       : a raw token
+
+    Returns:
+        str: the normalized pattern
+    """
+    tok = str(tok).encode("ascii", "ignore").decode().lower()
+    return tok.translate(punctuation_table)
 
 def run_normalization(toks, stemmer):
     """ Perform processing on tokens. Before stemming and lemmanization apllied, 
@@ -39,41 +185,112 @@ def run_normalization(toks, stemmer):
     processed_toks = []
     
     for tok in toks:
-        # Remove all non-ASCII characters
-        tok = str(tok).encode("ascii", "ignore").decode()
-        if(tok == ""):
-            continue
-        
-        # Convert to lower-case
-        tok = tok.lower()
-        
-        if tok in stopwords:
-            continue
-        else:
-            # Skip stemming for emails, websites
-            for pattern in patterns:
-                matches = re.findall(pattern, tok)
-                if len(matches) != 0:
-                    # Filter email, website from the token
-                    for item in matches:
-                        processed_toks.append(item)
-                    continue
-            
-            # Remove punctuation mark in token
-            for ch in tok:
-                if ch in punctuation_marks:
-                    tok =  tok.replace(ch, "")   
-            if(tok == ""):
-                continue
-                
-            # Stem
-            if stemmer != None:
-                tok = stemmer.stem(tok)
-            
-            processed_toks.append(tok)
+        processed_toks.extend(normalize_token(tok, stemmer))
     
     return processed_toks
 
+class NormalizationCache:
+    """ Bounded LRU cache mapping a raw token to its normalized tokens for one
+    stemmer. Natural text repeats the same raw tokens a lot, so most tokens
+    are normalized only once.
+    """
+
+    def __init__(self, stemmer_name, maxsize=NORMALIZATION_CACHE_SIZE):
+        self.stemmer_name = stemmer_name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def run_normalization(self, toks):
+        """ Same as run_normalization(toks, get_stemmer(stemmer_name)), with the
+        normalized form of every raw token looked up in the cache first.
+
+        Args:
+            toks (list(str)): all the tokens in a single document
+
+        Returns:
+            list(str): tokens after processing
+        """
+        processed_toks = []
+        entries = self.entries
+        stemmer = None
+        
+        for tok in toks:
+            res = entries.get(tok)
+            if res is not None:
+                entries.move_to_end(tok)
+                self.hits += 1
+            else:
+                if stemmer is None:
+                    stemmer = get_stemmer(self.stemmer_name)
+                res = normalize_token(tok, stemmer)
+                entries[tok] = res
+                self.misses += 1
+                if len(entries) > self.maxsize:
+                    entries.popitem(last=False)
+                    self.evictions += 1
+            processed_toks.extend(res)
+        
+        return processed_toks
+
+    def resize(self, maxsize):
+        """ Change the maximum number of cached raw tokens, evicting the least
+        recently used ones if needed.
+        """
+        self.maxsize = maxsize
+        while len(self.entries) > maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """ Drop all the entries and reset the statistics."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """ Get the hit/miss statistics, used to size the cache.
+
+        Returns:
+            dict(str : int or float): hits, misses, evictions, size, maxsize and hit_rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+# one cache per stemmer, shared by the indexer and the queries
+normalization_caches = {}
+
+def get_normalization_cache(stemmer_name):
+    """ Get the shared normalization cache of a stemmer.
+
+    Args:
+        stemmer_name (str): one of stemmer_classes, or None for no stemming
+
+    Returns:
+        NormalizationCache: the cache
+    """
+    if stemmer_name not in normalization_caches:
+        normalization_caches[stemmer_name] = NormalizationCache(stemmer_name)
+    return normalization_caches[stemmer_name]
+
+def normalization_cache_stats():
+    """ Get the statistics of all the normalization caches in use.
+
+    Returns:
+        dict(str : dict): statistics of each cache, keyed by stemmer name
+    """
+    return {str(name): cache.stats() for (name, cache) in normalization_caches.items()}
+
 def process_tokens_original(toks):
     """ Perform processing on tokens. This is the Linguistics Modules
     phase of index construction
@@ -106,7 +323,7 @@ def process_tokens_1(toks):
     """
     
     processed_toks = []
-    stemmer = PorterStemmer()
+    stemmer = get_stemmer("porter")
     
     for tok in toks:
         # Remove all non-ASCII characters
@@ -135,8 +352,7 @@ def process_tokens_2(toks):
         list(str): tokens after processing
     """
     
-    stemmer = PorterStemmer()
-    return run_normalization(toks, stemmer=stemmer)
+    return get_normalization_cache("porter").run_normalization(toks)
     
 def process_tokens_3(toks):
     """ Perform processing on tokens. This is the Linguistics Modules
@@ -149,8 +365,7 @@ def process_tokens_3(toks):
         list(str): tokens after processing
     """
     
-    stemmer = SnowballStemmer(language='english')
-    return run_normalization(toks, stemmer=stemmer)
+    return get_normalization_cache("snowball").run_normalization(toks)
 
 def process_tokens_4(toks):
     """ Perform processing on tokens. This is the Linguistics Modules
@@ -163,8 +378,7 @@ def process_tokens_4(toks):
         list(str): tokens after processing
     """
     
-    stemmer = LancasterStemmer()
-    return run_normalization(toks, stemmer=stemmer)
+    return get_normalization_cache("lancaster").run_normalization(toks)
 
 def process_tokens_5(toks):
     """ Perform processing on tokens. This is the Linguistics Modules
@@ -177,7 +391,7 @@ def process_tokens_5(toks):
         list(str): tokens after processing
     """
     
-    return run_normalization(toks, None)
+    return get_normalization_cache(None).run_normalization(toks)
 
 def tokenize_text(data):
     """Convert a document as a string into a document as a list of
@@ -192,3 +406,169 @@ def tokenize_text(data):
     # split text on spaces
     tokens = data.split()
     return tokens
+
+# the process_tokens_N function of each variant
+process_tokens_variants = {
+    "original": process_tokens_original,
+    1: process_tokens_1,
+    2: process_tokens_2,
+    3: process_tokens_3,
+    4: process_tokens_4,
+    5: process_tokens_5,
+}
+
+# stemmer of each process_tokens_N variant
+variant_stemmers = {
+    1: "porter",
+    2: "porter",
+    3: "snowball",
+    4: "lancaster",
+    5: None,
+}
+
+def analyze_stream(chunks, variant=None):
+    """Tokenize and normalize a document given as a sequence of text chunks.
+    The whole chunk is made ASCII-only (one precompiled regex pass to keep
+    the non-ASCII whitespace, skipped for ASCII text), lower-cased and split at once, and only the distinct
+    tokens are normalized (see NormalizationCache). A token cut
+    between two chunks is carried over to the next one, so documents of any
+    size can be analyzed a chunk at a time.
+
+    Args:
+        chunks (iterable(str)): the document, in consecutive pieces
+        variant (int or str): the process_tokens_N variant to reproduce, 1 to 5
+            or "original" (default: ACTIVE_VARIANT, the one used by process_tokens)
+
+    Yields:
+        list(str): the processed tokens of each chunk, together the same tokens
+            as process_tokens_N(tokenize_text(document))
+    """
+    if variant is None:
+        variant = ACTIVE_VARIANT
+    if variant == "original":
+        def normalize(toks):
+            return [t.lower() for t in toks if t.lower() not in stopwords]
+    elif variant == 1:
+        stemmer = get_stemmer(variant_stemmers[variant])
+        def normalize(toks):
+            return [stemmer.stem(t) for t in toks if t != "" and t not in stopwords]
+    else:
+        normalize = get_normalization_cache(variant_stemmers[variant]).run_normalization
+
+    carry = ""
+    for chunk in chunks:
+        with instrument.stage("tokenize"):
+            buf = carry + chunk
+            if variant != "original":
+                # ascii-only and lower-case once for the whole chunk
+                if not buf.isascii():
+                    buf = non_ascii_space_re.sub(" ", buf).encode("ascii", "ignore").decode()
+                buf = buf.lower()
+            toks = buf.split()
+            # keep back the last token if it may continue in the next chunk
+            carry = ""
+            if len(toks) > 0 and not buf[-1].isspace():
+                carry = toks.pop()
+        instrument.count("raw_tokens", len(toks))
+        with instrument.stage("normalize"):
+            toks = normalize(toks)
+        yield toks
+    if carry != "":
+        instrument.count("raw_tokens")
+        with instrument.stage("normalize"):
+            toks = normalize([carry])
+        yield toks
+
+def analyze_text(data, variant=None):
+    """Tokenize and normalize a document in one go.
+
+    Args:
+        data (str): The input document
+        variant (int or str): see analyze_stream
+
+    Returns:
+        list(str): the same tokens as process_tokens_N(tokenize_text(data))
+    """
+    processed_toks = []
+    for toks in analyze_stream([data], variant):
+        processed_toks.extend(toks)
+    return processed_toks
+
+def analyze_file(file_path, variant=None, chunk_size=2**20):
+    """Tokenize and normalize a document file, reading it a chunk at a time.
+
+    Args:
+        file_path (str): path to document file
+        variant (int or str): see analyze_stream
+        chunk_size (int): number of characters read at a time
+
+    Yields:
+        list(str): the processed tokens of each chunk
+    """
+    def read_chunk():
+        with instrument.stage("read"):
+            return f.read(chunk_size)
+
+    with open(file_path, "r", encoding='utf-8') as f:
+        yield from analyze_stream(iter(read_chunk, ""), variant)
+
+def benchmark_analyzer(paths, variant=None):
+    """Compare the analyzer with tokenize_text + process_tokens_N on a list of
+    documents. Both start with empty normalization caches.
+
+    Args:
+        paths (list(str)): paths of the documents
+        variant (int or str): see analyze_stream
+
+    Returns:
+        dict(str : float): tokens per second of run_normalization without cache,
+            of process_tokens_N and of the analyzer, and whether they agree
+    """
+    if variant is None:
+        variant = ACTIVE_VARIANT
+    process_func = globals()["process_tokens_{v}".format(v=variant)]
+    docs = []
+    for path in paths:
+        with open(path, "r", encoding='utf-8') as f:
+            docs.append(f.read())
+
+    elapsed_uncached = None
+    if variant in variant_stemmers and variant != 1:
+        stemmer = get_stemmer(variant_stemmers[variant])
+        start = time.perf_counter()
+        for doc in docs:
+            run_normalization(tokenize_text(doc), stemmer)
+        elapsed_uncached = time.perf_counter() - start
+
+    normalization_caches.clear()
+    start = time.perf_counter()
+    expected = [process_func(tokenize_text(doc)) for doc in docs]
+    elapsed_current = time.perf_counter() - start
+
+    normalization_caches.clear()
+    start = time.perf_counter()
+    actual = [analyze_text(doc, variant) for doc in docs]
+    elapsed_analyzer = time.perf_counter() - start
+
+    num_toks = sum(len(toks) for toks in expected)
+    return {
+        "documents": len(docs),
+        "tokens": num_toks,
+        "uncached_tokens_per_sec": num_toks / max(elapsed_uncached or elapsed_current, 1e-9),
+        "current_tokens_per_sec": num_toks / max(elapsed_current, 1e-9),
+        "analyzer_tokens_per_sec": num_toks / max(elapsed_analyzer, 1e-9),
+        "speedup": elapsed_current / max(elapsed_analyzer, 1e-9),
+        "identical": expected == actual,
+    }
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    # benchmark on (a sample of) the gov documents
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    paths = [os.path.join(dpath, f) for (dpath, dnames, fnames) in os.walk("./gov/documents") for f in fnames]
+    for variant in ["original", 1, 2, 3, 4, 5]:
+        res = benchmark_analyzer(paths[:num_docs], variant)
+        print("process_tokens_{v}: uncached {uncached_tokens_per_sec:.0f} tok/s, cached {current_tokens_per_sec:.0f} tok/s, "
+              "analyzer {analyzer_tokens_per_sec:.0f} tok/s, speedup {speedup:.2f}x, identical: {identical}".format(v=variant, **res))
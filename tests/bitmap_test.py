@@ -0,0 +1,72 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+import random
+from bitmap import (
+    CHUNK_SIZE,
+    Bitmap,
+)
+
+rnd = random.Random(0)
+
+# pairs of asc sorted doc_ids lists
+BITMAP_TEST_CASES = [
+    [[], []],                                                                       # Both sets are empty
+    [[0], []],                                                                      # doc_id 0
+    [[1, 5, 9], [5, 9, 12]],                                                        # Normal case
+    [[CHUNK_SIZE - 1, CHUNK_SIZE], [CHUNK_SIZE]],                                   # Across a chunk boundary
+    [list(range(0, 3 * CHUNK_SIZE, 7)), [5 * CHUNK_SIZE + 1]],                      # Chunks in only one of the sets
+    [sorted(rnd.sample(range(300000), 20000)), sorted(rnd.sample(range(300000), 50000))],
+]
+
+def test_bitmap(idx):
+    (list1, list2) = BITMAP_TEST_CASES[idx]
+    bitmap1 = Bitmap.from_doc_ids(list1)
+    bitmap2 = Bitmap.from_doc_ids(list2)
+    (set1, set2) = (set(list1), set(list2))
+
+    results = [
+        ["to_list", bitmap1.to_list(), list1],
+        ["len", len(bitmap1), len(list1)],
+        ["and", (bitmap1 & bitmap2).to_list(), sorted(set1 & set2)],
+        ["or", (bitmap1 | bitmap2).to_list(), sorted(set1 | set2)],
+        ["sub", (bitmap1 - bitmap2).to_list(), sorted(set1 - set2)],
+        ["filter", bitmap1.filter(list2), sorted(set1 & set2)],
+        ["exclude", bitmap1.exclude(list2), sorted(set2 - set1)],
+        ["contains", [docid in bitmap1 for docid in list2], [docid in set1 for docid in list2]],
+    ]
+    for (name, actual, expected) in results:
+        if actual != expected:
+            print("[TC{id}] FAILURE: Difference in {name}".format(id=idx, name=name))
+            print("Expected:", expected)
+            print("Actual  :", actual, "\n")
+            return False
+
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+
+if __name__ == '__main__':
+    ####### TEST SET OPERATIONS #######
+    success_cnt = 0
+    print("\n")
+    for i in range(0, len(BITMAP_TEST_CASES)):
+        if(test_bitmap(i)): success_cnt += 1
+    print("-----------------")
+    if(len(BITMAP_TEST_CASES) == success_cnt):
+        print("[BITMAP PASSED]")
+    else:
+        raise Exception("[BITMAP FAILED]")
+
+    ####### TEST RANGE #######
+    for num_docs in [0, 1, CHUNK_SIZE, CHUNK_SIZE + 3, 140000]:
+        if Bitmap.from_range(num_docs).to_list() != list(range(num_docs)):
+            raise Exception("[RANGE FAILED]")
+    print("[RANGE PASSED]")
+    print("-----------------")
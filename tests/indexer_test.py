@@ -0,0 +1,138 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+import tempfile
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from collections import Counter
+from indexer import (
+    read_doc,
+    gov_list_docs,
+    make_doc_ids,
+    get_token_list,
+    index_from_tokens,
+    count_doc_terms,
+    build_index_streaming,
+    build_index_parallel,
+    build_index_spimi,
+)
+from index_store import (
+    DocPaths,
+    INDEX_BIN_PATH,
+    INDEX_PKL_PATH,
+    write_index,
+    load_index,
+    stored_index_path,
+)
+
+DOCS = [
+    "Nuclear power plants produce nuclear energy.",
+    "How to stay safe during severe weather? Visit www.weather.gov.au or email info@weather.gov.au",
+    "The government's policy on science and technology (2004)",
+    "",
+    "Power, energy and the weather: science is everywhere!",
+    "café naïve résumé CAFÉ",
+]
+
+def make_collection(dir_path):
+    for (i, text) in enumerate(DOCS):
+        sub_dir = os.path.join(dir_path, "{:02d}".format(i % 2))
+        os.makedirs(sub_dir, exist_ok=True)
+        with open(os.path.join(sub_dir, "G00-{:07d}".format(i)), "w", encoding="utf-8") as f:
+            f.write(text)
+    doc_list = gov_list_docs(dir_path)
+    return doc_list, make_doc_ids(doc_list)
+
+def test_build(name, expected, actual):
+    if expected == actual and list(expected[0]) == list(actual[0]):
+        print("[{name}] SUCCESS\n".format(name=name))
+        return True
+    print("[{name}] FAILURE: Difference in index".format(name=name))
+    print("Expected:", expected)
+    print("Actual  :", actual, "\n")
+    return False
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as dir_path:
+        doc_list, doc_ids = make_collection(dir_path)
+        expected = index_from_tokens(get_token_list(doc_list, doc_ids))
+
+        ####### TEST STREAMING BUILD #######
+        streaming_success = test_build("STREAMING", expected, build_index_streaming(doc_list, doc_ids))
+        # tokens cut between chunks
+        for chunk_size in [1, 3, 16]:
+            for path in doc_list:
+                streaming_success &= count_doc_terms(path, chunk_size) == Counter(read_doc(path))
+        if streaming_success:
+            print("[STREAMING PASSED]")
+        else:
+            raise Exception("[STREAMING FAILED]")
+        print("-----------------")
+
+        ####### TEST PARALLEL BUILD #######
+        parallel_success = True
+        for num_workers in [1, 2, 3]:
+            actual = build_index_parallel(doc_list, doc_ids, num_workers, slices_per_worker=1)
+            parallel_success &= test_build("PARALLEL {n}".format(n=num_workers), expected, actual)
+        if parallel_success:
+            print("[PARALLEL PASSED]")
+        else:
+            raise Exception("[PARALLEL FAILED]")
+        print("-----------------")
+
+        ####### TEST SPIMI BUILD #######
+        spimi_success = True
+        # from one block per document up to a single block
+        for memory_budget in [1, 1000, 2**30]:
+            actual = build_index_spimi(doc_list, doc_ids, memory_budget)
+            spimi_success &= test_build("SPIMI {m}".format(m=memory_budget), expected, actual)
+        if spimi_success:
+            print("[SPIMI PASSED]")
+        else:
+            raise Exception("[SPIMI FAILED]")
+        print("-----------------")
+
+        ####### TEST BINARY INDEX #######
+        (index, doc_freq) = expected
+        index_path = os.path.join(dir_path, "stored_index.bin")
+        write_index(index_path, index.items(), doc_ids, len(doc_list))
+        (mm_index, mm_doc_freq, mm_doc_ids, mm_num_docs) = load_index(index_path)
+        actual = ({term: mm_index[term] for term in mm_index}, dict(mm_doc_freq))
+        binary_success = test_build("BINARY INDEX", expected, actual)
+        binary_success &= test_build("BINARY DOC IDS", (doc_ids, len(doc_list)), (dict(mm_doc_ids.items()), mm_num_docs))
+        binary_success &= "notaterm" not in mm_index
+        expected_paths = sorted(doc_ids, key=lambda path: doc_ids[path])
+        for ids in [doc_ids, mm_doc_ids]:
+            paths = DocPaths(ids)
+            binary_success &= [paths[docid] for docid in range(len(paths))] == expected_paths
+        mm_index.close()
+        if binary_success:
+            print("[BINARY PASSED]")
+        else:
+            raise Exception("[BINARY FAILED]")
+        print("-----------------")
+
+        ####### TEST STORED INDEX PATH #######
+        # the most recently written format is used
+        cwd = os.getcwd()
+        os.chdir(dir_path)
+        try:
+            stored_success = stored_index_path() == INDEX_BIN_PATH
+            open(INDEX_PKL_PATH, "wb").close()
+            os.utime(INDEX_BIN_PATH, ns=(0, 10**18))
+            os.utime(INDEX_PKL_PATH, ns=(0, 2 * 10**18))
+            stored_success &= stored_index_path() == INDEX_PKL_PATH
+            os.utime(INDEX_BIN_PATH, ns=(0, 3 * 10**18))
+            stored_success &= stored_index_path() == INDEX_BIN_PATH
+        finally:
+            os.chdir(cwd)
+        if stored_success:
+            print("[STORED INDEX PATH PASSED]")
+        else:
+            raise Exception("[STORED INDEX PATH FAILED]")
+        print("-----------------")
@@ -0,0 +1,122 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+import re
+import random
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from lexicon import Lexicon
+from query_boolean import run_boolean_query
+import query_tfidf
+
+def make_terms(num_terms, seed):
+    rnd = random.Random(seed)
+    terms = set()
+    while len(terms) < num_terms:
+        # few letters, so that many terms share prefixes
+        terms.add("".join(rnd.choice("abcé") for _ in range(rnd.randint(1, 8))))
+    return list(terms)
+
+PATTERNS = ["", "a", "ab", "abz", "é", "zz", "a*", "ab*", "é*", "*", "*c", "a*c", "*b*", "a**b", "c*é*a", "z*"]
+
+def brute_force(terms, pattern):
+    regex = re.compile(".*".join(re.escape(part) for part in pattern.split("*")), re.DOTALL)
+    return sorted(term for term in terms if regex.fullmatch(term))
+
+def test_lexicon(num_terms):
+    terms = make_terms(num_terms, num_terms)
+    lexicon = Lexicon(terms)
+    sorted_terms = sorted(terms)
+    if list(lexicon) != sorted_terms or len(lexicon) != num_terms:
+        print("[{n} TERMS] FAILURE: Difference in the sorted terms".format(n=num_terms))
+        return False
+    for (term_id, term) in enumerate(sorted_terms):
+        if lexicon.find(term) != term_id or lexicon.term_at(term_id) != term:
+            print("[{n} TERMS] FAILURE: Difference in the id of {t}".format(n=num_terms, t=term))
+            return False
+    for term in ["", "zzz", "aaaaaaaaa", "abcd" * 3]:
+        if (term in lexicon) != (term in terms):
+            print("[{n} TERMS] FAILURE: Difference in lookup of {t}".format(n=num_terms, t=term))
+            return False
+    for pattern in PATTERNS:
+        expected = brute_force(terms, pattern)
+        for max_terms in [1, 5, 100000]:
+            actual = lexicon.expand(pattern, max_terms)
+            if actual != (expected[:max_terms], len(expected) > max_terms):
+                print("[{n} TERMS] FAILURE: Difference in expansion of {p}".format(n=num_terms, p=pattern))
+                print("Expected:", expected[:max_terms])
+                print("Actual  :", actual, "\n")
+                return False
+    print("[{n} TERMS] SUCCESS\n".format(n=num_terms))
+    return True
+
+INDEX = {
+    "econom":    [(0, 1), (3, 2)],
+    "economi":   [(1, 1)],
+    "economist": [(2, 3), (3, 1)],
+    "ecolog":    [(4, 1)],
+    "power":     [(0, 2), (2, 1), (4, 1)],
+}
+DOC_FREQ = {term: len(postings) for (term, postings) in INDEX.items()}
+NUM_DOCS = 10
+
+# [query with *, same query without *]
+BOOLEAN_TEST_CASES = [
+    ["econom*", "econom OR economi OR economist"],
+    ["eco* AND power", "(econom OR economi OR economist OR ecolog) AND power"],
+    ["NOT econ*", "NOT (econom OR economi OR economist)"],
+    ["e*t OR ecolog*", "economist OR ecolog"],
+    ["zzz*", "zzz"],
+    ["*", "INVALID: * matches more than 4 terms"],
+]
+
+def test_boolean(idx, lexicon):
+    (query_string, expected_query) = BOOLEAN_TEST_CASES[idx]
+    expected = [expected_query] if expected_query.startswith("INVALID") else \
+        run_boolean_query(expected_query, INDEX, DOC_FREQ, NUM_DOCS)
+    actual = run_boolean_query(query_string, INDEX, DOC_FREQ, NUM_DOCS, lexicon=lexicon, max_expansions=4)
+    if expected != actual:
+        print("[TC{id}] FAILURE: Difference in result of {q}".format(id=idx, q=query_string))
+        print("Expected:", expected)
+        print("Actual  :", actual, "\n")
+        return False
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+
+if __name__ == '__main__':
+    ####### TEST LEXICON #######
+    success = True
+    for num_terms in [0, 1, 15, 16, 17, 300]:
+        success &= test_lexicon(num_terms)
+    if success:
+        print("[LEXICON PASSED]")
+    else:
+        raise Exception("[LEXICON FAILED]")
+    print("-----------------")
+
+    ####### TEST BOOLEAN WILDCARDS #######
+    lexicon = Lexicon(INDEX)
+    success_cnt = 0
+    for i in range(0, len(BOOLEAN_TEST_CASES)):
+        if(test_boolean(i, lexicon)): success_cnt += 1
+    print("-----------------")
+    if(len(BOOLEAN_TEST_CASES) == success_cnt):
+        print("[BOOLEAN WILDCARD PASSED]")
+    else:
+        raise Exception("[BOOLEAN WILDCARD FAILED]")
+
+    ####### TEST RANKED WILDCARDS #######
+    doc_norm = query_tfidf.get_doc_to_norm(INDEX, DOC_FREQ, NUM_DOCS)
+    expected = query_tfidf.run_query("econom economi economist power", INDEX, DOC_FREQ, doc_norm, NUM_DOCS)
+    actual = query_tfidf.run_query("Econom*, power", INDEX, DOC_FREQ, doc_norm, NUM_DOCS, lexicon=lexicon)
+    if expected != actual:
+        print("Expected:", expected)
+        print("Actual  :", actual, "\n")
+        raise Exception("[RANKED WILDCARD FAILED]")
+    print("[RANKED WILDCARD PASSED]")
+    print("-----------------")
@@ -0,0 +1,147 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+import random
+import tempfile
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from indexer import (
+    read_doc,
+    make_doc_ids,
+    build_index_streaming,
+)
+from positions import (
+    phrase_terms,
+    build_positional_index,
+    match_phrase,
+)
+from query_boolean import run_boolean_query
+import query_tfidf
+
+WORDS = ["nuclear", "power", "plant", "plants", "the", "of", "weather", "severe", "safe", "Power,"]
+
+# [phrase, slop]
+PHRASE_TEST_CASES = [
+    ["nuclear power", 0],
+    ["nuclear power plant", 0],
+    ["power nuclear", 0],
+    ["power power", 0],
+    ["power of the plant", 0],
+    ["severe weather safe", 0],
+    ["plant", 0],
+    ["notaword power", 0],
+    ["nuclear plant", 1],
+    ["plant nuclear", 1],
+    ["nuclear plant weather", 3],
+    ["safe safe", 2],
+]
+
+def write_doc(dir_path, i, rnd):
+    path = os.path.join(dir_path, "G00-{:07d}".format(i)).replace("\\", "/")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 15))))
+    return path
+
+def brute_force(docs, terms, slop):
+    """doc_ids of the documents whose processed tokens contain the phrase"""
+    res = []
+    for (docid, toks) in enumerate(docs):
+        if slop == 0:
+            found = any(toks[i:i + len(terms)] == terms for i in range(len(toks) - len(terms) + 1))
+        else:
+            width = len(terms) + slop
+            found = any(set(terms) <= set(toks[i:i + width]) for i in range(max(1, len(toks) - width + 1)))
+        if found and len(terms) > 0:
+            res.append(docid)
+    return res
+
+def test_phrase(idx, docs, positional_index):
+    (phrase, slop) = PHRASE_TEST_CASES[idx]
+    terms = phrase_terms(phrase)
+    expected = brute_force(docs, terms, slop)
+    actual = match_phrase(terms, positional_index, slop)
+    if expected != actual:
+        print("[TC{id}] FAILURE: Difference in documents of {p}".format(id=idx, p=phrase))
+        print("Expected:", expected)
+        print("Actual  :", actual, "\n")
+        return False
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as dir_path:
+        rnd = random.Random(0)
+        paths = [write_doc(dir_path, i, rnd) for i in range(60)]
+        doc_ids = make_doc_ids(paths)
+        num_docs = len(paths)
+        docs = [read_doc(path) for path in paths]
+        (index, doc_freq) = build_index_streaming(paths, doc_ids)
+        positional_index = build_positional_index(paths, doc_ids)
+
+        ####### TEST POSITIONAL INDEX #######
+        expected = {}
+        for (docid, toks) in enumerate(docs):
+            for (pos, tok) in enumerate(toks):
+                if tok not in expected:
+                    expected[tok] = {}
+                expected[tok].setdefault(docid, []).append(pos)
+        expected = {tok: sorted(postings.items()) for (tok, postings) in expected.items()}
+        actual = {tok: [(docid, positions) for (docid, positions) in positional_index[tok]] for tok in positional_index}
+        if expected != actual or list(positional_index) != list(index):
+            raise Exception("[POSITIONAL INDEX FAILED]")
+        print("[POSITIONAL INDEX PASSED]")
+        print("-----------------")
+
+        ####### TEST PHRASES #######
+        success_cnt = 0
+        for i in range(0, len(PHRASE_TEST_CASES)):
+            if(test_phrase(i, docs, positional_index)): success_cnt += 1
+        print("-----------------")
+        if(len(PHRASE_TEST_CASES) == success_cnt):
+            print("[PHRASE PASSED]")
+        else:
+            raise Exception("[PHRASE FAILED]")
+
+        ####### TEST BOOLEAN PHRASES #######
+        nuclear_power = brute_force(docs, phrase_terms("nuclear power"), 0)
+        near = brute_force(docs, phrase_terms("plant weather"), 2)
+        weather = brute_force(docs, ["weather"], 0)
+        boolean_success = True
+        for (query_string, expected) in [
+            ('"nuclear power"', nuclear_power),
+            ('"Nuclear Power" AND NOT "plant weather"~2', sorted(set(nuclear_power) - set(near))),
+            ('"plant weather"~2 OR weather', sorted(set(near) | set(weather))),
+            ('("nuclear power")', nuclear_power),
+        ]:
+            actual = run_boolean_query(query_string, index, doc_freq, num_docs, positions=positional_index)
+            boolean_success &= expected == actual
+        boolean_success &= run_boolean_query('"nuclear power"', index, doc_freq, num_docs) == \
+            ["INVALID: Phrases need a positional index"]
+        if boolean_success:
+            print("[BOOLEAN PHRASE PASSED]")
+        else:
+            raise Exception("[BOOLEAN PHRASE FAILED]")
+        print("-----------------")
+
+        ####### TEST RANKED PHRASES #######
+        doc_norm = query_tfidf.get_doc_to_norm(index, doc_freq, num_docs)
+        ranked_success = True
+        for k in [None, 3]:
+            unfiltered = query_tfidf.run_query("safe nuclear power", index, doc_freq, doc_norm, num_docs)
+            expected = [(docid, score) for (docid, score) in unfiltered if docid in nuclear_power][:k]
+            actual = query_tfidf.run_query('safe "nuclear power"', index, doc_freq, doc_norm, num_docs, k=k,
+                                           positions=positional_index)
+            ranked_success &= expected == actual
+            actual = query_tfidf.run_query_maxscore('safe "nuclear power"', index, doc_freq, doc_norm, num_docs, k=k,
+                                                    positions=positional_index)
+            ranked_success &= expected == actual
+        if ranked_success:
+            print("[RANKED PHRASE PASSED]")
+        else:
+            raise Exception("[RANKED PHRASE FAILED]")
+        print("-----------------")
@@ -0,0 +1,63 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from postings_codec import (
+    CODECS,
+    CompressedIndex,
+    encode_postings,
+    decode_postings,
+    decode_doc_ids,
+)
+
+POSTINGS_TEST_CASES = [
+    [],                                                                             # Empty list
+    [(0, 1)],                                                                       # doc_id 0 (gap of 0)
+    [(3, 1), (4, 2), (200, 127), (201, 128), (70000, 1)],                           # Gaps and tfs across byte boundaries
+    [(i * 3, 1 + i % 5) for i in range(300)],                                       # Several bit-packed blocks
+    [(i, 300) for i in range(129)],                                                 # 16 bits tfs, partial last block
+    [(2**31 + 5, 2**20)],                                                           # Large values
+]
+
+def test_codec(codec, idx):
+    postings = POSTINGS_TEST_CASES[idx]
+    data = encode_postings(postings, codec)
+    decoded = decode_postings(data, codec)
+    doc_ids = decode_doc_ids(data, codec)
+
+    if decoded != postings or doc_ids != [docid for (docid, tf) in postings]:
+        print("[TC{id}] FAILURE: Difference in data".format(id=idx))
+        print("Expected:", postings)
+        print("Actual  :", decoded, doc_ids, "\n")
+        return False
+
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+
+if __name__ == '__main__':
+    ####### TEST ENCODE / DECODE #######
+    for codec in CODECS:
+        success_cnt = 0
+        print("\n")
+        for i in range(0, len(POSTINGS_TEST_CASES)):
+            if(test_codec(codec, i)): success_cnt += 1
+        print("-----------------")
+        if(len(POSTINGS_TEST_CASES) == success_cnt):
+            print("[{codec} PASSED]".format(codec=codec.upper()))
+        else:
+            raise Exception("[{codec} FAILED]".format(codec=codec.upper()))
+
+    ####### TEST COMPRESSED INDEX #######
+    index = {"car": [(1, 1), (2, 5)], "insurance": [(3, 1)], "auto": [(1, 3), (4, 2)]}
+    for codec in CODECS:
+        compressed = CompressedIndex(index, codec)
+        if dict(compressed) != index or "bike" in compressed or compressed.doc_ids_of("auto") != [1, 4]:
+            raise Exception("[COMPRESSED INDEX {codec} FAILED]".format(codec=codec.upper()))
+    print("[COMPRESSED INDEX PASSED]")
+    print("-----------------")
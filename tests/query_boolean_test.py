@@ -7,7 +7,8 @@ sys.path.append(parent)
 
 #############################################################################
 
-from query_boolean import union_query, intersect_query, parse_query
+from query_boolean import union_query, intersect_query, intersect_galloping, intersect_adaptive, parse_query, run_boolean_query, union_many, intersect_many
+from bitmap import build_bitmaps
 
 LIST1_IDX = 0
 LIST2_IDX = 1
@@ -20,6 +21,8 @@ PARSE_MSG_IDX = 3
 
 TEST_UNION = "union"
 TEST_INTERSECT = "intersect"
+TEST_GALLOPING = "galloping"
+TEST_ADAPTIVE = "adaptive"
 
 UNION_TEST_CASES = [
     [[1, 2, 3, 5], [4, 6, 7], [1, 2, 3, 4, 5, 6, 7]],                               # Normal case
@@ -38,6 +41,21 @@ INTERSECT_TEST_CASES = [
     [[0, 2, 4], [1, 3], []],                                                        # No intersect
     [[], [1, 2, 3], []],                                                            # One of the lists is empty
     [[4, 6], [], []],                                                               # One of the lists is empty
+    [[5, 500, 999], list(range(0, 1000, 5)), [5, 500]],                             # Short list against a long one
+    [list(range(0, 3000, 3)), [0, 2999], [0]],                                      # Long list against a short one
+    [[10**6], list(range(1000)), []],                                               # Past the end of the long list
+]
+
+# [lists, expected union, expected intersection]
+MANY_TEST_CASES = [
+    [[[1, 4, 7], [2, 4, 8], [4, 7, 9]], [1, 2, 4, 7, 8, 9], [4]],                 # Normal case
+    [[[1, 2, 3]], [1, 2, 3], [1, 2, 3]],                                            # Single list
+    [[[], [1, 2], [2, 3]], [1, 2, 3], []],                                          # One of the lists is empty
+    [[[1, 2, 3], [1, 2, 3], [1, 2, 3], [1, 2, 3]], [1, 2, 3], [1, 2, 3]],           # All the lists are the same
+    [[list(range(0, 1000, 2)), list(range(0, 1000, 3)), [0, 6, 7, 600, 999]] + [[n] for n in range(5)],
+     sorted(set(range(0, 1000, 2)) | set(range(0, 1000, 3)) | {1, 7, 999}), []],    # Many lists of skewed lengths
+    [[list(range(0, 1000, 2)), list(range(0, 1000, 3)), [0, 6, 7, 600, 999]],
+     sorted(set(range(0, 1000, 2)) | set(range(0, 1000, 3)) | {7, 999}), [0, 6, 600]],
 ]
 
 PARSE_TEST_CASES = [
@@ -51,6 +69,72 @@ PARSE_TEST_CASES = [
     ["australia commonwealth canberra", [], [], "INVALID: 2 terms cannot appear next to each other: australia commonwealth"]
 ]
 
+# doc_ids 0 .. 9, each term maps to (doc_id, tf) postings
+BOOLEAN_NUM_DOCS = 10
+BOOLEAN_INDEX = {
+    "anu":       [(0, 1), (1, 2), (2, 1), (3, 1), (5, 1), (8, 3)],
+    "australia": [(1, 1), (3, 2), (4, 1), (8, 1)],
+    "canberra":  [(2, 1), (3, 1), (9, 1)],
+    "science":   [(3, 1)],
+}
+
+BOOLEAN_QUERY_TEST_CASES = [
+    ["anu AND australia", [1, 3, 8]],
+    ["canberra OR anu AND australia", [1, 2, 3, 8, 9]],                              # AND binds tighter than OR
+    ["(canberra OR anu) AND australia", [1, 3, 8]],                                  # Brackets
+    ["anu AND NOT australia", [0, 2, 5]],
+    ["NOT anu", [4, 6, 7, 9]],
+    ["NOT anu AND NOT australia", [6, 7, 9]],
+    ["NOT (anu OR australia OR canberra)", [6, 7]],
+    ["NOT NOT science", [3]],
+    ["anu AND (australia AND (canberra OR science))", [3]],
+    ["anu AND missing", []],                                                         # Term not in the index
+    ["missing OR science", [3]],
+    ["anu AND", ["INVALID: Operation cannot be at the end of a query"]],
+    ["(anu OR australia", ["INVALID: Missing closing bracket"]],
+    ["anu OR australia)", ["INVALID: Unexpected closing bracket"]],
+    ["anu NOT australia", ["INVALID: 2 terms cannot appear next to each other: anu NOT"]],
+    ["anu AND NOT OR canberra", ["INVALID: 2 operations cannot appear next to each other: NOT OR"]],
+    ["( ) )", ["INVALID: Empty brackets"]],                                          # ) is never a term
+    ["()", ["INVALID: Empty brackets"]],
+    ["( )", ["INVALID: Empty brackets"]],
+    ["anu AND ( )", ["INVALID: Empty brackets"]],
+    ["(anu OR ())", ["INVALID: Empty brackets"]],
+    ["( AND anu)", ["INVALID: Operation cannot be at the start of brackets"]],
+    ["(", ["INVALID: Missing closing bracket"]],
+]
+
+def test_boolean_query(idx, bitmap_threshold=None):
+    (query, expected) = BOOLEAN_QUERY_TEST_CASES[idx]
+    doc_freq = {term: len(postings) for (term, postings) in BOOLEAN_INDEX.items()}
+    bitmaps = None
+    if bitmap_threshold is not None:
+        bitmaps = build_bitmaps(BOOLEAN_INDEX, doc_freq, BOOLEAN_NUM_DOCS, bitmap_threshold)
+    
+    res = run_boolean_query(query, BOOLEAN_INDEX, doc_freq, BOOLEAN_NUM_DOCS, bitmaps=bitmaps)
+    if(list(res) != expected):
+        print("[TC{id}] FAILURE: {query}".format(id=idx, query=query))
+        print("Expected:", expected)
+        print("Actual  :", res, "\n")
+        return False
+    
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+def test_many(idx):
+    (lists, expected_union, expected_intersect) = MANY_TEST_CASES[idx]
+    
+    res_union = union_many(lists)
+    res_intersect = intersect_many(lists)
+    if(res_union != expected_union or res_intersect != expected_intersect):
+        print("[TC{id}] FAILURE: Difference in data".format(id=idx))
+        print("Expected:", expected_union, expected_intersect)
+        print("Actual  :", res_union, res_intersect, "\n")
+        return False
+    
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
 def test_parse(idx):
     test_case = PARSE_TEST_CASES[idx]
     
@@ -106,7 +190,7 @@ def test_query(type, idx):
     test_case = None
     res = []
     
-    if(type == TEST_INTERSECT):
+    if(type in [TEST_INTERSECT, TEST_GALLOPING, TEST_ADAPTIVE]):
         test_case =  INTERSECT_TEST_CASES[idx]
     elif(type == TEST_UNION):
         test_case = UNION_TEST_CASES[idx]
@@ -116,6 +200,10 @@ def test_query(type, idx):
     
     if(type == TEST_INTERSECT):
         res = intersect_query(list1, list2)
+    elif(type == TEST_GALLOPING):
+        res = intersect_galloping(list1, list2)
+    elif(type == TEST_ADAPTIVE):
+        res = intersect_adaptive(list1, list2)
     elif(type == TEST_UNION):
         res = union_query(list1, list2)
     res.sort()
@@ -162,6 +250,31 @@ if __name__ == '__main__':
     else:
         raise Exception("[INTERSECT FAILED]")
     ################################################################################
+
+    ###################   TEST GALLOPING / ADAPTIVE INTERSECT   ###################
+    for test_type in [TEST_GALLOPING, TEST_ADAPTIVE]:
+        success_cnt = 0
+        print("\n")
+        for i in range(0, len(INTERSECT_TEST_CASES)):
+            if(True == test_query(test_type, i)): success_cnt += 1
+        print("-----------------")
+        if(len(INTERSECT_TEST_CASES) == success_cnt):
+            print("[{t} PASSED]".format(t=test_type.upper()))
+        else:
+            raise Exception("[{t} FAILED]".format(t=test_type.upper()))
+    ################################################################################
+    
+    ########################   TEST N-ARY UNION / INTERSECT   ######################
+    many_success_cnt = 0
+    print("\n")
+    for i in range(0, len(MANY_TEST_CASES)):
+        if(True == test_many(i)): many_success_cnt += 1
+    print("-----------------")
+    if(len(MANY_TEST_CASES) == many_success_cnt):
+        print("[N-ARY PASSED]")
+    else:
+        raise Exception("[N-ARY FAILED]")
+    ################################################################################
     
     #############################   TEST PARSE QUERY   #############################
     parse_success_cnt = 0
@@ -174,3 +287,17 @@ if __name__ == '__main__':
     else:
         raise Exception("[PARSE FAILED]")
     ################################################################################
+
+    ###########################   TEST BOOLEAN QUERY   ############################
+    query_success_cnt = 0
+    print("\n")
+    # lists only, bitmaps for "anu" and "australia" only (mixed operands), bitmaps only
+    for bitmap_threshold in [None, 0.4, 0.0]:
+        for i in range(0, len(BOOLEAN_QUERY_TEST_CASES)):
+            if(True == test_boolean_query(i, bitmap_threshold)): query_success_cnt += 1
+    print("-----------------")
+    if(3 * len(BOOLEAN_QUERY_TEST_CASES) == query_success_cnt):
+        print("[BOOLEAN QUERY PASSED]")
+    else:
+        raise Exception("[BOOLEAN QUERY FAILED]")
+    ################################################################################
@@ -0,0 +1,117 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from query_cache import (
+    QueryResultCache,
+    cached_query_func,
+)
+from query_boolean import run_boolean_query
+from positions import PositionalIndex
+import query_tfidf
+
+INDEX = {
+    "nuclear": [(0, 2), (2, 1)],
+    "power":   [(0, 1), (1, 3), (3, 1)],
+    "weather": [(1, 1), (2, 2)],
+}
+DOC_FREQ = {term: len(postings) for (term, postings) in INDEX.items()}
+NUM_DOCS = 10
+DOC_NORM = query_tfidf.get_doc_to_norm(INDEX, DOC_FREQ, NUM_DOCS)
+
+# [queries run in order, expected hits after them, expected size of the cache]
+RANKED_TEST_CASES = [
+    [["nuclear power", "nuclear power"], 1, 1],                                     # Same query
+    [["nuclear power", "Power, NUCLEAR!"], 1, 1],                                   # Same processed terms
+    [["nuclear power", "nuclear power power"], 0, 2],                               # Different term frequencies
+    [["nuclear", "power", "weather", "nuclear"], 0, 2],                             # Evicted (maxsize 2)
+    [["nuclear", "power", "nuclear", "weather", "nuclear"], 2, 2],                  # Recently used, kept
+]
+
+BOOLEAN_TEST_CASES = [
+    [["nuclear AND power", "power AND nuclear"], 1, 1],
+    [["nuclear AND power", "power AND (nuclear AND nuclear)"], 1, 1],
+    [["nuclear OR weather", "NOT NOT (weather OR nuclear)"], 1, 1],
+    [["nuclear AND power", "nuclear OR power"], 0, 2],
+]
+
+def test_cache(name, idx, run):
+    (queries, expected_hits, expected_size) = (RANKED_TEST_CASES if name == "RANKED" else BOOLEAN_TEST_CASES)[idx]
+    cache = QueryResultCache(maxsize=2, index_version=0)
+    for query_string in queries:
+        res = run(query_string, cache)
+        if res != run(query_string, None):
+            print("[TC{id}] FAILURE: Cached result differs for {q}".format(id=idx, q=query_string))
+            return False
+    stats = cache.stats()
+    if stats["hits"] != expected_hits or stats["size"] != expected_size:
+        print("[TC{id}] FAILURE: Difference in statistics".format(id=idx))
+        print("Expected:", expected_hits, expected_size)
+        print("Actual  :", stats, "\n")
+        return False
+
+    print("[TC {id}] SUCCESS\n".format(id=idx))
+    return True
+
+def run_ranked(query_string, cache):
+    if cache is None:
+        return query_tfidf.run_query(query_string, INDEX, DOC_FREQ, DOC_NORM, NUM_DOCS)
+    query_func = cached_query_func(query_tfidf.run_query, cache)
+    return query_func(query_string, INDEX, DOC_FREQ, DOC_NORM, NUM_DOCS)
+
+def run_boolean(query_string, cache):
+    return run_boolean_query(query_string, INDEX, DOC_FREQ, NUM_DOCS, cache=cache)
+
+
+if __name__ == '__main__':
+    for (name, test_cases, run) in [("RANKED", RANKED_TEST_CASES, run_ranked), ("BOOLEAN", BOOLEAN_TEST_CASES, run_boolean)]:
+        success_cnt = 0
+        print("\n")
+        for i in range(0, len(test_cases)):
+            if(test_cache(name, i, run)): success_cnt += 1
+        print("-----------------")
+        if(len(test_cases) == success_cnt):
+            print("[{name} CACHE PASSED]".format(name=name))
+        else:
+            raise Exception("[{name} CACHE FAILED]".format(name=name))
+
+    ####### TEST INVALIDATION #######
+    cache = QueryResultCache(index_version=0)
+    run_ranked("nuclear", cache)
+    cache.set_index_version(0)
+    run_ranked("nuclear", cache)
+    cache.set_index_version(1)
+    run_ranked("nuclear", cache)
+    stats = cache.stats()
+    if stats["hits"] != 1 or stats["misses"] != 2 or stats["invalidations"] != 1:
+        raise Exception("[INVALIDATION FAILED]")
+    print("[INVALIDATION PASSED]")
+    print("-----------------")
+
+    ####### TEST PHRASES #######
+    # processed tokens of the documents of INDEX
+    positions = PositionalIndex()
+    for (docid, toks) in enumerate([["nuclear", "nuclear", "power"], ["power", "power", "weather", "power"],
+                                    ["weather", "nuclear", "weather"], ["power"]]):
+        positions.add_document(docid, toks)
+    positions.finish()
+    def run_phrases(query_string, index, doc_freq, doc_norm, num_docs, k=None):
+        return query_tfidf.run_query(query_string, index, doc_freq, doc_norm, num_docs, k=k, positions=positions)
+    cache = QueryResultCache(index_version=0)
+    query_func = cached_query_func(run_phrases, cache)
+    phrase_success = True
+    for query_string in ['"nuclear power" weather', 'nuclear power weather', '"power nuclear" weather',
+                         '"nuclear power" weather', '"power nuclear"~1 weather']:
+        expected = run_phrases(query_string, INDEX, DOC_FREQ, DOC_NORM, NUM_DOCS)
+        phrase_success &= query_func(query_string, INDEX, DOC_FREQ, DOC_NORM, NUM_DOCS) == expected
+    phrase_success &= cache.stats()["hits"] == 1
+    if phrase_success:
+        print("[PHRASE CACHE PASSED]")
+    else:
+        raise Exception("[PHRASE CACHE FAILED]")
+    print("-----------------")
@@ -2,13 +2,21 @@
 import sys
 import os
 import math
+import pickle
+import tempfile
 
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 #############################################################################
 
-from query_tfidf import (calc_idf, get_doc_to_norm)
+import random
+from query_tfidf import (calc_idf, get_doc_to_norm, run_query, run_query_maxscore)
+from query import (get_query_tokens, query_main)
+from index_store import INDEX_PKL_PATH
+import query_numpy
+from doc_norms import compute_doc_norms
+from lexicon import Lexicon
 
 IDF_DF_IDX = 0
 IDF_NUM_IDX = 1
@@ -34,6 +42,49 @@ def test_idf(idx):
         return False
     
 
+def make_random_index(words, num_docs, seed):
+    # index keys have to be processed the same way as the query tokens
+    rnd = random.Random(seed)
+    index = {}
+    for word in words:
+        term = get_query_tokens(word)[0]
+        doc_list = sorted(rnd.sample(range(num_docs), rnd.randint(1, num_docs // 2)))
+        # small tfs to get many ties
+        index[term] = [(doc_id, rnd.randint(1, 3)) for doc_id in doc_list]
+    doc_freq = {term: len(index[term]) for term in index}
+    return index, doc_freq
+
+RANKING_WORDS = ["nuclear", "power", "plant", "weather", "severe", "science", "energy", "safety"]
+RANKING_QUERIES = [
+    "nuclear",
+    "nuclear power plant",
+    "severe weather safety safety",
+    "science energy power weather nuclear plant safety severe",
+    "unknownword nuclear",
+]
+
+def test_ranking(name, query_func, idx, **kwargs):
+    (index, doc_freq) = make_random_index(RANKING_WORDS, 200, idx)
+    doc_norms = get_doc_to_norm(index, doc_freq, 200)
+    for query_string in RANKING_QUERIES:
+        expected = run_query(query_string, index, doc_freq, doc_norms, 200)
+        for k in [0, 1, 5, 10, 1000]:
+            actual = query_func(query_string, index, doc_freq, doc_norms, 200, k=k, **kwargs)
+            if(len(actual) != len(expected[:k]) or
+               any(a[0] != e[0] or abs(a[1] - e[1]) > 1e-9 for (a, e) in zip(actual, expected[:k]))):
+                print("[{name} TC{id}] FAILURE: Difference in ranking of {q} (k={k})".format(name=name, id=idx, q=query_string, k=k))
+                print("Expected:", expected[:k])
+                print("Actual  :", actual, "\n")
+                return False
+    print("[{name} TC{id}] SUCCESS\n".format(name=name, id=idx))
+    return True
+
+def run_batch(**kwargs):
+    query_main(query_func=run_query, doc_norm_func=get_doc_to_norm, **kwargs)
+    with open("retrieved.txt", "rb") as f:
+        return f.read()
+
+
 if __name__ == '__main__':
     ####### TEST IDF CALCULATION #######
     idf_success_cnt = 0
@@ -88,4 +139,97 @@ if __name__ == '__main__':
     else:
         raise Exception("[NORMS FAILED]\n")
     print("-----------------")
-     
\ No newline at end of file
+    
+    ####### TEST STORED NORMS #######
+    # doc_ids of the stored norms are 0..num_docs-1
+    stored_norms = compute_doc_norms(index, doc_freq, doc_num + 1, calc_idf)["tfidf"]
+    expected_norms = get_doc_to_norm(index, doc_freq, doc_num + 1)
+    if(stored_norms[0] == 0 and all(stored_norms[doc_id] == expected_norms[doc_id] for doc_id in expected_norms)):
+        print("[STORED NORMS PASSED]")
+    else:
+        print("Expected:", dict(expected_norms))
+        print("Actual  :", list(stored_norms))
+        raise Exception("[STORED NORMS FAILED]\n")
+    print("-----------------")
+         
+    ####### TEST TOP-K #######
+    topk_success_cnt = 0
+    for i in range(0, 5):
+        if(test_ranking("TOP-K", run_query, i)): topk_success_cnt += 1
+    if(topk_success_cnt == 5):
+        print("[TOP-K PASSED]")
+    else:
+        raise Exception("[TOP-K FAILED]\n")
+    print("-----------------")
+    
+    ####### TEST MAXSCORE #######
+    maxscore_success_cnt = 0
+    for i in range(0, 5):
+        if(test_ranking("MAXSCORE", run_query_maxscore, i)): maxscore_success_cnt += 1
+    if(maxscore_success_cnt == 5):
+        print("[MAXSCORE PASSED]")
+    else:
+        raise Exception("[MAXSCORE FAILED]\n")
+    print("-----------------")
+    
+    ####### TEST NUMPY SCORER #######
+    numpy_success_cnt = 0
+    for i in range(0, 5):
+        if(test_ranking("NUMPY", query_numpy.run_query, i)): numpy_success_cnt += 1
+    if(numpy_success_cnt == 5):
+        print("[NUMPY PASSED]")
+    else:
+        raise Exception("[NUMPY FAILED]\n")
+    print("-----------------")
+
+    ####### TEST NUMPY CACHE AND FALLBACK #######
+    # the arrays of at most maxsize posting lists are kept
+    (index, doc_freq) = make_random_index(RANKING_WORDS, 200, 0)
+    doc_norms = get_doc_to_norm(index, doc_freq, 200)
+    fallback_success = True
+    for maxsize in [0, 2]:
+        array_index = query_numpy.build_array_index(index, maxsize)
+        for query_string in RANKING_QUERIES:
+            fallback_success &= (query_numpy.run_query(query_string, array_index, doc_freq, doc_norms, 200, k=10) ==
+                                 run_query(query_string, index, doc_freq, doc_norms, 200, k=10))
+        fallback_success &= len(array_index.arrays) <= maxsize
+    # wildcards and phrases run on the pure Python scorer
+    lexicon = Lexicon(doc_freq)
+    for query_string in ["nucl* power", "scien* energ*"]:
+        fallback_success &= (query_numpy.run_query(query_string, index, doc_freq, doc_norms, 200, k=10, lexicon=lexicon) ==
+                             run_query(query_string, index, doc_freq, doc_norms, 200, k=10, lexicon=lexicon))
+    if fallback_success:
+        print("[NUMPY CACHE PASSED]")
+    else:
+        raise Exception("[NUMPY CACHE FAILED]\n")
+    print("-----------------")
+
+    ####### TEST PARALLEL BATCH #######
+    # the run file is the same with several workers, in the order of gov.topics
+    (index, doc_freq) = make_random_index(RANKING_WORDS, 200, 0)
+    doc_ids = {"./gov/documents/00/G00-00-{:07d}".format(doc_id): doc_id for doc_id in range(200)}
+    qids = [str(700 + i) for i in range(len(RANKING_QUERIES) * 3)]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as dir_path:
+        os.chdir(dir_path)
+        try:
+            os.makedirs(os.path.join("gov", "topics"))
+            with open(os.path.join("gov", "topics", "gov.topics"), "w") as f:
+                for (i, qid) in enumerate(qids):
+                    f.write("{qid} {q}\n".format(qid=qid, q=RANKING_QUERIES[i % len(RANKING_QUERIES)]))
+            with open(INDEX_PKL_PATH, "wb") as f:
+                pickle.dump((index, doc_freq, doc_ids, 200), f)
+            parallel_success = True
+            for k in [None, 5]:
+                expected = run_batch(k=k, workers=1)
+                actual = run_batch(k=k, workers=2)
+                run_qids = [line.split()[0] for line in expected.decode().splitlines()]
+                parallel_success &= actual == expected
+                parallel_success &= [qid for (i, qid) in enumerate(run_qids) if i == 0 or run_qids[i - 1] != qid] == qids
+        finally:
+            os.chdir(cwd)
+    if parallel_success:
+        print("[PARALLEL BATCH PASSED]")
+    else:
+        raise Exception("[PARALLEL BATCH FAILED]\n")
+    print("-----------------")
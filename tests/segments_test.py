@@ -0,0 +1,158 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+import random
+import tempfile
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from indexer import (
+    make_doc_ids,
+    get_token_list,
+    index_from_tokens,
+)
+from index_store import (
+    INDEX_PKL_PATH,
+    SEGMENTS_MANIFEST_PATH,
+    stored_index_path,
+)
+from segments import SegmentManager
+from doc_norms import (
+    compute_doc_norms,
+    compute_term_upper_bounds,
+    load_doc_norms,
+)
+from query_tfidf import calc_idf
+
+WORDS = ["nuclear", "power", "weather", "science", "energy", "policy", "safe", "plant", "storm", "canberra"]
+
+def write_doc(dir_path, i, seed):
+    rnd = random.Random(seed)
+    path = os.path.join(dir_path, "G00-{:07d}".format(i)).replace("\\", "/")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 12))))
+    return path
+
+def by_path(index, doc_freq, doc_ids, num_docs):
+    """Describe an index with paths instead of doc_ids, which differ between
+    a segmented index and a rebuilt one."""
+    ids_to_doc = {docid: path for (path, docid) in doc_ids.items()}
+    postings = {term: sorted((ids_to_doc[docid], tf) for (docid, tf) in index[term]) for term in index}
+    norms = compute_doc_norms(index, doc_freq, num_docs, calc_idf)
+    norms = {variant: {ids_to_doc[docid]: round(norm, 12) for (docid, norm) in enumerate(values)}
+             for (variant, values) in norms.items()}
+    return (postings, dict(doc_freq), num_docs, sorted(doc_ids.values()) == list(range(num_docs)), norms)
+
+def test_segments(name, manager, live_paths):
+    paths = sorted(live_paths)
+    doc_ids = make_doc_ids(paths)
+    (index, doc_freq) = index_from_tokens(get_token_list(paths, doc_ids))
+    expected = by_path(index, doc_freq, doc_ids, len(paths))
+    (index, doc_freq, doc_ids, num_docs) = manager.open_index()
+    actual = by_path(index, doc_freq, doc_ids, num_docs)
+
+    # the norms and bounds stored for the queries are those of the live documents
+    manager.refresh_norms()
+    norms = compute_doc_norms(index, doc_freq, num_docs, calc_idf)
+    norms["tfidf_bounds"] = compute_term_upper_bounds(index, norms["tfidf"])
+    stored_norms = {variant: load_doc_norms(variant, manager.manifest_path) for variant in norms}
+    stored_ok = stored_norms == norms and not manager.refresh_norms()
+    # the document frequencies of the deleted documents are kept, not counted at open
+    with_deleted = {name for name in manager.manifest["segments"] if len(manager.manifest["deleted"][name]) > 0}
+    stored_ok &= set(manager.manifest["deleted_doc_freq"]) == with_deleted
+
+    if expected == actual and stored_ok:
+        print("[{name}] SUCCESS\n".format(name=name))
+        return True
+    print("[{name}] FAILURE: Difference in index".format(name=name))
+    print("Expected:", expected)
+    print("Actual  :", actual, "\n")
+    return False
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as dir_path:
+        docs_path = os.path.join(dir_path, "documents")
+        os.makedirs(docs_path)
+        manager = SegmentManager(os.path.join(dir_path, "segments"))
+        # another process changing the same segments
+        other = SegmentManager(os.path.join(dir_path, "segments"))
+        live = set()
+        success = True
+
+        ####### TEST ADD / DELETE / UPDATE #######
+        paths = [write_doc(docs_path, i, i) for i in range(8)]
+        manager.add_documents(paths[:4])
+        live |= set(paths[:4])
+        success &= test_segments("ADD", manager, live)
+
+        manager.add_documents(paths[4:])
+        live |= set(paths[4:])
+        success &= test_segments("ADD SEGMENT", manager, live)
+
+        manager.delete_documents([paths[1], paths[6], "not/indexed"])
+        live -= {paths[1], paths[6]}
+        success &= test_segments("DELETE", manager, live)
+
+        write_doc(docs_path, 2, 100)
+        manager.add_documents([paths[2]])
+        success &= test_segments("UPDATE", manager, live)
+
+        ####### TEST MERGE #######
+        more_paths = [write_doc(docs_path, i, i) for i in range(8, 12)]
+        for path in more_paths:
+            manager.add_documents([path])
+            live.add(path)
+        manager.delete_documents([paths[0]])
+        live.discard(paths[0])
+        num_segments = len(manager.manifest["segments"])
+        manager.start_background_merge()
+        manager.wait_for_merges()
+        success &= len(manager.manifest["segments"]) < num_segments
+        success &= test_segments("MERGE", manager, live)
+
+        # all the documents of a segment deleted, then merged away
+        manager.delete_documents(paths[3:6])
+        live -= set(paths[3:6])
+        manager.maybe_merge()
+        success &= test_segments("MERGE DELETED", manager, live)
+
+        ####### TEST REOPEN #######
+        success &= test_segments("REOPEN", SegmentManager(os.path.join(dir_path, "segments")), live)
+        segment_files = sorted(f for f in os.listdir(os.path.join(dir_path, "segments")) if f.startswith("seg_"))
+        success &= segment_files == sorted(name + ext for name in manager.manifest["segments"]
+                                           for ext in [".pkl", ".terms.pkl"])
+
+        ####### TEST SEVERAL MANAGERS #######
+        # each sees the changes of the other one
+        other_paths = [write_doc(docs_path, i, i) for i in range(12, 14)]
+        other.add_documents(other_paths)
+        live |= set(other_paths)
+        manager.delete_documents([other_paths[0], paths[7]])
+        live -= {other_paths[0], paths[7]}
+        success &= test_segments("OTHER MANAGER", other, live)
+        success &= test_segments("OTHER MANAGER REOPEN", SegmentManager(os.path.join(dir_path, "segments")), live)
+
+        ####### TEST STORED INDEX PATH #######
+        # the segments are only searched if they changed after indexer.py last wrote the index
+        cwd = os.getcwd()
+        os.chdir(dir_path)
+        try:
+            success &= stored_index_path() == SEGMENTS_MANIFEST_PATH
+            open(INDEX_PKL_PATH, "wb").close()
+            os.utime(SEGMENTS_MANIFEST_PATH, ns=(0, 10**18))
+            os.utime(INDEX_PKL_PATH, ns=(0, 2 * 10**18))
+            success &= stored_index_path() == INDEX_PKL_PATH
+            os.utime(SEGMENTS_MANIFEST_PATH, ns=(0, 3 * 10**18))
+            success &= stored_index_path() == SEGMENTS_MANIFEST_PATH
+        finally:
+            os.chdir(cwd)
+
+        if success:
+            print("[SEGMENTS PASSED]")
+        else:
+            raise Exception("[SEGMENTS FAILED]")
+        print("-----------------")
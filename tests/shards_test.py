@@ -0,0 +1,100 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+import random
+import tempfile
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+from indexer import (
+    make_doc_ids,
+    build_index_streaming,
+)
+from shards import (
+    ENGINES,
+    build_shards,
+    split_index,
+    ShardCoordinator,
+)
+from query_boolean import run_boolean_query
+
+WORDS = ["nuclear", "power", "weather", "science", "energy", "policy", "safe", "plant", "storm", "canberra"]
+
+RANKED_QUERIES = [
+    "nuclear power",
+    "weather weather storm",
+    "canberra science policy plant",
+    "safe",
+    "notaword power",
+    "notaword",
+]
+
+BOOLEAN_QUERIES = [
+    "nuclear AND power",
+    "weather OR storm",
+    "NOT energy",
+    "science AND NOT (policy OR plant)",
+    "notaword OR safe",
+    "AND power",
+    "",
+]
+
+def write_doc(dir_path, i, rnd):
+    path = os.path.join(dir_path, "G00-{:07d}".format(i)).replace("\\", "/")
+    with open(path, "w", encoding="utf-8") as f:
+        # few distinct documents, so many documents have equal scores
+        f.write(" ".join(rnd.choice(WORDS[:rnd.randint(1, len(WORDS))]) for _ in range(rnd.randint(0, 4))))
+    return path
+
+def test_shards(name, coordinator, index, doc_freq, doc_norms, num_docs):
+    for (engine, (run_query, _)) in ENGINES.items():
+        for query_string in RANKED_QUERIES:
+            for k in [None, 1, 5]:
+                expected = run_query(query_string, index, doc_freq, doc_norms[engine], num_docs, k=k)
+                actual = coordinator.run_query(query_string, engine, k)
+                if expected != actual:
+                    print("[{name}] FAILURE: Difference in {e} ranking of {q} (k={k})".format(name=name, e=engine, q=query_string, k=k))
+                    print("Expected:", expected)
+                    print("Actual  :", actual, "\n")
+                    return False
+    for query_string in BOOLEAN_QUERIES:
+        expected = run_boolean_query(query_string, index, doc_freq, num_docs)
+        actual = coordinator.run_boolean_query(query_string)
+        if expected != actual:
+            print("[{name}] FAILURE: Difference in boolean result of {q}".format(name=name, q=query_string))
+            print("Expected:", expected)
+            print("Actual  :", actual, "\n")
+            return False
+
+    print("[{name}] SUCCESS\n".format(name=name))
+    return True
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as dir_path:
+        rnd = random.Random(0)
+        paths = [write_doc(dir_path, i, rnd) for i in range(40)]
+        doc_ids = make_doc_ids(paths)
+        num_docs = len(paths)
+        (index, doc_freq) = build_index_streaming(paths, doc_ids)
+        doc_norms = {engine: norm_func(index, doc_freq, num_docs) for (engine, (_, norm_func)) in ENGINES.items()}
+
+        success = True
+        for num_shards in [1, 3, 7]:
+            for (how, build) in [("BUILD", lambda d: build_shards(paths, doc_ids, num_shards, d)),
+                                 ("SPLIT", lambda d: split_index(index, doc_freq, doc_ids, num_docs, num_shards, d))]:
+                shards_dir = os.path.join(dir_path, "shards_{how}_{n}".format(how=how, n=num_shards))
+                build(shards_dir)
+                with ShardCoordinator(shards_dir) as coordinator:
+                    success &= coordinator.paths == paths
+                    success &= test_shards("{how} {n}".format(how=how, n=num_shards), coordinator,
+                                           index, doc_freq, doc_norms, num_docs)
+
+        if success:
+            print("[SHARDS PASSED]")
+        else:
+            raise Exception("[SHARDS FAILED]")
+        print("-----------------")
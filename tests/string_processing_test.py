@@ -0,0 +1,118 @@
+# Reference: https://www.geeksforgeeks.org/python-import-from-parent-directory/
+import sys
+import os
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+#############################################################################
+
+import string_processing
+from string_processing import (
+    NormalizationCache,
+    analyze_stream,
+    analyze_text,
+    get_stemmer,
+    run_normalization,
+    tokenize_text,
+)
+
+DOCUMENTS = [
+    "Nuclear power plants produce nuclear energy.",
+    "How to stay safe during severe weather? Visit www.weather.gov.au or email info@weather.gov.au",
+    "The government's policy on science and technology (2004) [draft] {v2} \"quoted\" under_score",
+    "café naïve résumé CAFÉ ; : ! ?",
+    "",
+    "non\xa0breaking\u3000spaces\x85and KELVIN\u212a signs\tİstanbul\n\nend",
+]
+
+def test_cache(stemmer_name, maxsize):
+    cache = NormalizationCache(stemmer_name, maxsize)
+    # run every document twice to get hits
+    for (idx, doc) in enumerate(DOCUMENTS + DOCUMENTS):
+        toks = tokenize_text(doc)
+        expected = run_normalization(toks, get_stemmer(stemmer_name))
+        actual = cache.run_normalization(toks)
+        if actual != expected:
+            print("[TC{id}] FAILURE: Difference in data".format(id=idx))
+            print("Expected:", expected)
+            print("Actual  :", actual, "\n")
+            return False
+
+    stats = cache.stats()
+    if stats["size"] > maxsize or stats["hits"] + stats["misses"] != 2 * sum(len(tokenize_text(doc)) for doc in DOCUMENTS):
+        print("[{name} {size}] FAILURE: Wrong statistics".format(name=stemmer_name, size=maxsize))
+        print("Actual  :", stats, "\n")
+        return False
+
+    print("[{name} {size}] SUCCESS\n".format(name=stemmer_name, size=maxsize))
+    return True
+
+
+def test_analyzer(variant, chunk_size):
+    process_func = getattr(string_processing, "process_tokens_{v}".format(v=variant))
+    for (idx, doc) in enumerate(DOCUMENTS):
+        expected = process_func(tokenize_text(doc))
+        if chunk_size is None:
+            actual = analyze_text(doc, variant)
+        else:
+            chunks = [doc[i:i + chunk_size] for i in range(0, len(doc), chunk_size)]
+            actual = [tok for toks in analyze_stream(chunks, variant) for tok in toks]
+        if actual != expected:
+            print("[TC{id}] FAILURE: Difference in data".format(id=idx))
+            print("Expected:", expected)
+            print("Actual  :", actual, "\n")
+            return False
+
+    print("[{v} {size}] SUCCESS\n".format(v=variant, size=chunk_size))
+    return True
+
+
+if __name__ == '__main__':
+    ####### TEST NORMALIZATION CACHE #######
+    cache_success = True
+    for stemmer_name in ["snowball", "porter", None]:
+        # from evicting on every token to no eviction at all
+        for maxsize in [1, 8, 1000]:
+            cache_success &= test_cache(stemmer_name, maxsize)
+    if cache_success:
+        print("[CACHE PASSED]")
+    else:
+        raise Exception("[CACHE FAILED]")
+    print("-----------------")
+
+    ####### TEST ANALYZER #######
+    analyzer_success = True
+    for variant in ["original", 1, 2, 3, 4, 5]:
+        # whole document, then chunks cutting through tokens
+        for chunk_size in [None, 1, 7, 4096]:
+            analyzer_success &= test_analyzer(variant, chunk_size)
+    if analyzer_success:
+        print("[ANALYZER PASSED]")
+    else:
+        raise Exception("[ANALYZER FAILED]")
+    print("-----------------")
+
+    ####### TEST ACTIVE VARIANT #######
+    # the documents (analyze_text) and the queries (process_tokens) use the same variant
+    variant_success = True
+    active = string_processing.ACTIVE_VARIANT
+    try:
+        for variant in ["original", 1, 3, 5]:
+            string_processing.ACTIVE_VARIANT = variant
+            for doc in DOCUMENTS:
+                expected = getattr(string_processing, "process_tokens_{v}".format(v=variant))(tokenize_text(doc))
+                variant_success &= string_processing.process_tokens(tokenize_text(doc)) == expected
+                variant_success &= analyze_text(doc, variant) == expected
+                # the default variant and process_tokens.variant follow ACTIVE_VARIANT
+                variant_success &= analyze_text(doc) == expected
+            variant_success &= string_processing.process_tokens.variant == variant
+    finally:
+        string_processing.ACTIVE_VARIANT = active
+    variant_success &= string_processing.process_tokens.variant == active
+    variant_success &= analyze_text(DOCUMENTS[1]) == string_processing.process_tokens(tokenize_text(DOCUMENTS[1]))
+    if variant_success:
+        print("[ACTIVE VARIANT PASSED]")
+    else:
+        raise Exception("[ACTIVE VARIANT FAILED]")
+    print("-----------------")